@@ -0,0 +1,63 @@
+""" Сравнение библиотек JSON-кодека envi на типичных ответах (словари и списки словарей)
+
+Запуск: python benchmarks/json_codec.py
+"""
+import os
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from envi import JsonCodec, json_loads_handler
+
+
+def payloads():
+    row = {"id": 1, "name": "Иван Петров", "email": "ivan@example.com", "active": True, "score": 12.5,
+           "tags": ["a", "b", "c"], "created": datetime(2016, 1, 2, 3, 4, 5), "parent": None}
+    return {
+        "small dict": row,
+        "list of 1000 dicts": [dict(row, id=i) for i in range(1000)],
+        "nested dict": {"result": {"items": [dict(row, id=i) for i in range(100)], "total": 100, "page": 1}},
+    }
+
+
+def measure(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number
+
+
+def main():
+    codecs = []
+    for backend in JsonCodec.backends:
+        try:
+            codecs.append(JsonCodec(backend))
+        except ImportError:
+            print("%s: not installed" % backend)
+
+    print("%-20s %-8s %12s %12s %18s" % ("payload", "backend", "dumps, us", "loads, us", "loads+hook, us"))
+    for name, payload in payloads().items():
+        number = 20000 if name == "small dict" else 50
+        baseline = None
+        for codec in codecs:
+            encoded = codec.dumps(payload)
+            timings = (
+                measure(lambda: codec.dumps(payload), number),
+                measure(lambda: codec.loads(encoded), number),
+                measure(lambda: codec.loads(encoded, object_hook=json_loads_handler), number),
+            )
+            if codec.backend == "json":
+                baseline = timings
+            print("%-20s %-8s %12.1f %12.1f %18.1f" % ((name, codec.backend) + tuple(t * 1e6 for t in timings)))
+        if baseline:
+            for codec in codecs:
+                if codec.backend != "json":
+                    encoded = codec.dumps(payload)
+                    print("%-20s %-8s dumps x%.1f, loads+hook x%.1f faster than json" % (
+                        name, codec.backend,
+                        baseline[0] / measure(lambda: codec.dumps(payload), number),
+                        baseline[2] / measure(lambda: codec.loads(encoded, object_hook=json_loads_handler), number)
+                    ))
+
+
+if __name__ == "__main__":
+    main()
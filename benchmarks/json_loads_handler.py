@@ -0,0 +1,56 @@
+""" Стоимость восстановления дат (json_loads_handler) при декодировании больших JSON-тел
+
+Запуск: python benchmarks/json_loads_handler.py
+"""
+import os
+import re
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from envi import json_codec, json_loads_handler, datetime_hook
+
+
+def legacy_json_loads_handler(data):
+    """ Реализация до появления предварительных проверок: некомпилированное выражение для каждой строки """
+    for k, v in data.items():
+        if isinstance(v, str) and re.search(r"\w\w\w[\s]+\w\w\w[\s]+\d[\d]*[\s]+\d\d:\d\d:\d\d[\s]+\d\d\d\d", v):
+            data[k] = datetime.strptime(v, "%a %b %d %H:%M:%S %Y")
+    return data
+
+
+def payload(fields=12000):
+    row = {"name": "Иван Петров", "email": "ivan@example.com", "city": "Москва", "phone": "+7 (495) 123-45-67",
+           "comment": "Долгий комментарий без дат, но с двоеточием: да", "status": "active"}
+    rows = [dict(row, id=str(i), created=datetime(2016, 1, 2, 3, 4, i % 60).ctime())
+            for i in range(fields // (len(row) + 2))]
+    return json_codec.dumps(rows)
+
+
+def measure(fn, number=10):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number
+
+
+def main():
+    encoded = payload()
+    variants = [
+        ("no revival", None),
+        ("legacy handler", legacy_json_loads_handler),
+        ("json_loads_handler", json_loads_handler),
+        ("declared keys only", datetime_hook(("created",))),
+    ]
+    assert json_codec.loads(encoded, object_hook=legacy_json_loads_handler) == \
+        json_codec.loads(encoded, object_hook=json_loads_handler)
+
+    fields = sum(len(row) for row in json_codec.loads(encoded))
+    print("backend: %s, %d bytes, %d string fields" % (json_codec.backend, len(encoded), fields))
+    amounts = [(name, measure(lambda: json_codec.loads(encoded, object_hook=hook))) for name, hook in variants]
+    legacy = dict(amounts)["legacy handler"]
+    for name, amount in amounts:
+        print("%-20s %8.2f ms  x%.1f vs legacy" % (name, amount * 1000, legacy / amount))
+
+
+if __name__ == "__main__":
+    main()
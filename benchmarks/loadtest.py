@@ -0,0 +1,285 @@
+""" Нагрузочное тестирование приложения envi: пропускная способность, перцентили задержек и память воркеров
+
+Приложение запускается на локальном WSGI-сервере в workers процессах (как воркеры uwsgi, с общим сокетом),
+клиентские потоки отправляют смесь запросов разных типов в течение duration секунд. По умолчанию нагружается
+встроенное демонстрационное приложение; собственное приложение подключается параметром --app module:attribute
+(экземпляр Application или функция без аргументов, возвращающая его). Вызовы microservice() обслуживает локальный
+микросервис-заглушка (см. stub_microservice.py), его адрес передается в переменной окружения ENVI_STUB_MICROSERVICE
+
+Запуск:
+    python benchmarks/loadtest.py --concurrency 16 --duration 10 --mix ajax=4,jsonrpc=2,static=1
+    python benchmarks/loadtest.py --app myproject.app:application --request profile=/profile/get?id=1 \\
+        --mix profile=1 --workers 4 --output result.json
+
+Типы запросов встроенного приложения: plain, ajax, pjax, jsonrpc, jsonrpc_batch, static, microservice.
+Клиент и сервер работают на одной машине, поэтому результаты полезны для сравнения версий и конфигураций,
+а не как абсолютная оценка производительности. wsgiref закрывает соединение после каждого ответа,
+поэтому в задержки входит установка TCP-соединения
+"""
+import os
+import sys
+import json
+import math
+import random
+import shutil
+import argparse
+import tempfile
+import importlib
+import threading
+import http.client
+import multiprocessing
+from time import perf_counter
+from socketserver import ThreadingMixIn
+from urllib.parse import urlencode
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from envi import Application, Controller, microservice
+from stub_microservice import StubMicroService
+
+
+class LoadTestController(Controller):
+    @staticmethod
+    def page(request, **kwargs):
+        return {"id": request.get("id", cast_type=int), "items": [{"n": n, "title": "item %s" % n} for n in range(20)]}
+
+    @staticmethod
+    def add(request, **kwargs):
+        return sum(request.get("params"))
+
+    @staticmethod
+    def remote(request, **kwargs):
+        return microservice(os.environ["ENVI_STUB_MICROSERVICE"], {"id": request.get("id")}, "result.id")
+
+
+def demo_application(static_root: str) -> Application:
+    app = Application()
+    app.route("/page/", LoadTestController, "page")
+    app.route("/rpc/", LoadTestController)
+    app.route("/remote/", LoadTestController, "remote")
+    app.route_static("/static", static_root)
+    return app
+
+
+def load_application(spec: str) -> Application:
+    """ Загружает приложение по строке module:attribute """
+    module, _, attribute = spec.partition(":")
+    app = getattr(importlib.import_module(module), attribute or "application")
+    return app if isinstance(app, Application) else app()
+
+
+AJAX = {"X-Requested-With": "XMLHttpRequest"}
+
+
+def builtin_requests(batch_size: int) -> dict:
+    """ Типы запросов встроенного приложения: имя -> функция(номер запроса) -> (метод, путь, заголовки, тело) """
+    def rpc(calls):
+        return urlencode({"q": json.dumps(calls)}).encode()
+
+    form = dict(AJAX, **{"Content-Type": "application/x-www-form-urlencoded"})
+    return {
+        "plain": lambda i: ("GET", "/page?id=%s" % i, {}, None),
+        "ajax": lambda i: ("GET", "/page?id=%s" % i, AJAX, None),
+        "pjax": lambda i: ("GET", "/page?id=%s" % i, dict(AJAX, **{"X-PJAX": "true"}), None),
+        "jsonrpc": lambda i: ("POST", "/rpc", form, rpc(
+            {"jsonrpc": "2.0", "method": "add", "params": [i, 1], "id": 1}
+        )),
+        "jsonrpc_batch": lambda i: ("POST", "/rpc", form, rpc([
+            {"jsonrpc": "2.0", "method": "add", "params": [i, n], "id": n + 1} for n in range(batch_size)
+        ])),
+        "static": lambda i: ("GET", "/static/app.js", {}, None),
+        "microservice": lambda i: ("GET", "/remote?id=%s" % i, AJAX, None),
+    }
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def memory(pid) -> dict:
+    """ Текущая (rss) и пиковая (hwm) резидентная память процесса, КБ (только Linux) """
+    result = {}
+    try:
+        with open("/proc/%s/status" % pid) as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    result["rss" if line.startswith("VmRSS") else "hwm"] = int(line.split()[1])
+    except OSError:
+        pass
+    return result
+
+
+def percentile(ordered: list, p: float) -> float:
+    """ Перцентиль по упорядоченной выборке (nearest-rank) """
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+def client(port, kinds, weights, deadline, warmup_until, seed, results):
+    """ Клиентский поток: отправляет запросы до deadline; задержки после warmup_until записываются в results """
+    rnd = random.Random(seed)
+    names = list(kinds)
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    i = 0
+    while True:
+        started = perf_counter()
+        if started >= deadline:
+            break
+        name = rnd.choices(names, weights)[0]
+        method, path, headers, body = kinds[name](i)
+        i += 1
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            failed = response.status >= 400
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            failed = True
+        if started < warmup_until:
+            continue
+        latencies[name].append(perf_counter() - started)
+        if failed:
+            errors[name] += 1
+    connection.close()
+    results.append((latencies, errors))
+
+
+def run(app, kinds, mix, concurrency=8, duration=10.0, warmup=1.0, workers=1) -> dict:
+    """ Запускает сервер приложения, нагружает его и возвращает отчет """
+    server = make_server("127.0.0.1", 0, app, server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+    port = server.server_address[1]
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=server.serve_forever, daemon=True) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        memory_before = {process.pid: memory(process.pid) for process in processes}
+        names = list(mix)
+        results = []
+        warmup_until = perf_counter() + warmup
+        deadline = warmup_until + duration
+        threads = [
+            threading.Thread(target=client, args=(
+                port, {name: kinds[name] for name in names}, [mix[name] for name in names],
+                deadline, warmup_until, n, results
+            )) for n in range(concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        memory_after = {process.pid: memory(process.pid) for process in processes}
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+        server.server_close()
+
+    report = {"concurrency": concurrency, "duration": duration, "workers": workers, "kinds": {}}
+    total = []
+    total_errors = 0
+    for name in mix:
+        latencies = sorted(sample for result in results for sample in result[0][name])
+        errors = sum(result[1][name] for result in results)
+        total += latencies
+        total_errors += errors
+        report["kinds"][name] = summary(latencies, errors, duration)
+    report["total"] = summary(sorted(total), total_errors, duration)
+    report["memory"] = [
+        {"pid": pid, "rss_before_kb": memory_before[pid].get("rss"), "rss_after_kb": memory_after[pid].get("rss"),
+         "peak_kb": memory_after[pid].get("hwm")} for pid in memory_before
+    ]
+    return report
+
+
+def summary(ordered: list, errors: int, duration: float) -> dict:
+    result = {"requests": len(ordered), "errors": errors, "throughput": len(ordered) / duration}
+    for p in (50, 90, 99, 99.9):
+        result["p%s" % str(p).replace(".", "")] = percentile(ordered, p)
+    return result
+
+
+def print_report(report: dict):
+    print("%-16s %9s %7s %10s %9s %9s %9s %9s" % (
+        "kind", "requests", "errors", "req/s", "p50, ms", "p90, ms", "p99, ms", "p999, ms"
+    ))
+    for name, result in list(report["kinds"].items()) + [("total", report["total"])]:
+        print("%-16s %9d %7d %10.1f %9.2f %9.2f %9.2f %9.2f" % (
+            name, result["requests"], result["errors"], result["throughput"],
+            result["p50"] * 1e3, result["p90"] * 1e3, result["p99"] * 1e3, result["p999"] * 1e3
+        ))
+    for worker in report["memory"]:
+        print("worker %s: rss %s -> %s KB, peak %s KB" % (
+            worker["pid"], worker["rss_before_kb"], worker["rss_after_kb"], worker["peak_kb"]
+        ))
+
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="envi load test")
+    parser.add_argument("--app", help="приложение в формате module:attribute (по умолчанию - встроенное)")
+    parser.add_argument("--request", action="append", default=[],
+                        help="дополнительный тип AJAX GET-запроса в формате name=/path?query")
+    parser.add_argument("--mix", default="plain=1,ajax=4,pjax=1,jsonrpc=2,jsonrpc_batch=1,static=2,microservice=1",
+                        help="типы запросов с весами: name=weight,...")
+    parser.add_argument("--concurrency", type=int, default=8, help="количество клиентских потоков")
+    parser.add_argument("--duration", type=float, default=10.0, help="длительность замера, секунды")
+    parser.add_argument("--warmup", type=float, default=1.0, help="длительность прогрева, секунды")
+    parser.add_argument("--workers", type=int, default=1, help="количество процессов сервера")
+    parser.add_argument("--batch-size", type=int, default=10, help="размер пачки jsonrpc_batch")
+    parser.add_argument("--microservice-latency", type=float, default=0.005, help="задержка заглушки, секунды")
+    parser.add_argument("--output", help="сохранить отчет в JSON-файл")
+    args = parser.parse_args(argv)
+
+    # Заглушка работает в отдельном процессе, чтобы не конкурировать за GIL с клиентскими потоками
+    stub = StubMicroService(latency=args.microservice_latency)
+    stub_process = multiprocessing.get_context("fork").Process(target=stub.serve_forever, daemon=True)
+    stub_process.start()
+    os.environ["ENVI_STUB_MICROSERVICE"] = stub.url
+    static_root = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(static_root, "app.js"), "w") as f:
+            f.write("console.log('envi');\n" * 500)
+        app = load_application(args.app) if args.app else demo_application(static_root)
+        kinds = builtin_requests(args.batch_size)
+        for spec in args.request:
+            name, _, path = spec.partition("=")
+            kinds[name] = (lambda p: lambda i: ("GET", p, AJAX, None))(path)
+        mix = parse_mix(args.mix)
+        unknown = set(mix) - set(kinds)
+        if unknown:
+            parser.error("unknown request kinds: %s" % ", ".join(sorted(unknown)))
+        report = run(app, kinds, mix, args.concurrency, args.duration, args.warmup, args.workers)
+    finally:
+        stub_process.terminate()
+        stub_process.join()
+        stub.server_close()
+        shutil.rmtree(static_root, ignore_errors=True)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 1 if report["total"]["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+""" Стоимость построения Request в обертке Application.route: прежнее (жадное) построение против ленивого
+
+Запуск: python benchmarks/request.py
+"""
+import os
+import sys
+import timeit
+import tracemalloc
+from io import BytesIO
+from urllib.parse import urlencode
+
+import bottle
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from envi import Request, json_codec, json_loads_handler
+
+
+BODY = urlencode({"field%d" % i: "значение %d" % i for i in range(20)}).encode()
+
+
+def environ():
+    body = BODY
+    env = {
+        "REQUEST_METHOD": "POST", "PATH_INFO": "/users/save", "QUERY_STRING": "page=1&sort=name&filter=active",
+        "CONTENT_TYPE": "application/x-www-form-urlencoded", "CONTENT_LENGTH": str(len(body)),
+        "HTTP_COOKIE": "session=abcdef0123456789; lang=ru; theme=dark", "HTTP_X_REQUESTED_WITH": "XMLHttpRequest",
+        "HTTP_USER_AGENT": "Mozilla/5.0", "REMOTE_ADDR": "127.0.0.1", "SERVER_PORT": "80",
+        "wsgi.input": BytesIO(body), "wsgi.url_scheme": "http",
+    }
+    env.update({"HTTP_X_HEADER_%d" % i: "value" for i in range(20)})
+    return env
+
+
+def eager(kwargs):
+    """ Построение запроса так, как это делала обертка Application.route до ленивых источников """
+    get_decoded = dict(bottle.request.GET.decode())
+    try:
+        post_decoded = bottle.request.json or dict(bottle.request.POST.decode())
+    except Exception:
+        post_decoded = dict(bottle.request.POST.decode())
+    try:
+        post_json = json_codec.loads(post_decoded.get("json", get_decoded.get("json", "{}")),
+                                     object_hook=json_loads_handler)
+    except Exception:
+        post_json = {}
+    request = Request({})
+    request.environ = dict(bottle.request.environ)
+    for data in (dict(bottle.request.cookies), kwargs, get_decoded, post_decoded,
+                 {'json': post_json} if isinstance(post_json, list) else post_json):
+        request.update(data)
+    return request
+
+
+def lazy(kwargs):
+    return Request.from_bottle(kwargs, json_loads_handler)
+
+
+def scenario(build):
+    """ Типичное действие: определение типа запроса и чтение трех параметров """
+    bottle.request.bind(environ())
+    request = build({"action": "save"})
+    request.type()
+    request.get("action")
+    request.get("field1")
+    request.get("page", cast_type=int)
+
+
+def allocations(build, number=1000):
+    tracemalloc.start()
+    snapshot = tracemalloc.take_snapshot()
+    for _ in range(number):
+        scenario(build)
+    allocated = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(snapshot, "filename")
+                    if stat.size_diff > 0)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return allocated, peak
+
+
+def main():
+    baseline = min(timeit.repeat(lambda: bottle.request.bind(environ()), number=2000, repeat=5)) / 2000
+    print("%-8s %14s %16s" % ("variant", "latency, us", "peak traced, KB"))
+    for name, build in (("eager", eager), ("lazy", lazy)):
+        amount = min(timeit.repeat(lambda: scenario(build), number=2000, repeat=15)) / 2000 - baseline
+        print("%-8s %14.1f %16.1f" % (name, amount * 1e6, allocations(build)[1] / 1024))
+
+
+if __name__ == "__main__":
+    main()
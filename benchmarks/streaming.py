@@ -0,0 +1,60 @@
+""" Пиковая память при приеме большого JSON-массива: разбор тела целиком против потокового чтения
+
+Запуск: python benchmarks/streaming.py
+"""
+import json
+import os
+import sys
+import tracemalloc
+from io import BytesIO
+
+import bottle
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from envi import RequestStream
+
+
+def body(items):
+    return json.dumps([{"id": i, "name": "item %d" % i, "tags": ["a", "b"]} for i in range(items)]).encode()
+
+
+def environ(data):
+    return {"REQUEST_METHOD": "POST", "CONTENT_TYPE": "application/json", "CONTENT_LENGTH": str(len(data)),
+            "wsgi.input": BytesIO(data)}
+
+
+def buffered(data):
+    bottle.request.bind(environ(data))
+    return sum(1 for _ in bottle.request.json)
+
+
+def streaming(data):
+    return sum(1 for _ in RequestStream(environ(data)).json_array())
+
+
+def peak(fn, data):
+    tracemalloc.start()
+    count = fn(data)
+    amount = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return count, amount
+
+
+def main():
+    print("%-10s %10s %12s %16s" % ("variant", "items", "body, MB", "peak traced, MB"))
+    for items in (10000, 100000, 300000):
+        data = body(items)
+        for name, fn in (("buffered", buffered), ("streaming", streaming)):
+            try:
+                count, amount = peak(fn, data)
+            except bottle.HTTPError as err:
+                tracemalloc.stop()
+                print("%-10s %10d %12.1f %16s" % (name, items, len(data) / 2 ** 20, err.status_code))
+                continue
+            assert count == items
+            print("%-10s %10d %12.1f %16.2f" % (name, items, len(data) / 2 ** 20, amount / 2 ** 20))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+""" Локальный микросервис-заглушка для нагрузочного тестирования контроллеров, вызывающих microservice()
+
+Отвечает на POST-запросы с JSON-телом в формате микросервисов envi: {"result": <полученные данные>}.
+Задержка ответа задается параметром --latency (секунды) или ключом "sleep" в данных запроса;
+данные с ключом "fail" превращаются в ответ с ошибкой
+
+Запуск: python benchmarks/stub_microservice.py --port 8001 --latency 0.005
+"""
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class StubMicroServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Заголовки и тело отправляются отдельно: без этого ответы задерживаются на время отложенного ACK
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        data = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode() or "{}")
+        latency = data.get("sleep", self.server.latency) if isinstance(data, dict) else self.server.latency
+        if latency:
+            time.sleep(latency)
+        if isinstance(data, dict) and data.get("fail"):
+            body = json.dumps({"error": {"code": 1, "message": "fail"}}).encode()
+        else:
+            body = json.dumps({"result": data}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubMicroService(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, host: str="127.0.0.1", port: int=0, latency: float=0.0):
+        """
+        :param port: порт, 0 - любой свободный (см. url)
+        :param latency: задержка ответа по умолчанию, секунды
+        """
+        super().__init__((host, port), StubMicroServiceHandler)
+        self.latency = latency
+
+    @property
+    def url(self) -> str:
+        return "http://%s:%s/" % self.server_address[:2]
+
+    def start(self):
+        """ Запускает обработку запросов в фоновом потоке """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="stub microservice")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, секунды")
+    args = parser.parse_args()
+    server = StubMicroService(args.host, args.port, args.latency)
+    print("stub microservice at %s" % server.url, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+""" Набор микробенчмарков горячих путей envi с сохранением результатов в JSON и сравнением с базовой линией
+
+Запуск:
+    python benchmarks/suite.py                                  # таблица результатов
+    python benchmarks/suite.py --output base.json               # сохранить результаты
+    python benchmarks/suite.py --baseline base.json --threshold 0.1
+                                                                # код возврата 1, если какой-либо бенчмарк
+                                                                # замедлился более чем на 10%
+    python benchmarks/suite.py --filter jsonrpc --quick         # часть бенчмарков, меньше повторов
+
+В отчете и при сравнении используется минимальное из повторений время одного вызова: оно меньше всего
+зависит от фоновой нагрузки машины. Сравнивать имеет смысл результаты, полученные на одной машине
+с одним и тем же JSON-бекендом (он сохраняется в результатах)
+"""
+import os
+import sys
+import json
+import timeit
+import argparse
+import platform
+import statistics
+from io import BytesIO
+from datetime import datetime
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from envi import Application, Controller, ProxyController, Request, template, json_codec, json_dumps_handler, \
+    json_loads_handler
+
+
+""" Зарегистрированные бенчмарки: (имя, количество вызовов в одном повторении, фабрика тестируемой функции) """
+BENCHMARKS = []
+
+
+def benchmark(name, number):
+    """ Регистрирует фабрику бенчмарка: фабрика выполняет подготовку и возвращает функцию без аргументов """
+    def decorator(factory):
+        BENCHMARKS.append((name, number, factory))
+        return factory
+    return decorator
+
+
+class BenchmarkController(Controller):
+    @staticmethod
+    def echo(request, **kwargs):
+        return {"id": request.get("id", cast_type=int), "name": request.get("name")}
+
+    @staticmethod
+    def add(request, **kwargs):
+        return sum(request.get("params"))
+
+    @staticmethod
+    @template("error", if_exc=ValueError)
+    @template("empty", if_true=lambda data: not data)
+    @template("default")
+    def page(request, **kwargs):
+        return {"id": request.get("id", cast_type=int)}
+
+
+class InnerProxyController(ProxyController):
+    @staticmethod
+    def factory_method(app, request, user, host):
+        return BenchmarkController
+
+
+class OuterProxyController(ProxyController):
+    @staticmethod
+    def factory_method(app, request, user, host):
+        return InnerProxyController
+
+
+class CachedInnerProxyController(InnerProxyController):
+    depends_on = ()
+
+
+class CachedOuterProxyController(ProxyController):
+    depends_on = ()
+
+    @staticmethod
+    def factory_method(app, request, user, host):
+        return CachedInnerProxyController
+
+
+def application():
+    app = Application()
+    app.route("/direct/<action>/", BenchmarkController)
+    app.route("/proxy/<action>/", OuterProxyController)
+    app.route("/cached-proxy/<action>/", CachedOuterProxyController)
+    app.route("/rpc/", BenchmarkController)
+    return app
+
+
+def wsgi_call(app, path, query="", body=b"", ajax=True):
+    """ Функция, выполняющая полный WSGI-вызов приложения (включая чтение тела ответа) """
+    def start_response(status, headers, exc_info=None):
+        pass
+
+    def call():
+        environ = {
+            "REQUEST_METHOD": "POST" if body else "GET", "PATH_INFO": path, "QUERY_STRING": query,
+            "SERVER_NAME": "localhost", "SERVER_PORT": "80", "REMOTE_ADDR": "127.0.0.1",
+            "HTTP_USER_AGENT": "benchmark", "wsgi.input": BytesIO(body), "wsgi.url_scheme": "http",
+        }
+        if ajax:
+            environ["HTTP_X_REQUESTED_WITH"] = "XMLHttpRequest"
+        if body:
+            environ["CONTENT_TYPE"] = "application/x-www-form-urlencoded"
+            environ["CONTENT_LENGTH"] = str(len(body))
+        return b"".join(app(environ, start_response))
+    return call
+
+
+@benchmark("route.wsgi.ajax", 2000)
+def route_wsgi_ajax():
+    return wsgi_call(application(), "/direct/echo", "id=1&name=test")
+
+
+@benchmark("route.wsgi.static", 2000)
+def route_wsgi_static():
+    return wsgi_call(application(), "/direct/page", "id=1", ajax=False)
+
+
+@benchmark("request.get", 100000)
+def request_get():
+    request = Request({"id": "1", "name": "test"})
+    return lambda: request.get("name")
+
+
+@benchmark("request.get.cast_type", 100000)
+def request_get_cast_type():
+    request = Request({"id": "1", "name": "test"})
+    return lambda: request.get("id", cast_type=int)
+
+
+def jsonrpc_batch(size):
+    calls = [{"jsonrpc": "2.0", "method": "add", "params": [i, 1], "id": i + 1} for i in range(size)]
+    return wsgi_call(application(), "/rpc", body=urlencode({"q": json.dumps(calls)}).encode())
+
+
+@benchmark("jsonrpc.batch.1", 2000)
+def jsonrpc_batch_1():
+    return jsonrpc_batch(1)
+
+
+@benchmark("jsonrpc.batch.100", 100)
+def jsonrpc_batch_100():
+    return jsonrpc_batch(100)
+
+
+@benchmark("jsonrpc.batch.10000", 2)
+def jsonrpc_batch_10000():
+    return jsonrpc_batch(10000)
+
+
+@benchmark("template.stacked", 100000)
+def template_stacked():
+    request = Request({"id": "1"})
+    return lambda: BenchmarkController.page(request=request)
+
+
+def large_payload():
+    row = {"id": 1, "name": "Иван Петров", "email": "ivan@example.com", "active": True, "score": 12.5,
+           "tags": ["a", "b", "c"], "created": datetime(2016, 1, 2, 3, 4, 5), "parent": None}
+    return [dict(row, id=i) for i in range(10000)]
+
+
+@benchmark("json.dumps.large", 10)
+def json_dumps_large():
+    payload = large_payload()
+    return lambda: json_codec.dumps(payload, default=json_dumps_handler)
+
+
+@benchmark("json.loads.large", 10)
+def json_loads_large():
+    encoded = json_codec.dumps(large_payload())
+    return lambda: json_codec.loads(encoded, object_hook=json_loads_handler)
+
+
+@benchmark("proxy.chain", 2000)
+def proxy_chain():
+    return wsgi_call(application(), "/proxy/echo", "id=1&name=test")
+
+
+@benchmark("proxy.chain.cached", 2000)
+def proxy_chain_cached():
+    return wsgi_call(application(), "/cached-proxy/echo", "id=1&name=test")
+
+
+def run(names=None, repeat=5, quick=False) -> dict:
+    """ Выполняет бенчмарки и возвращает результаты (время одного вызова в секундах) """
+    results = {}
+    for name, number, factory in BENCHMARKS:
+        if names and not any(part in name for part in names):
+            continue
+        number = max(1, number // 10) if quick else number
+        fn = factory()
+        fn()
+        timings = [amount / number for amount in timeit.repeat(fn, number=number, repeat=repeat)]
+        results[name] = {
+            "min": min(timings), "median": statistics.median(timings), "number": number, "repeat": repeat
+        }
+    return {
+        "python": platform.python_version(), "implementation": platform.python_implementation(),
+        "machine": platform.machine(), "json_backend": json_codec.backend,
+        "created": datetime.now().isoformat(timespec="seconds"), "benchmarks": results,
+    }
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> list:
+    """ Сравнивает результаты; возвращает имена бенчмарков, замедлившихся более чем на threshold (доля) """
+    regressions = []
+    print("%-24s %14s %14s %9s" % ("benchmark", "baseline, us", "current, us", "change"))
+    for name, result in current["benchmarks"].items():
+        base = baseline["benchmarks"].get(name)
+        if base is None:
+            print("%-24s %14s %14.2f %9s" % (name, "-", result["min"] * 1e6, "new"))
+            continue
+        change = result["min"] / base["min"] - 1
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print("%-24s %14.2f %14.2f %+8.1f%%%s" % (
+            name, base["min"] * 1e6, result["min"] * 1e6, change * 100, "  REGRESSION" if regressed else ""
+        ))
+    if baseline.get("json_backend") != current.get("json_backend"):
+        print("warning: json backends differ (%s -> %s)" % (baseline.get("json_backend"), current.get("json_backend")))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="envi microbenchmarks")
+    parser.add_argument("--output", help="сохранить результаты в JSON-файл")
+    parser.add_argument("--baseline", help="сравнить с результатами из JSON-файла")
+    parser.add_argument("--current", help="не выполнять бенчмарки, а взять текущие результаты из JSON-файла")
+    parser.add_argument("--threshold", type=float, default=0.1, help="допустимое замедление (доля), по умолчанию 0.1")
+    parser.add_argument("--filter", action="append", help="выполнять только бенчмарки, содержащие подстроку")
+    parser.add_argument("--repeat", type=int, default=5, help="количество повторений")
+    parser.add_argument("--quick", action="store_true", help="в 10 раз меньше вызовов в повторении")
+    args = parser.parse_args(argv)
+
+    if args.current:
+        with open(args.current) as f:
+            current = json.load(f)
+    else:
+        current = run(args.filter, args.repeat, args.quick)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+
+    if not args.baseline:
+        print("%-24s %14s %14s" % ("benchmark", "min, us", "median, us"))
+        for name, result in current["benchmarks"].items():
+            print("%-24s %14.2f %14.2f" % (name, result["min"] * 1e6, result["median"] * 1e6))
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(baseline, current, args.threshold)
+    if regressions:
+        print("%s regressed by more than %.0f%%" % (", ".join(regressions), args.threshold * 100))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,6 +3,16 @@ __version__ = '0.2'
 from envi.classes import Application, SuitApplication, Controller, ProxyController, \
     WebSocketController, WebSocketControllerNb, \
     RequestPipe, JsonRpcRequestPipe,\
-    Request, Response,\
+    Request, RequestStream, Response, StreamingResponse, StaticFiles, AssetManifest, \
+    ResponseCompressor,\
     template, ControllerMethodResponseWithTemplate, \
-    microservice, json_dumps_handler, json_loads_handler, response_format, BaseServiceException
+    microservice, microservice_many, microservice_async, MicroServiceClient, MicroServiceCache, LRUCache, \
+    SingleFlight, JsonCodec, BinaryCodec, json_codec, \
+    json_dumps_handler, json_loads_handler, datetime_hook, response_format, \
+    BaseServiceException
+from envi.metrics import Metrics
+from envi.profiling import SamplingProfiler
+from envi.websocket import WebSocketTransport, UwsgiWebSocketTransport, AsgiWebSocketTransport, WebSocketClosed, \
+    Frame
+from envi.broadcast import BroadcastHub
+from envi.asgi import AsgiApplication
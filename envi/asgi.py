@@ -0,0 +1,312 @@
+import sys
+import asyncio
+from io import BytesIO
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import bottle
+from envi.classes import Application, Controller, Request, RequestPipe, JsonRpcRequestPipe, RequestContext, \
+    AsyncMicroServiceClient, Profiler, WebSocketController, json_codec, datetime_hook
+from envi.websocket import AsgiWebSocketTransport
+
+
+class RequestAborted(BaseException):
+    """ Синхронный код запроса вызвал SystemExit: запрос завершается без ответа """
+    pass
+
+
+class AsgiApplication(Application):
+    """ Приложение для ASGI-серверов (uvicorn, hypercorn, daphne)
+
+    Все запросы процесса обслуживает один цикл событий: асинхронные действия контроллеров (async def), setup,
+    apply_to_each_response и user_initialization_hook выполняются в нем, поэтому запрос, ожидающий ответа
+    микросервиса (microservice_async), не занимает поток. Синхронные контроллеры и хуки работают как прежде -
+    в пуле потоков из sync_workers потоков, с привязанными bottle.request и bottle.response (см. run_sync).
+    Вызовы пачки JSON-RPC выполняются одновременно. WebSocket-соединения с контроллерами WebSocketController
+    обслуживаются в цикле событий (см. WebSocketController.serve_async).
+
+    Роутинг, конвертеры ответов, сжатие, метрики и Server-Timing - как у Application. Тело запроса читается
+    целиком до начала обработки (в том числе для streaming-роутов), но только после роутинга и только для
+    контроллеров; тело больше max_body_size отклоняется с кодом 413. Выборочное профилирование
+    (sampling_profiler) синхронных контроллеров - в потоке пула; асинхронные действия и пачки JSON-RPC
+    профилируются в потоке цикла событий, поэтому в их результаты попадают и одновременно выполняемые корутины.
+    SystemExit, как и в Application, завершает запрос без ответа
+    """
+
+    """ Наибольший размер тела запроса, байт (None - без ограничения) """
+    max_body_size = 10 * 1024 * 1024
+
+    """ Количество потоков для синхронного кода """
+    sync_workers = 32
+
+    """ Размер порции при отправке файлов и потоковых ответов, байт """
+    chunk_size = 64 * 1024
+
+    def __init__(self):
+        super().__init__()
+        self.executor = ThreadPoolExecutor(max_workers=self.sync_workers, thread_name_prefix="envi-sync")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            await self.http(scope, receive, send)
+        elif scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "websocket":
+            await self.websocket(scope, receive, send)
+
+    async def startup(self):
+        """ Вызывается при запуске сервера (ASGI lifespan) """
+        pass
+
+    async def shutdown(self):
+        """ Вызывается при остановке сервера (ASGI lifespan); закрывает соединения с микросервисами """
+        await AsyncMicroServiceClient.close()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self.startup()
+                except Exception as err:
+                    await send({"type": "lifespan.startup.failed", "message": str(err)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def run_sync(self, request, fn, /, *args, **kwargs):
+        """
+        Выполняет синхронную функцию в пуле потоков в контексте запроса: bottle.request и bottle.response
+        в ней относятся к этому запросу, заголовки, cookies и код ответа попадают в request.response
+        """
+        context = RequestContext(request.environ, request.response)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, partial(context.run, fn, *args, **kwargs)
+            )
+        except SystemExit as err:
+            # SystemExit, вышедший из задачи asyncio (например, вызова пачки JSON-RPC), останавливает цикл событий
+            raise RequestAborted() from err
+        finally:
+            context.merge()
+
+    # noinspection PyMethodOverriding
+    def route(self, path, controller, action=None, revive_datetimes=None, streaming=False, compress=True):
+        """
+        Роутинг запросов на контроллер (параметры - как у Application.route)
+        """
+        controller.actions()
+        object_hook = datetime_hook(controller.revive_datetimes if revive_datetimes is None else revive_datetimes)
+        if path != '/':
+            path = path.rstrip("/")
+        handler = partial(self.handle, path, controller, action, object_hook, streaming, compress)
+        for method in ("GET", "POST"):
+            self.router.add(path, method, handler)
+        if issubclass(controller, WebSocketController):
+            # WebSocket-соединения ищутся в роутере под отдельным методом (см. websocket)
+            self.router.add(path, "WEBSOCKET", partial(self.handle_websocket, controller, object_hook))
+
+    def route_static(self, route_path, root, manifest=None, **options):
+        """
+        Роутинг статики (параметры - как у Application.route_static); файлы читаются в пуле потоков
+        """
+        static_files = self._static_files(route_path, root, manifest, options)
+
+        async def handler(environ, kwargs, response):
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, static_files.serve, kwargs["filename"], environ
+            )
+
+        # Тело запроса к статике не читается
+        handler.reads_body = False
+
+        for method in ("GET", "HEAD"):
+            self.router.add("/{path}/<filename:path>".format(path=route_path.strip("/")), method, handler)
+        return static_files
+
+    async def http(self, scope, receive, send):
+        environ = self.environ(scope, b"")
+        response = bottle.BaseResponse()
+        try:
+            target, kwargs = self.router.match(environ)
+            if getattr(target, "reads_body", True):
+                body = await self.read_body(scope, receive)
+                if body is None:
+                    return
+                self.set_body(environ, body)
+            result = await target(environ, kwargs, response)
+        except bottle.HTTPResponse as err:
+            result = err
+        except (SystemExit, RequestAborted):
+            # Как в Application.__call__: уходим молча, заголовки не отправляем
+            return
+        await self.send_response(send, environ, response, result)
+
+    async def read_body(self, scope, receive):
+        """ Читает тело запроса; None - клиент отключился. Тело больше max_body_size - HTTPError 413 """
+        limit = self.max_body_size
+        declared = next((value for name, value in scope.get("headers", ()) if name.lower() == b"content-length"), b"")
+        if limit is not None and declared.isdigit() and int(declared) > limit:
+            raise bottle.HTTPError(413, "Request body is too large")
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return None
+            body += message.get("body", b"")
+            if limit is not None and len(body) > limit:
+                raise bottle.HTTPError(413, "Request body is too large")
+            if not message.get("more_body"):
+                return bytes(body)
+
+    @staticmethod
+    def set_body(environ: dict, body: bytes):
+        """ Подставляет прочитанное тело запроса в environ """
+        environ["wsgi.input"] = BytesIO(body)
+        if body:
+            environ["CONTENT_LENGTH"] = str(len(body))
+
+    async def websocket(self, scope, receive, send):
+        transport = AsgiWebSocketTransport(receive, send)
+        environ = self.environ(dict(scope, method="GET"), b"")
+        try:
+            target, kwargs = self.router.match(dict(environ, REQUEST_METHOD="WEBSOCKET"))
+        except bottle.HTTPError:
+            await transport.reject()
+            return
+        await target(environ, kwargs, transport)
+
+    async def handle_websocket(self, controller, object_hook, environ, kwargs, transport):
+        """ Обслуживание WebSocket-соединения контроллером """
+        request = Request.from_environ(environ, kwargs, object_hook)
+        request.response = bottle.BaseResponse()
+        try:
+            user = await Controller._call_async(
+                self, request, self.user_initialization_hook, Application.user_initialization_hook, request=request
+            )
+        except Exception as err:
+            self.log(err)
+            await transport.reject()
+            return
+        await controller.instance().serve_async(self, request, user, self._host(environ), transport)
+
+    @staticmethod
+    def environ(scope, body: bytes) -> dict:
+        """ WSGI environ запроса по ASGI scope """
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", ""),
+            # Как в Application.__call__: завершающий слеш не учитывается
+            "PATH_INFO": scope["path"].rstrip("/"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": server[0], "SERVER_PORT": str(server[1]),
+            "REMOTE_ADDR": client[0], "REMOTE_PORT": str(client[1]),
+            "SERVER_PROTOCOL": "HTTP/%s" % scope.get("http_version", "1.1"),
+            "wsgi.version": (1, 0), "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True, "wsgi.multiprocess": True, "wsgi.run_once": False,
+            "asgi.scope": scope,
+        }
+        AsgiApplication.set_body(environ, body)
+        for name, value in scope.get("headers", ()):
+            name, value = name.decode("latin-1").upper().replace("-", "_"), value.decode("latin-1")
+            if name == "CONTENT_TYPE":
+                environ["CONTENT_TYPE"] = value
+            elif name != "CONTENT_LENGTH":
+                key = "HTTP_" + name
+                environ[key] = "%s,%s" % (environ[key], value) if key in environ else value
+        return environ
+
+    async def handle(self, path, controller, action, object_hook, streaming, compress, environ, kwargs, response):
+        """ Обработка запроса к контроллеру. Возвращает тело ответа """
+        if self.metrics is None:
+            return await self._handle(path, controller, action, object_hook, streaming, compress,
+                                      environ, kwargs, response, None)
+        with self.metrics.track(path) as tracker:
+            return await self._handle(path, controller, action, object_hook, streaming, compress,
+                                      environ, kwargs, response, tracker)
+
+    async def _handle(self, path, controller, action, object_hook, streaming, compress, environ, kwargs, response,
+                      tracker):
+        request = Request.from_environ(environ, kwargs, object_hook, streaming)
+        request.response = response
+        request.profiler = Profiler(self.phase_timing or self.server_timing)
+        with request.profiler as p:
+            error = self._decode(request, controller, action, tracker)
+            if error is not None:
+                return error
+
+            try:
+                with p.phase("user"):
+                    user = await Controller._call_async(
+                        self, request, self.user_initialization_hook, Application.user_initialization_hook,
+                        request=request
+                    )
+            except Exception as err:
+                return self._failure(err, tracker)
+            host = self._host(environ)
+            instance = controller.instance()
+            if request.type() == Request.Types.JSON_RPC or controller.asynchronous():
+                pipe = JsonRpcRequestPipe(self.json_rpc_executor) \
+                    if request.type() == Request.Types.JSON_RPC else RequestPipe()
+                with self._sample(path, controller, request):
+                    result = await pipe.process_async(instance, self, request, user, host)
+            else:
+                result = await self.run_sync(request, self._process, path, controller, instance, request, user, host)
+            if tracker is not None:
+                tracker.error = request.exception
+            body = self._response_body(request, result, compress, response)
+        self._finish(user, request, result, body, response)
+        return body
+
+    def _process(self, path, controller, instance, request, user, host):
+        """ Обработка запроса синхронным контроллером в потоке пула (профилируется этот поток) """
+        with self._sample(path, controller, request):
+            return RequestPipe().process(instance, self, request, user, host)
+
+    async def send_response(self, send, environ, response: bottle.BaseResponse, body):
+        """ Отправляет ответ; файлы и итераторы (потоковые ответы) читаются в пуле потоков """
+        if isinstance(body, bottle.HTTPResponse):
+            body.apply(response)
+            body = response.body
+        if isinstance(body, dict):
+            # Как JSONPlugin bottle для словарей, возвращенных обработчиком
+            response.content_type = "application/json"
+            body = json_codec.dumps(body)
+        if isinstance(body, str):
+            body = body.encode(response.charset or "utf-8")
+        if body is None:
+            body = b""
+        if isinstance(body, (bytes, bytearray)) and "Content-Length" not in response:
+            response["Content-Length"] = str(len(body))
+
+        await send({
+            "type": "http.response.start", "status": response.status_code,
+            "headers": [(name.encode("latin-1"), value.encode("latin-1")) for name, value in response.headerlist],
+        })
+        if environ["REQUEST_METHOD"] == "HEAD":
+            body = b""
+        if isinstance(body, (bytes, bytearray)):
+            await send({"type": "http.response.body", "body": bytes(body)})
+            return
+
+        loop = asyncio.get_running_loop()
+        chunks = iter(partial(body.read, self.chunk_size), b"") if hasattr(body, "read") else iter(body)
+        # Порции потокового ответа получаются в контексте запроса, как в синхронном приложении
+        read = partial(RequestContext(environ, response).run, next, chunks, None)
+        try:
+            while True:
+                chunk = await loop.run_in_executor(self.executor, read)
+                if chunk is None:
+                    break
+                if chunk:
+                    chunk = chunk.encode(response.charset or "utf-8") if isinstance(chunk, str) else bytes(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+        await send({"type": "http.response.body", "body": b""})
@@ -0,0 +1,136 @@
+import threading
+from envi.classes import json_codec
+from envi.websocket import Frame
+
+
+class BroadcastHub(object):
+    """ Рассылка сообщений по темам WebSocket-соединениям процесса
+
+    Соединения (экземпляры WebSocketController) подписываются на темы, обычно в open():
+
+        hub = BroadcastHub(queue_size=100)
+
+        class NotificationsController(WebSocketControllerNb):
+            def open(self, app, request, user, host):
+                hub.subscribe(self, "user:%s" % user["id"], "news")
+
+        hub.publish("news", {"title": "..."})
+
+    Опубликованное сообщение сериализуется один раз и добавляется в исходящие очереди подписчиков; отправляют
+    его обработчики соединений. Очередь соединения ограничена queue_size сообщениями; если клиент не успевает
+    их получать, применяется policy: DROP_OLDEST - удаляется самое старое сообщение очереди, DISCONNECT -
+    соединение закрывается. При закрытии соединение отписывается от всех тем автоматически.
+    Сообщения сразу отправляют WebSocketControllerNb и контроллеры AsgiApplication; publish можно вызывать
+    из любого потока. Хаб работает в пределах процесса: каждый воркер рассылает сообщения своим соединениям
+    """
+
+    DROP_OLDEST = "drop_oldest"
+    DISCONNECT = "disconnect"
+
+    def __init__(self, queue_size: int=1000, policy: str=DROP_OLDEST, serializer=None):
+        """
+        :param queue_size: наибольшее количество неотправленных сообщений в очереди соединения
+        :param policy: что делать при переполнении очереди: DROP_OLDEST или DISCONNECT
+        :param serializer: сериализатор сообщений, по умолчанию - json_codec.dumps
+        """
+        if policy not in (self.DROP_OLDEST, self.DISCONNECT):
+            raise ValueError("Unknown backpressure policy: %s" % policy)
+        self.queue_size = queue_size
+        self.policy = policy
+        self.serializer = serializer or json_codec.dumps
+        self._lock = threading.Lock()
+        """ Тема -> {соединение: None} (словарь - упорядоченное множество) """
+        self._topics = {}
+        """ Тема -> кортеж подписчиков для рассылки (строится заново после изменения подписок) """
+        self._snapshots = {}
+        """ Соединение -> множество тем """
+        self._connections = {}
+        self._published = self._delivered = self._dropped = self._disconnected = 0
+
+    def subscribe(self, connection, *topics):
+        """ Подписывает соединение на темы """
+        with self._lock:
+            for topic in topics:
+                self._topics.setdefault(topic, {})[connection] = None
+                self._snapshots.pop(topic, None)
+            self._connections.setdefault(connection, set()).update(topics)
+            connection.hubs = connection.hubs | {self}
+
+    def unsubscribe(self, connection, *topics):
+        """ Отписывает соединение от тем (без тем - от всех) """
+        with self._lock:
+            subscribed = self._connections.get(connection, set())
+            for topic in topics or tuple(subscribed):
+                subscribers = self._topics.get(topic, {})
+                if connection in subscribers:
+                    del subscribers[connection]
+                    self._snapshots.pop(topic, None)
+                    if not subscribers:
+                        del self._topics[topic]
+                subscribed.discard(topic)
+            if not subscribed:
+                self._connections.pop(connection, None)
+                connection.hubs = connection.hubs - {self}
+
+    def publish(self, topic, message) -> int:
+        """
+        Рассылает сообщение подписчикам темы
+        :param message: сообщение (сериализуется serializer) или envi.websocket.Frame с готовыми данными
+        :return: количество соединений, в очереди которых добавлено сообщение
+        """
+        frame = message if isinstance(message, Frame) else Frame(self.serializer(message), message)
+        subscribers = self._snapshots.get(topic)
+        if subscribers is None:
+            with self._lock:
+                subscribers = tuple(self._topics.get(topic, ()))
+                if subscribers:
+                    self._snapshots[topic] = subscribers
+        limit, drop_oldest = self.queue_size, self.policy == self.DROP_OLDEST
+        delivered = dropped = 0
+        slow = []
+        for connection in subscribers:
+            transport = connection.transport
+            if transport is None or transport.closed:
+                continue
+            if transport.offer(frame, limit):
+                delivered += 1
+            elif drop_oldest:
+                transport.discard()
+                transport.push(frame)
+                delivered += 1
+                dropped += 1
+            else:
+                slow.append(connection)
+        for connection in slow:
+            self.unsubscribe(connection)
+            connection.transport.abort()
+        with self._lock:
+            self._published += 1
+            self._delivered += delivered
+            self._dropped += dropped
+            self._disconnected += len(slow)
+        return delivered
+
+    def subscribers(self, topic) -> int:
+        """ Количество подписчиков темы """
+        return len(self._topics.get(topic, ()))
+
+    def topics(self) -> list:
+        return list(self._topics)
+
+    def stats(self) -> dict:
+        """ Метрики хаба: подписки, рассылки, потерянные сообщения и отключенные медленные клиенты """
+        with self._lock:
+            connections = list(self._connections)
+            return {
+                "topics": len(self._topics),
+                "connections": len(connections),
+                "subscriptions": sum(len(subscribers) for subscribers in self._topics.values()),
+                "published": self._published,
+                "delivered": self._delivered,
+                "dropped": self._dropped,
+                "disconnected": self._disconnected,
+                "max_pending": max(
+                    (c.transport.pending() for c in connections if c.transport is not None), default=0
+                ),
+            }
@@ -1,18 +1,30 @@
 import os
 import re
 import json
+import zlib
+import codecs
+import hashlib
+import tempfile
+import mimetypes
+import email.utils
 import time as profiler_time
-from time import sleep
+import inspect
+import threading
 import traceback
 from io import BytesIO
 import bottle
 from abc import ABCMeta, abstractmethod
-from datetime import datetime, date, time
+from collections.abc import Iterator, Mapping
+from datetime import datetime, date, time, timezone
+from urllib.parse import unquote_to_bytes
+from envi.websocket import UwsgiWebSocketTransport, WebSocketClosed, Frame
 
 
 """ 16 Mb """
 bottle.BaseRequest.MEMFILE_MAX = 16 * 1024 * 1024
 
+_class_cache_lock = threading.Lock()
+
 
 class ControllerMethodResponseWithTemplate(object):
     """ Класс для оформления результатов работы декоратора template """
@@ -22,28 +34,217 @@ class ControllerMethodResponseWithTemplate(object):
         self.template = template_name
 
     def __str__(self):
-        return json.dumps(self.data, default=json_dumps_handler) if isinstance(self.data, (list, dict)) else str(
-            self.data)
+        return json_codec.dumps(self.data) if isinstance(self.data, (list, dict)) else str(self.data)
+
+
+class ProfilerPhase(object):
+    """ Замер одной фазы обработки запроса (см. Profiler.phase)
+    Время вложенных фаз не учитывается во времени внешней фазы
+    """
+    __slots__ = ("profiler", "name", "started", "nested", "parent")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.started = self.nested = 0.0
+        self.parent = None
+
+    def __enter__(self):
+        local = self.profiler.local
+        self.parent = getattr(local, "phase", None)
+        local.phase = self
+        self.started = profiler_time.perf_counter()
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        amount = profiler_time.perf_counter() - self.started
+        phases = self.profiler.phases
+        phases[self.name] = phases.get(self.name, 0.0) + amount - self.nested
+        if self.parent is not None:
+            self.parent.nested += amount
+        self.profiler.local.phase = self.parent
+
+
+class NoProfilerPhase(object):
+    """ Фаза, которая ничего не замеряет (замер фаз выключен) """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        pass
 
 
 class Profiler(object):
-    def __init__(self):
+    """ Замер времени обработки запроса с разбивкой по фазам
+    Фазы с одинаковым именем суммируются (например, вызовы пачки JSON-RPC), время фаз - в секундах
+    """
+    no_phase = NoProfilerPhase()
+
+    def __init__(self, phases: bool=False):
+        """
+        :param phases: замерять фазы (без этого phases остается пустым)
+        """
         self._startTime = 0
+        self.phases = {}
+        """ Текущая фаза каждого потока (вызовы пачки JSON-RPC могут выполняться параллельно) """
+        self.local = threading.local() if phases else None
+
+    def phase(self, name: str):
+        """ Контекстный менеджер замера фазы """
+        return ProfilerPhase(self, name) if self.local is not None else self.no_phase
+
+    def server_timing(self) -> str:
+        """ Значение заголовка Server-Timing: фазы и общее время в миллисекундах """
+        timings = ["%s;dur=%.3f" % (name, amount * 1000) for name, amount in self.phases.items()]
+        return ", ".join(timings + ["total;dur=%.3f" % (self.get_amount() * 1000)])
 
     def __enter__(self):
-        self._startTime = profiler_time.time()
+        self._startTime = profiler_time.perf_counter()
         return self
 
     def __exit__(self, etype, value, traceback):
         pass
 
     def get_amount(self):
-        return float(profiler_time.time() - self._startTime)
+        return float(profiler_time.perf_counter() - self._startTime)
+
+
+class ResponseCompressor(object):
+    """ Сжатие ответов с выбором кодировки по заголовку Accept-Encoding
+
+    brotli (br) и zstd используются, если установлены библиотеки brotli и zstandard
+    """
+
+    """ Поддерживаемые кодировки в порядке предпочтения сервера """
+    supported = ("br", "zstd", "gzip", "deflate")
+
+    """ Уровни сжатия по умолчанию: компромисс между степенью сжатия и нагрузкой на процессор """
+    default_levels = {"br": 4, "zstd": 3, "gzip": 6, "deflate": 6}
+
+    def __init__(self, min_size: int=1024, levels: dict=None, encodings=None):
+        """
+        :param min_size: минимальный размер ответа для сжатия, байт
+        :param levels: уровни сжатия по кодировкам, переопределяющие default_levels
+        :param encodings: используемые кодировки в порядке предпочтения (по умолчанию - все доступные из supported)
+        """
+        self.min_size = min_size
+        self.levels = dict(self.default_levels, **(levels or {}))
+        self.encodings = tuple(encoding for encoding in (encodings or self.supported) if self.available(encoding))
+        self._negotiated = {}
+
+    @staticmethod
+    def available(encoding: str) -> bool:
+        """ Проверяет, что для кодировки установлена библиотека сжатия """
+        module = {"br": "brotli", "zstd": "zstandard"}.get(encoding)
+        if module is None:
+            return encoding in ("gzip", "deflate")
+        try:
+            __import__(module)
+        except ImportError:
+            return False
+        return True
+
+    def negotiate(self, accept_encoding: str):
+        """ Выбирает кодировку по заголовку Accept-Encoding; None - клиент не принимает ни одну из encodings """
+        if not accept_encoding:
+            return None
+        if accept_encoding not in self._negotiated:
+            if len(self._negotiated) > 256:
+                self._negotiated.clear()
+            self._negotiated[accept_encoding] = self._negotiate(accept_encoding)
+        return self._negotiated[accept_encoding]
+
+    def _negotiate(self, accept_encoding):
+        qualities = {}
+        for item in accept_encoding.split(","):
+            coding, _, params = item.partition(";")
+            quality = 1.0
+            for param in params.split(";"):
+                name, _, value = param.partition("=")
+                if name.strip().lower() == "q":
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            qualities[coding.strip().lower()] = quality
+        best, best_quality = None, 0.0
+        for encoding in self.encodings:
+            quality = qualities.get(encoding, qualities.get("*", 0.0))
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def codec(self, encoding: str):
+        """ Возвращает функции (сжатие порции, сброс буфера, завершение потока) для кодировки """
+        level = self.levels[encoding]
+        if encoding in ("gzip", "deflate"):
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 31 if encoding == "gzip" else 15)
+            return compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+        if encoding == "br":
+            import brotli
+            compressor = brotli.Compressor(quality=level)
+            return compressor.process, compressor.flush, compressor.finish
+        if encoding == "zstd":
+            import zstandard
+            compressor = zstandard.ZstdCompressor(level=level).compressobj()
+            return (compressor.compress, lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+                    compressor.flush)
+        raise ValueError("unsupported content encoding '%s'" % encoding)
+
+    def compress(self, data: bytes, encoding: str) -> bytes:
+        """ Сжимает тело ответа целиком """
+        compress, _, finish = self.codec(encoding)
+        return compress(data) + finish()
+
+    def stream(self, chunks, encoding: str, report=None):
+        """
+        Сжимает порции потокового ответа, сбрасывая буфер компрессора после каждой порции
+        :param report: функция (исходный размер, сжатый размер), вызываемая после последней порции
+        """
+        compress, flush, finish = self.codec(encoding)
+        original = compressed = 0
+        for chunk in chunks:
+            data = compress(chunk) + flush()
+            original, compressed = original + len(chunk), compressed + len(data)
+            if data:
+                yield data
+        data = finish()
+        compressed += len(data)
+        yield data
+        if report is not None:
+            report(original, compressed)
 
 
 class Application(bottle.Bottle):
     ignored_exceptions = []
 
+    """ Пул (concurrent.futures.Executor) для параллельного выполнения пачек JSON-RPC запросов.
+    None - вызовы пачки выполняются последовательно """
+    json_rpc_executor = None
+
+    """ Манифест отпечатков статики (см. route_static и asset_url) """
+    asset_manifest = None
+
+    """ Сжатие ответов (ResponseCompressor), None - ответы не сжимаются. Включается приложением:
+    compressor = ResponseCompressor() """
+    compressor = None
+
+    """ Метрики обработки запросов (envi.metrics.Metrics), None - метрики не собираются """
+    metrics = None
+
+    """ Замерять время фаз обработки запроса (см. Profiler и performance_report) """
+    phase_timing = False
+
+    """ Добавлять в ответы заголовок Server-Timing с временем фаз обработки запроса (включает phase_timing) """
+    server_timing = False
+
+    """ Выборочное профилирование запросов (envi.profiling.SamplingProfiler), None - запросы не профилируются """
+    sampling_profiler = None
+
+    """ Двоичные форматы ответов (см. BinaryCodec) в порядке предпочтения сервера; пустой кортеж - только JSON """
+    binary_formats = ("msgpack", "cbor")
+
     def __init__(self):
         super().__init__(catchall=False)
 
@@ -55,6 +256,14 @@ class Application(bottle.Bottle):
 
     @classmethod
     def performance_report(cls, user, request, result, amount):
+        """ Вызывается после обработки запроса
+        :param amount: общее время обработки, секунды; разбивка по фазам - в request.profiler.phases
+        """
+        pass
+
+    @classmethod
+    def compression_report(cls, request, encoding, original_size, compressed_size):
+        """ Вызывается после сжатия ответа (для потоковых ответов - после отправки последней порции) """
         pass
 
     # noinspection PyMethodMayBeStatic
@@ -74,26 +283,80 @@ class Application(bottle.Bottle):
             return {"error": {"code": 0, "type": str(type(result)), "message": str(result)}}
         return result
 
+    def response_codec(self, request):
+        """ Выбирает формат ответа по заголовку Accept: BinaryCodec или None - JSON
+        Двоичный формат выбирается, только если клиент указал его явно и не предпочел ему application/json
+        """
+        accept = request.environ.get("HTTP_ACCEPT", "")
+        if not self.binary_formats or "application/" not in accept:
+            return None
+        ranks = {}
+        for item in accept.lower().split(","):
+            media_type, *params = item.split(";")
+            quality = 1.0
+            for param in params:
+                name, _, value = param.partition("=")
+                if name.strip() == "q":
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            ranks[media_type.strip()] = quality
+        best, best_quality = None, ranks.get("application/json", 0.0)
+        for name in self.binary_formats:
+            quality = ranks.get(BinaryCodec.content_types.get(name), 0.0)
+            if quality > best_quality:
+                codec = BinaryCodec.get(name)
+                if codec is not None:
+                    best, best_quality = codec, quality
+        return best
+
+    @staticmethod
+    def serialize(request, result, response: bottle.BaseResponse=None):
+        """ Кодирует результат (list или dict) в формат, выбранный для запроса (request.codec)
+        :param response: ответ, в который добавляются заголовки (по умолчанию - текущий ответ bottle)
+        """
+        if request.codec is None:
+            return json_codec.dumps(result)
+        response = bottle.response if response is None else response
+        response.content_type = request.codec.content_type
+        response.add_header("Vary", "Accept")
+        return request.codec.dumps(result)
+
     # noinspection PyMethodMayBeStatic
     def static_output_converter(self, result: ControllerMethodResponseWithTemplate) -> str:
         """ Функция для конвертации ответов при статических загрузках страницы
         Переопределить для подключения кастомной шаблонизации
         :param result: Ответ в формате ControllerMethodResponseWithTemplate
         """
-        return json.dumps(result.data, default=json_dumps_handler)
+        return json_codec.dumps(result.data)
 
     @staticmethod
-    def _host():
-        """ Предоставляет информацию о параметрах запроса """
+    def _host(environ: dict=None):
+        """ Предоставляет информацию о параметрах запроса (по умолчанию - текущего запроса bottle) """
+        environ = bottle.request.environ if environ is None else environ
         return {
-            "ip": bottle.request.environ.get("REMOTE_ADDR"),
-            "port": bottle.request.environ.get("SERVER_PORT"),
-            "user_agent": bottle.request.environ.get("HTTP_USER_AGENT"),
+            "ip": environ.get("REMOTE_ADDR"),
+            "port": environ.get("SERVER_PORT"),
+            "user_agent": environ.get("HTTP_USER_AGENT"),
         }
 
     # noinspection PyMethodOverriding
-    def route(self, path, controller, action=None):
+    def route(self, path, controller, action=None, revive_datetimes=None, streaming=False, compress=True):
+        """
+        Роутинг запросов на контроллер
+        :param path: путь (в формате bottle)
+        :param controller: класс контроллера
+        :param action: действие контроллера, если оно не передается в запросе
+        :param revive_datetimes: восстановление дат в параметре json (см. datetime_hook);
+                                 по умолчанию - Controller.revive_datetimes
+        :param streaming: тело запроса не разбирается в параметры, а читается действием через request.stream
+                          (параметры доступны только из cookies, роута и строки запроса)
+        :param compress: сжимать ответы (см. compressor)
+        """
         app = self
+        controller.actions()
+        object_hook = datetime_hook(controller.revive_datetimes if revive_datetimes is None else revive_datetimes)
         if os.environ.get("PRINT_INTRO", None):
             names = []
             cc = controller().__class__
@@ -103,75 +366,193 @@ class Application(bottle.Bottle):
             print("INTRO", cc.__name__, ",".join(sorted(names)), flush=True)
 
         def wrapper(*args, **kwargs):
-            try:
-                get_decoded = dict(bottle.request.GET.decode())
-                try:
-                    post_decoded = bottle.request.json or dict(bottle.request.POST.decode())
-                except Exception:
-                    post_decoded = dict(bottle.request.POST.decode())
-            except UnicodeDecodeError as err:
-                response = self.ajax_output_converter(Exception("Invalid HTTP request encoding. Must be 'ISO-8859-1'."))
-                self.log(err)
-                return response
-
-            try:
-                post_json = json.loads(post_decoded.get("json", get_decoded.get("json", "{}")),
-                                       object_hook=json_loads_handler)
-            except:
-                post_json = {}
+            if self.metrics is None:
+                return handle(kwargs)
+            with self.metrics.track(path) as tracker:
+                return handle(kwargs, tracker)
+
+        def handle(kwargs, tracker=None):
+            request = Request.from_bottle(kwargs, object_hook, streaming)
+            request.profiler = Profiler(self.phase_timing or self.server_timing)
+            with request.profiler as p:
+                error = self._decode(request, controller, action, tracker)
+                if error is not None:
+                    return error
 
-            request = Request(
-                dict(bottle.request.cookies),
-                kwargs, get_decoded, post_decoded,
-                {'json': post_json} if isinstance(post_json, list) else post_json,
-                environ=dict(bottle.request.environ))
-
-            if action:
-                request.set("action", action)
-
-            with Profiler() as p:
                 # noinspection PyNoneFunctionAssignment
                 try:
-                    user = self.user_initialization_hook(request)
+                    with p.phase("user"):
+                        user = self.user_initialization_hook(request)
                 except Exception as err:
-                    if not isinstance(err, bottle.HTTPResponse):
-                        self.log(err)
-                        response = self.ajax_output_converter(err)
-                        return response
-                    else:
-                        raise err
+                    return self._failure(err, tracker)
                 host = self._host()
-                pipe = JsonRpcRequestPipe() if request.type() == Request.Types.JSON_RPC else RequestPipe()
-                result = pipe.process(controller(), app, request, user, host)
-                self.performance_report(user, request, result, p.get_amount())
-                if isinstance(result, (bytes, bytearray)) or (type(result) is bottle.HTTPResponse):
-                    return result
-                return json.dumps(result, default=json_dumps_handler) if isinstance(result, (list, dict)) else str(
-                    result)
+                pipe = JsonRpcRequestPipe(self.json_rpc_executor) \
+                    if request.type() == Request.Types.JSON_RPC else RequestPipe()
+                with self._sample(path, controller, request):
+                    result = pipe.process(controller.instance(), app, request, user, host)
+                    if tracker is not None:
+                        tracker.error = request.exception
+                    body = self._response_body(request, result, compress, bottle.response)
+            self._finish(user, request, result, body, bottle.response)
+            return body
 
         if path != '/':
             path = path.rstrip("/")
 
         super().route(path, ["GET", "POST"], wrapper)
 
-    def route_static(self, route_path, root):
-        """
-        Роутинг статики
-        :param root: директория с статикой
+    def _decode(self, request, controller, action, tracker):
+        """ Разбирает запрос (фаза decode) и отмечает действие в метриках
+        Возвращает ответ с ошибкой, если запрос не удалось разобрать, иначе None
         """
+        try:
+            with request.profiler.phase("decode"):
+                request.type()
+                request.codec = self.response_codec(request)
+        except UnicodeDecodeError as err:
+            return self._failure(err, tracker, Exception("Invalid HTTP request encoding. Must be 'ISO-8859-1'."))
+        if action:
+            request.set("action", action)
+        if tracker is not None:
+            tracker.action = self._action_label(controller, request)
+        return None
 
-        class StaticController(Controller):
-            default_action = 'static'
-
-            def static(self, request, **kwargs):
-                filename = request.get("filename")
-                search = r'^(.*)\.(v[0-9]+)?\.(.*)$'
-                replace = r'\1.\3'
-                r = re.compile(search)
-                filename = r.sub(replace, filename)
-                return bottle.static_file(filename, root)
+    def _failure(self, err: Exception, tracker, shown: Exception=None):
+        """ Ответ с ошибкой, возникшей до вызова контроллера (bottle.HTTPResponse пробрасывается)
+        :param shown: исключение, показываемое клиенту вместо err
+        """
+        if isinstance(err, bottle.HTTPResponse):
+            raise err
+        self.log(err)
+        if tracker is not None:
+            tracker.error = err
+        return self.ajax_output_converter(err if shown is None else shown)
+
+    def _sample(self, path, controller, request):
+        """ Контекстный менеджер выборочного профилирования запроса (см. sampling_profiler) """
+        if self.sampling_profiler is None:
+            return Profiler.no_phase
+        return self.sampling_profiler.sample(path, self._action_label(controller, request))
+
+    def _response_body(self, request, result, compress, response: bottle.BaseResponse):
+        """ Тело ответа по результату контроллера: сериализация (фаза serialize) и сжатие (фаза compress) """
+        if isinstance(result, StreamingResponse):
+            response.content_type = result.content_type
+            return self.compress_stream(request, iter(result), response) if compress else iter(result)
+        if isinstance(result, (bytes, bytearray)) or (type(result) is bottle.HTTPResponse):
+            return result
+        with request.profiler.phase("serialize"):
+            body = self.serialize(request, result, response) if isinstance(result, (list, dict)) else str(result)
+        if compress:
+            with request.profiler.phase("compress"):
+                body = self.compress_response(request, body, response)
+        return body
+
+    def _finish(self, user, request, result, body, response: bottle.BaseResponse):
+        """ Завершает обработку запроса: отчет о производительности и заголовок Server-Timing """
+        self.performance_report(user, request, result, request.profiler.get_amount())
+        if self.server_timing and type(body) is not bottle.HTTPResponse:
+            response.add_header("Server-Timing", request.profiler.server_timing())
 
-        self.route("/{path}/<filename:path>".format(path=route_path.strip("/")), StaticController)
+    @staticmethod
+    def _action_label(controller, request) -> str:
+        """ Имя действия для метрик и профилирования: неизвестные контроллеру действия не порождают новые серии
+        (действия проксирующего контроллера известны только целевому контроллеру - проверяется лишь имя)
+        """
+        if request.type() == Request.Types.JSON_RPC:
+            return "json-rpc"
+        action = request.get("action", controller.default_action)
+        if not isinstance(action, str):
+            return "other"
+        if issubclass(controller, ProxyController):
+            return action if action.isidentifier() else "other"
+        return action if action in controller.actions() else "other"
+
+    def route_metrics(self, path="/metrics", metrics=None):
+        """
+        Роутинг выгрузки метрик в текстовом формате Prometheus
+        :param path: путь
+        :param metrics: метрики (envi.metrics.Metrics); по умолчанию - Application.metrics или новые метрики
+        """
+        from envi.metrics import Metrics, MetricsController
+        if metrics is not None or self.metrics is None:
+            self.metrics = metrics or Metrics()
+        self.route(path, MetricsController, compress=False)
+
+    def _compression_encoding(self, request, response):
+        """ Выбирает кодировку сжатия ответа или возвращает None, если ответ сжимать не нужно """
+        if self.compressor is None or "Content-Encoding" in response.headers:
+            return None
+        return self.compressor.negotiate(request.environ.get("HTTP_ACCEPT_ENCODING", ""))
+
+    def compress_response(self, request, body, response: bottle.BaseResponse=None):
+        """ Сжимает тело ответа, если клиент поддерживает сжатие, а ответ не меньше compressor.min_size
+        :param response: ответ, в который добавляются заголовки сжатия (по умолчанию - текущий ответ bottle)
+        """
+        if self.compressor is None:
+            return body
+        response = bottle.response if response is None else response
+        data = body if isinstance(body, (bytes, bytearray)) else body.encode(response.charset or "utf-8")
+        if len(data) < self.compressor.min_size:
+            return body
+        response.add_header("Vary", "Accept-Encoding")
+        encoding = self._compression_encoding(request, response)
+        if encoding is None:
+            return body
+        compressed = self.compressor.compress(data, encoding)
+        if len(compressed) >= len(data):
+            return body
+        response.set_header("Content-Encoding", encoding)
+        self.compression_report(request, encoding, len(data), len(compressed))
+        return compressed
+
+    def compress_stream(self, request, chunks, response: bottle.BaseResponse=None):
+        """ Сжимает потоковый ответ порция за порцией (каждая порция отправляется клиенту без задержки)
+        :param response: ответ, в который добавляются заголовки сжатия (по умолчанию - текущий ответ bottle)
+        """
+        if self.compressor is None:
+            return chunks
+        response = bottle.response if response is None else response
+        response.add_header("Vary", "Accept-Encoding")
+        encoding = self._compression_encoding(request, response)
+        if encoding is None:
+            return chunks
+        response.set_header("Content-Encoding", encoding)
+        return self.compressor.stream(chunks, encoding, lambda original, compressed: self.compression_report(
+            request, encoding, original, compressed
+        ))
+
+    def route_static(self, route_path, root, manifest=None, **options):
+        """
+        Роутинг статики (в обход контроллеров, см. StaticFiles)
+        :param root: директория с статикой
+        :param manifest: AssetManifest для URL с отпечатками содержимого (True - построить для root)
+        :param options: параметры StaticFiles
+        """
+        static_files = self._static_files(route_path, root, manifest, options)
+        super().route(
+            "/{path}/<filename:path>".format(path=route_path.strip("/")), ["GET", "HEAD"],
+            lambda filename: static_files.serve(filename, bottle.request.environ)
+        )
+        return static_files
+
+    def _static_files(self, route_path, root, manifest, options):
+        """ StaticFiles для route_static; манифест отпечатков подключается к приложению """
+        if manifest is True:
+            manifest = AssetManifest(root).build()
+        if manifest is not None:
+            manifest.prefix = "/%s/" % route_path.strip("/")
+            self.asset_manifest = manifest
+        return StaticFiles(root, manifest=manifest, **options)
+
+    def asset_url(self, name: str) -> str:
+        """
+        URL файла статики с отпечатком содержимого (для использования в шаблонах)
+        :param name: путь к файлу относительно директории статики
+        """
+        if self.asset_manifest is None:
+            raise RuntimeError("asset manifest is not configured, see route_static(..., manifest=...)")
+        return self.asset_manifest.url(name)
 
     @staticmethod
     def redirect(path, code=None):
@@ -215,34 +596,411 @@ class SuitApplication(Application):
             return str(result)
 
 
+class StaticFile(object):
+    """ Сведения о файле статики, кешируемые StaticFiles """
+    __slots__ = ("path", "size", "mtime", "etag", "last_modified")
+
+    def __init__(self, path, stats: os.stat_result):
+        self.path = path
+        self.size = stats.st_size
+        self.mtime = int(stats.st_mtime)
+        self.etag = '"%x-%x-%x"' % (stats.st_ino, stats.st_size, stats.st_mtime_ns)
+        self.last_modified = email.utils.formatdate(stats.st_mtime, usegmt=True)
+
+
+class StaticFiles(object):
+    """ Раздача статики без Request/RequestPipe
+
+    Результаты stat и содержимое небольших часто запрашиваемых файлов кешируются в памяти (с ограничением размера),
+    условные запросы (If-None-Match, If-Modified-Since) отвечаются 304 (ETag сравниваются слабо - как того
+    требует RFC 9110 для If-None-Match, поэтому подходят и ослабленные прокси теги W/"..."), при поддержке клиентом
+    отдаются заранее сжатые копии файлов (file.js.br, file.js.gz), большие файлы отправляются через
+    wsgi.file_wrapper (sendfile сервера). Запросы с Range обрабатываются bottle.static_file
+    """
+
+    """ Удаление версии из имени файла: file.v123.js -> file.js """
+    version_re = re.compile(r'^(.*)\.(v[0-9]+)?\.(.*)$')
+
+    """ Заранее сжатые копии файлов: (Content-Encoding, расширение) в порядке предпочтения """
+    precompressed = (("br", ".br"), ("gzip", ".gz"))
+
+    def __init__(self, root, stat_ttl: float=2.0, stat_cache_size: int=4096,
+                 memory_cache_size: int=512, memory_cache_max_file: int=64 * 1024, headers: dict=None, manifest=None):
+        """
+        :param root: директория с статикой
+        :param stat_ttl: время (в секундах), в течение которого изменения файлов на диске могут быть не замечены
+        :param stat_cache_size: количество файлов, сведения о которых хранятся в кеше
+        :param memory_cache_size: количество файлов, содержимое которых хранится в памяти
+        :param memory_cache_max_file: максимальный размер файла, содержимое которого хранится в памяти, байт
+        :param headers: дополнительные заголовки ответов (например, Cache-Control)
+        :param manifest: AssetManifest; ответы на запросы с актуальным отпечатком кешируются клиентами навсегда
+        """
+        self.root = os.path.join(os.path.abspath(root), "")
+        self.manifest = manifest
+        self.memory_cache_max_file = memory_cache_max_file
+        self.headers = dict(headers or {})
+        self._stats = LRUCache(maxsize=stat_cache_size, ttl=stat_ttl)
+        self._contents = LRUCache(maxsize=memory_cache_size)
+
+    def stat(self, path):
+        """ Возвращает StaticFile по абсолютному пути или None, если такого файла нет """
+        info = self._stats.get(path, _MISSING)
+        if info is _MISSING:
+            try:
+                stats = os.stat(path)
+                info = StaticFile(path, stats) if os.path.isfile(path) else None
+            except OSError:
+                info = None
+            self._stats.set(path, info)
+        return info
+
+    def resolve(self, filename, accept_encoding: str=""):
+        """
+        Возвращает путь к запрошенному файлу, StaticFile отдаваемого файла и его Content-Encoding
+        :param filename: имя файла относительно root (возможно, с версией)
+        :param accept_encoding: заголовок Accept-Encoding запроса
+        """
+        filename = self.version_re.sub(r'\1.\3', filename)
+        path = os.path.abspath(os.path.join(self.root, filename.strip("/\\")))
+        if not path.startswith(self.root):
+            raise bottle.HTTPError(403, "Access denied.")
+        info = self.stat(path)
+        if info is None:
+            raise bottle.HTTPError(404, "File does not exist.")
+        accepted = self._accepted_encodings(accept_encoding)
+        for encoding, extension in self.precompressed:
+            if encoding in accepted:
+                compressed = self.stat(path + extension)
+                if compressed is not None and compressed.mtime >= info.mtime:
+                    return path, compressed, encoding
+        return path, info, None
+
+    @staticmethod
+    def _accepted_encodings(accept_encoding: str) -> set:
+        accepted = set()
+        for item in accept_encoding.split(","):
+            coding, _, params = item.partition(";")
+            if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+                accepted.add(coding.strip().lower())
+        return accepted
+
+    @staticmethod
+    def content_type(filename):
+        """ Content-Type по имени файла (как в bottle.static_file) """
+        mimetype, encoding = mimetypes.guess_type(filename)
+        if encoding == "gzip":
+            return "application/gzip"
+        if encoding:
+            return "application/x-" + encoding
+        if mimetype and (mimetype[:5] == "text/" or mimetype == "application/javascript"):
+            return mimetype + "; charset=UTF-8"
+        return mimetype
+
+    def serve(self, filename, environ: dict) -> bottle.HTTPResponse:
+        """
+        Ответ на запрос файла статики
+        :param filename: имя файла относительно root (возможно, с версией)
+        :param environ: WSGI environ запроса
+        """
+        extra_headers = self.headers
+        if self.manifest is not None and self.manifest.is_current(filename):
+            extra_headers = dict(self.headers, **{"Cache-Control": self.manifest.cache_control})
+        if environ.get("HTTP_RANGE"):
+            return bottle.static_file(self.version_re.sub(r'\1.\3', filename), self.root, headers=extra_headers)
+        try:
+            path, info, encoding = self.resolve(filename, environ.get("HTTP_ACCEPT_ENCODING", ""))
+        except bottle.HTTPError as err:
+            return err
+
+        headers = {
+            "Content-Length": str(info.size), "Last-Modified": info.last_modified, "ETag": info.etag,
+            "Accept-Ranges": "bytes", "Vary": "Accept-Encoding",
+        }
+        content_type = self.content_type(path)
+        if content_type:
+            headers["Content-Type"] = content_type
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        headers.update(extra_headers)
+
+        if self.not_modified(info, environ):
+            del headers["Content-Length"]
+            return bottle.HTTPResponse(status=304, **headers)
+        if environ.get("REQUEST_METHOD") == "HEAD":
+            return bottle.HTTPResponse("", **headers)
+        body = self.body(info)
+        # Файл мог измениться в течение stat_ttl: длина - по фактически отправляемому содержимому
+        headers["Content-Length"] = str(len(body) if isinstance(body, bytes) else os.fstat(body.fileno()).st_size)
+        return bottle.HTTPResponse(body, **headers)
+
+    @staticmethod
+    def not_modified(info: StaticFile, environ: dict) -> bool:
+        """ Проверяет условия If-None-Match (приоритетно, слабое сравнение ETag) и If-Modified-Since """
+        if_none_match = environ.get("HTTP_IF_NONE_MATCH")
+        if if_none_match:
+            if if_none_match.strip() == "*":
+                return True
+            etag = info.etag[2:] if info.etag.startswith("W/") else info.etag
+            for tag in if_none_match.split(","):
+                tag = tag.strip()
+                if (tag[2:] if tag.startswith("W/") else tag) == etag:
+                    return True
+            return False
+        if_modified_since = environ.get("HTTP_IF_MODIFIED_SINCE")
+        if if_modified_since:
+            since = bottle.parse_date(if_modified_since.split(";")[0].strip())
+            return since is not None and since >= info.mtime
+        return False
+
+    def body(self, info: StaticFile):
+        """ Содержимое небольшого файла из памяти или открытый файл (bottle отправит его через wsgi.file_wrapper) """
+        if info.size > self.memory_cache_max_file:
+            return open(info.path, "rb")
+        content = self._contents.get(info.etag)
+        if content is None:
+            with open(info.path, "rb") as f:
+                content = f.read()
+            if len(content) == info.size:
+                self._contents.set(info.etag, content)
+        return content
+
+    def invalidate(self):
+        """ Сбрасывает кеши (например, после выкладки новой статики) """
+        self._stats.invalidate()
+        self._contents.invalidate()
+
+
+class AssetManifest(object):
+    """ Манифест отпечатков (хешей содержимого) файлов статики
+
+    URL с отпечатком (js/app.js -> /static/js/app.v123456.js) меняется при изменении файла, поэтому ответы на такие
+    запросы кешируются браузерами и CDN навсегда. Если задан кеш-файл, хеши сохраняются в нем вместе с mtime
+    и размером файлов, и при повторной сборке пересчитываются только для измененных файлов. Кеш-файл,
+    принадлежащий другому пользователю или доступный на запись другим, не читается: подмененные хеши
+    дали бы вечно кешируемые URL со старым содержимым
+    """
+
+    """ Cache-Control ответов на запросы по URL с актуальным отпечатком """
+    cache_control = "public, max-age=31536000, immutable"
+
+    """ Расширения заранее сжатых копий файлов, не получающих собственных отпечатков """
+    compressed_extensions = (".gz", ".br")
+
+    def __init__(self, root, cache_file: str=None, prefix: str="/static/"):
+        """
+        :param root: директория с статикой
+        :param cache_file: файл кеша хешей, например, рядом с root (None - хеши вычисляются при каждой сборке)
+        :param prefix: префикс URL статики (устанавливается Application.route_static)
+        """
+        self.root = os.path.abspath(root)
+        self.cache_file = cache_file
+        self.prefix = prefix
+        """ Версии (отпечатки) файлов по их путям относительно root """
+        self.versions = {}
+        """ Количество файлов, хеши которых пришлось вычислить при последней сборке """
+        self.hashed = 0
+
+    def build(self):
+        """ Строит манифест, вычисляя хеши только новых и измененных файлов """
+        cache = self._load_cache()
+        entries, hashed = {}, 0
+        for directory, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [dirname for dirname in dirnames if not dirname.startswith(".")]
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                if filename.startswith(".") or (filename.endswith(self.compressed_extensions)
+                                                and os.path.exists(path[:-3])):
+                    continue
+                try:
+                    stats = os.stat(path)
+                except OSError:
+                    continue
+                name = os.path.relpath(path, self.root).replace(os.sep, "/")
+                entry = cache.get(name)
+                if not entry or entry[0] != stats.st_mtime_ns or entry[1] != stats.st_size:
+                    entry = [stats.st_mtime_ns, stats.st_size, self.digest(path)]
+                    hashed += 1
+                entries[name] = entry
+        self.versions = {name: str(int(entry[2][:12], 16)) for name, entry in entries.items()}
+        self.hashed = hashed
+        if hashed or len(entries) != len(cache):
+            self._save_cache(entries)
+        return self
+
+    @staticmethod
+    def digest(path) -> str:
+        """ Хеш содержимого файла """
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _load_cache(self) -> dict:
+        if self.cache_file is None:
+            return {}
+        try:
+            with open(self.cache_file) as f:
+                stats = os.fstat(f.fileno())
+                if hasattr(os, "geteuid") and (stats.st_uid != os.geteuid() or stats.st_mode & 0o022):
+                    return {}
+                cache = json.load(f)
+            return cache if isinstance(cache, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def _save_cache(self, entries: dict):
+        """ Записывает кеш атомарно: одновременно стартующие процессы не увидят недописанный файл """
+        if self.cache_file is None:
+            return
+        try:
+            fd, path = tempfile.mkstemp(dir=os.path.dirname(self.cache_file) or ".")
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(entries, f)
+            os.replace(path, self.cache_file)
+        except OSError:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def url(self, name: str) -> str:
+        """
+        URL файла статики с отпечатком; для неизвестных файлов и файлов без расширения - URL без отпечатка
+        :param name: путь к файлу относительно root
+        """
+        name = name.lstrip("/")
+        version = self.versions.get(name)
+        base, dot, extension = name.rpartition(".")
+        if version is None or not base or "/" in extension or base.endswith("/"):
+            return self.prefix + name
+        return "%s%s.v%s.%s" % (self.prefix, base, version, extension)
+
+    def is_current(self, filename: str) -> bool:
+        """ Проверяет, что запрошенное имя файла содержит актуальный отпечаток """
+        match = StaticFiles.version_re.match(filename)
+        if match is None or match.group(2) is None:
+            return False
+        return self.versions.get("%s.%s" % (match.group(1), match.group(3))) == match.group(2)[1:]
+
+
 class Controller(metaclass=ABCMeta):
     error_template = "error_template"
     default_action = "not_implemented"
 
+    """ Восстановление дат при декодировании JSON-данных запроса: True - во всех ключах, False - отключено,
+    набор ключей - только в перечисленных ключах """
+    revive_datetimes = True
+
+    """ Stateless-контроллер не хранит состояние запроса в self, поэтому один его экземпляр обслуживает все запросы """
+    stateless = False
+
+    """ Методы фреймворка, которые нельзя вызвать как действие контроллера """
+    reserved_actions = frozenset((
+        "process", "process_async", "setup", "apply_to_each_response", "actions", "instance", "asynchronous"
+    ))
+
     @staticmethod
     def not_implemented(**kwargs):
         raise NotImplementedError()
 
+    @classmethod
+    def actions(cls) -> frozenset:
+        """ Таблица действий контроллера: имена публичных методов, кроме методов фреймворка (reserved_actions)
+        Строится один раз для класса (при регистрации роута или при первом запросе)
+        """
+        actions = cls.__dict__.get("_actions")
+        if actions is None:
+            actions = frozenset(
+                name for name in dir(cls)
+                if not name.startswith("_") and name not in cls.reserved_actions
+                and callable(getattr(cls, name, None)) and not isinstance(getattr(cls, name), type)
+            )
+            cls._actions = actions
+        return actions
+
+    @classmethod
+    def instance(cls):
+        """ Возвращает экземпляр контроллера для обработки запроса: новый или общий для stateless-контроллера """
+        if not cls.stateless:
+            return cls()
+        instance = cls.__dict__.get("_instance")
+        if instance is None:
+            instance = cls._instance = cls()
+        return instance
+
+    @classmethod
+    def asynchronous(cls) -> bool:
+        """ Есть ли у контроллера асинхронные (async def) действия, setup или apply_to_each_response
+        Запросы к синхронным контроллерам AsgiApplication целиком обрабатывает в пуле потоков
+        """
+        asynchronous = cls.__dict__.get("_asynchronous")
+        if asynchronous is None:
+            asynchronous = cls._asynchronous = any(
+                inspect.iscoroutinefunction(getattr(cls, name))
+                for name in cls.actions() | {"setup", "apply_to_each_response"}
+            )
+        return asynchronous
+
     def process(self, app: Application, request, user, host):
-        error_response2 = lambda error_data: ControllerMethodResponseWithTemplate(error_data, self.error_template)
-        request.set("error_response2", error_response2)
+        request.error_controller = self
+
+        with request.profiler.phase("setup"):
+            domain_data = self.setup(app=app, request=request, user=user, host=host)
 
-        domain_data = self.setup(app=app, request=request, user=user, host=host)
+        request.error_context = (self, app, user, host, domain_data)
 
-        error_response = lambda error_data: self.apply_to_each_response(
-            response=ControllerMethodResponseWithTemplate(error_data, self.error_template),
-            app=app, request=request, user=user, host=host, **domain_data)
+        action = request.get("action", self.__class__.default_action)
+        if not isinstance(action, str) or action not in self.actions():
+            raise NotImplementedError()
+        cb = getattr(self, action)
 
-        request.set("error_response", error_response)
+        with request.profiler.phase("action"):
+            response = cb(app=app, request=request, user=user, host=host, **domain_data)
+        with request.profiler.phase("apply"):
+            return self.apply_to_each_response(
+                response=response, app=app, request=request, user=user, host=host, **domain_data)
 
-        try:
-            cb = self.__getattribute__(request.get("action", self.__class__.default_action))
-        except AttributeError:
+    async def process_async(self, app, request, user, host):
+        """ Обработка запроса в AsgiApplication: корутины выполняются в цикле событий,
+        синхронные методы - в пуле потоков приложения (app.run_sync)
+        """
+        request.error_controller = self
+
+        with request.profiler.phase("setup"):
+            domain_data = await self._call_async(
+                app, request, self.setup, Controller.setup, app=app, request=request, user=user, host=host)
+
+        request.error_context = (self, app, user, host, domain_data)
+
+        action = request.get("action", self.__class__.default_action)
+        if not isinstance(action, str) or action not in self.actions():
             raise NotImplementedError()
+        cb = getattr(self, action)
 
-        return self.apply_to_each_response(
-            response=cb(app=app, request=request, user=user, host=host, **domain_data),
-            app=app, request=request, user=user, host=host, **domain_data)
+        with request.profiler.phase("action"):
+            response = await self._call_async(
+                app, request, cb, None, app=app, request=request, user=user, host=host, **domain_data)
+        with request.profiler.phase("apply"):
+            return await self._call_async(
+                app, request, self.apply_to_each_response, Controller.apply_to_each_response,
+                response=response, app=app, request=request, user=user, host=host, **domain_data)
+
+    @staticmethod
+    async def _call_async(app, request, method, default, /, **kwargs):
+        """ Вызывает метод контроллера: корутину - в цикле событий, переопределенный синхронный метод - в пуле потоков
+        :param default: реализация метода в Controller (она ничего не блокирует и вызывается на месте)
+        """
+        if inspect.iscoroutinefunction(method):
+            return await method(**kwargs)
+        if default is not None and getattr(method, "__func__", None) is default:
+            result = method(**kwargs)
+        else:
+            result = await app.run_sync(request, method, **kwargs)
+        return await result if inspect.isawaitable(result) else result
 
     def setup(self, app, request, user, host) -> dict:
         """ Можно переопределять в создаваемых контроллерах """
@@ -255,12 +1013,71 @@ class Controller(metaclass=ABCMeta):
 
 
 class ProxyController(Controller, metaclass=ABCMeta):
-    """ Проксирующий контроллер """
+    """ Проксирующий контроллер
+
+    Выбор целевого контроллера можно кешировать: для этого нужно перечислить в depends_on параметры запроса,
+    от которых зависит выбор (или переопределить resolution_key, например, чтобы учесть роль пользователя).
+    Для вложенных проксирующих контроллеров ключ внешнего контроллера должен учитывать входные данные всей цепочки
+    """
+    reserved_actions = Controller.reserved_actions | {
+        "factory_method", "resolve", "resolution_key", "cache_info", "cache_clear"
+    }
+
+    """ Параметры запроса, от которых зависит выбор целевого контроллера. None - выбор не кешируется """
+    depends_on = None
+    resolution_cache_size = 1024
+
+    @classmethod
+    def resolution_key(cls, app, request, user, host):
+        """ Ключ кеша выбора целевого контроллера. None - не кешировать
+        По умолчанию - значения параметров запроса из depends_on
+        """
+        if cls.depends_on is None:
+            return None
+        return tuple(request.get(name, None) for name in cls.depends_on)
+
+    @classmethod
+    def resolve(cls, app, request, user, host):
+        """ Возвращает конечный (не проксирующий) целевой контроллер, используя кеш, если он настроен """
+        key = cls.resolution_key(app, request, user, host)
+        try:
+            cached = cls._resolution_cache().get(key) if key is not None else None
+        except TypeError:
+            # Нехешируемые значения параметров (списки, словари) не кешируются
+            key, cached = None, None
+        if cached is not None:
+            return cached
+
+        proxy_controller = cls.factory_method(app, request, user, host)
+        if issubclass(proxy_controller, ProxyController):
+            proxy_controller = proxy_controller.resolve(app, request, user, host)
+
+        if key is not None:
+            cls._resolution_cache().set(key, proxy_controller)
+        return proxy_controller
+
+    @classmethod
+    def cache_info(cls) -> dict:
+        """ Статистика кеша выбора целевого контроллера """
+        return cls._resolution_cache().stats()
+
+    @classmethod
+    def cache_clear(cls):
+        """ Сбрасывает кеш выбора целевого контроллера (например, после изменения прав пользователей) """
+        cls._resolution_cache().invalidate()
+
+    @classmethod
+    def _resolution_cache(cls):
+        cache = cls.__dict__.get("_resolution_cache_instance")
+        if cache is None:
+            with _class_cache_lock:
+                cache = cls.__dict__.get("_resolution_cache_instance")
+                if cache is None:
+                    cache = cls._resolution_cache_instance = LRUCache(maxsize=cls.resolution_cache_size)
+        return cache
 
     def setup(self, app, request, user, host):
-        proxy_controller = self.factory_method(app, request, user, host)
-        while issubclass(proxy_controller, ProxyController):
-            proxy_controller = proxy_controller.factory_method(app, request, user, host)
+        proxy_controller = self.resolve(app, request, user, host)
 
         data = {"proxy_controller": proxy_controller, "action": request.get("action", proxy_controller.default_action)}
         request.set("action", "ret")
@@ -269,7 +1086,29 @@ class ProxyController(Controller, metaclass=ABCMeta):
     @staticmethod
     def ret(proxy_controller, action, app, request, user, host):
         request.set("action", action)
-        return proxy_controller().process(app, request, user, host)
+        return proxy_controller.instance().process(app, request, user, host)
+
+    @classmethod
+    def asynchronous(cls) -> bool:
+        """ Целевой контроллер определяется только при обработке запроса и может быть асинхронным """
+        return True
+
+    async def process_async(self, app, request, user, host):
+        request.error_controller = self
+
+        with request.profiler.phase("setup"):
+            domain_data = await self._call_async(
+                app, request, self.setup, None, app=app, request=request, user=user, host=host)
+
+        request.error_context = (self, app, user, host, domain_data)
+
+        # Как ret, но целевой контроллер обрабатывает запрос асинхронно
+        request.set("action", domain_data["action"])
+        response = await domain_data["proxy_controller"].instance().process_async(app, request, user, host)
+        with request.profiler.phase("apply"):
+            return await self._call_async(
+                app, request, self.apply_to_each_response, Controller.apply_to_each_response,
+                response=response, app=app, request=request, user=user, host=host, **domain_data)
 
     @staticmethod
     @abstractmethod
@@ -284,7 +1123,37 @@ class ProxyController(Controller, metaclass=ABCMeta):
 
 
 class WebSocketController(Controller):
+    """ Контроллер WebSocket-соединения (по экземпляру на соединение, поэтому stateless не включается)
+
+    Сообщения клиента с ключом action обрабатываются как запросы к действиям контроллера, результат отправляется
+    в сокет. Сообщения из других потоков отправляются в сокет методом push (см. WebSocketControllerNb),
+    рассылка по темам многим соединениям - envi.broadcast.BroadcastHub.
+    В Application соединение обслуживает транспорт uwsgi (create_transport), в AsgiApplication - asyncio (serve_async)
+
+    Формат сообщений согласуется подпротоколом (заголовок Sec-WebSocket-Protocol): json, msgpack или cbor
+    (двоичные форматы - если установлена библиотека, см. BinaryCodec). Без подпротокола - JSON, как раньше.
+    С суффиксом ".batch" (например, msgpack.batch) результаты и сообщения очереди, полученные за одно пробуждение
+    обработчика, отправляются одним сообщением-массивом, а массив от клиента обрабатывается как несколько сообщений
+    """
     default_action = "connect"
+    reserved_actions = Controller.reserved_actions | {
+        "open", "close", "tick", "process_request_from_browser", "create_transport", "push", "serve_async",
+        "select_protocol"
+    }
+
+    """ Форматы сообщений, которые контроллер согласует с клиентом """
+    protocols = ("msgpack", "cbor", "json")
+
+    """ Транспорт текущего соединения (envi.websocket.WebSocketTransport) """
+    transport = None
+
+    """ Согласованный подпротокол соединения (None - без подпротокола), кодек двоичного формата и пакетный режим """
+    protocol = None
+    codec = None
+    batch = False
+
+    """ Хабы рассылки (envi.broadcast.BroadcastHub), на которые подписано соединение """
+    hubs = frozenset()
 
     def open(self, app, request, user, host):
         """ Открытие сокета """
@@ -299,105 +1168,558 @@ class WebSocketController(Controller):
         """ Ничего не делает. Нужен чтобы прошёл цикл внутри self.connect() """
         return {}
 
+    def create_transport(self):
+        """ Транспорт соединения для Application. Можно переопределять (например, в тестах) """
+        return UwsgiWebSocketTransport()
+
+    def push(self, message):
+        """ Отправляет сообщение клиенту из любого потока (не ждет отправки)
+        В Application отправку таких сообщений поддерживает только WebSocketControllerNb:
+        WebSocketController.connect блокируется на чтении сокета
+        """
+        self.transport.push(message)
+
+    def select_protocol(self, offered: list):
+        """ Выбирает подпротокол из предложенных клиентом (в порядке предпочтения клиента); None - без подпротокола """
+        for protocol in offered:
+            name, _, mode = protocol.partition(".")
+            if name in self.protocols and mode in ("", "batch") and (name == "json" or BinaryCodec.get(name)):
+                return protocol
+        return None
+
     def connect(self, app, request, user, host):
-        import uwsgi
-        uwsgi.websocket_handshake()
+        transport = self.transport = self.create_transport()
+        transport.handshake(request.environ, self._negotiate(request.environ))
         self.open(app=app, request=request, user=user, host=host)
         try:
             while True:
                 try:
-                    msg = uwsgi.websocket_recv()
-                except OSError:
+                    msg = transport.receive()
+                    self._dispatch(app, request, user, host, msg)
+                    self._flush()
+                except WebSocketClosed:
                     raise SystemExit()
-
-                if msg:
-                    msg = msg.decode()
-                    try:
-                        msg = json.loads(msg, object_hook=json_loads_handler)
-                    except ValueError:
-                        msg = None
-
-                    if msg:
-                        self.process_request_from_browser(app, request, user, host, msg)
         finally:
+            self._leave_hubs()
             self.close(app=app, request=request, user=user, host=host)
+            transport.close()
+
+    def _negotiate(self, environ: dict):
+        """ Выбирает формат сообщений соединения; возвращает подпротокол для ответа на handshake """
+        self._results = []
+        offered = [name.strip() for name in environ.get("HTTP_SEC_WEBSOCKET_PROTOCOL", "").split(",") if name.strip()]
+        protocol = self.select_protocol(offered) if offered else None
+        if protocol is not None:
+            name, _, mode = protocol.partition(".")
+            self.codec = BinaryCodec.get(name) if name != "json" else None
+            self.batch = mode == "batch"
+        self.protocol = protocol
+        return protocol
+
+    def _decode(self, msg) -> list:
+        """ Запросы (словари) из сообщения клиента """
+        if not msg:
+            return []
+        object_hook = datetime_hook(self.revive_datetimes)
+        try:
+            if self.codec is not None and isinstance(msg, (bytes, bytearray)):
+                data = self.codec.loads(msg, object_hook=object_hook)
+            else:
+                data = json_codec.loads(msg.decode() if isinstance(msg, (bytes, bytearray)) else msg,
+                                        object_hook=object_hook)
+        except ValueError:
+            return []
+        messages = data if self.batch and isinstance(data, list) else [data]
+        return [message for message in messages if message and isinstance(message, dict)]
+
+    def _dispatch(self, app, request, user, host, msg):
+        for message in self._decode(msg):
+            self.process_request_from_browser(app, request, user, host, message)
+
+    def _leave_hubs(self):
+        for hub in self.hubs:
+            hub.unsubscribe(self)
+
+    @staticmethod
+    def _result(result, msg):
+        """ Результат действия для отправки клиенту """
+        if isinstance(result, dict):
+            result.update({"ws": {"event": msg["action"]}})
+        return result
+
+    def _message(self, message):
+        """ Сообщение (из исходящей очереди или в пакете) в согласованном формате """
+        if isinstance(message, Frame):
+            return message.encode(self.codec)
+        return self.codec.dumps(message) if self.codec is not None else json_codec.dumps(message)
+
+    def _encode(self, result):
+        """ Результат действия в виде сообщения сокета (bytes отправляются как есть) """
+        if isinstance(result, StreamingResponse):
+            result = b"".join(result)
+        if isinstance(result, (bytes, bytearray)):
+            return result
+        if self.codec is not None:
+            return self.codec.dumps(result)
+        return json_codec.dumps(result) if isinstance(result, (list, dict)) else str(result)
 
-    def process_request_from_browser(self, app, request, user, host, msg, uwsgi):
+    def _frames(self, results, pushed) -> list:
+        """ Сообщения сокета: по одному на результат и сообщение очереди, в пакетном режиме - один массив
+        (результаты в виде bytes и в пакетном режиме отправляются отдельно)
+        """
+        if not self.batch:
+            return [self._encode(result) for result in results] + [self._message(message) for message in pushed]
+        frames, items = [], []
+        for result in results:
+            if isinstance(result, (bytes, bytearray)):
+                frames.append(result)
+            else:
+                items.append(self._message(result))
+        items += [self._message(message) for message in pushed]
+        if items:
+            frames.append(self.codec.array(items) if self.codec is not None else "[%s]" % ",".join(items))
+        return frames
+
+    def _flush(self, pushed=()):
+        """ Отправляет накопленные результаты и сообщения очереди """
+        results, self._results = self._results, []
+        for data in self._frames(results, pushed):
+            self.transport.send(data, binary=self.codec is not None)
+
+    async def _flush_async(self, pushed=()):
+        results, self._results = self._results, []
+        for data in self._frames(results, pushed):
+            await self.transport.send(data, binary=self.codec is not None)
+
+    def process_request_from_browser(self, app, request, user, host, msg, uwsgi=None):
+        """
+        Обработка сообщения клиента
+        :param uwsgi: не используется (оставлен для совместимости), сообщения отправляются через self.transport
+        """
         if "action" in msg:
             ws_request = Request(msg, environ=request.environ)
             pipe = RequestPipe()
             result = pipe.process(self, app, ws_request, user, host)
-            if isinstance(result, dict):
-                result.update({"ws": {"event": msg["action"]}})
-            if isinstance(result, (bytes, bytearray)):
-                uwsgi.websocket_send(result)
-            else:
-                uwsgi.websocket_send(
-                    json.dumps(result, default=json_dumps_handler)
-                    if isinstance(result, (list, dict)) else str(result)
-                )
+            if isinstance(result, StreamingResponse):
+                result = b"".join(result)
+            self._results.append(self._result(result, msg))
+            if not self.batch:
+                self._flush()
             self.tick(app=app, request=ws_request, user=user, host=host)
 
+    async def serve_async(self, app, request, user, host, transport):
+        """ Обслуживание соединения в AsgiApplication (envi.websocket.AsgiWebSocketTransport)
+        Действия и хуки - корутины выполняются в цикле событий, синхронные методы - в пуле потоков приложения
+        """
+        self.transport = transport
+        await transport.handshake(request.environ, self._negotiate(request.environ))
+        await self._call_async(app, request, self.open, WebSocketController.open,
+                               app=app, request=request, user=user, host=host)
+        poll_interval = self._poll_interval()
+        try:
+            while True:
+                try:
+                    incoming, outgoing = await transport.wait(poll_interval)
+                except WebSocketClosed:
+                    break
+                for msg in incoming:
+                    for message in self._decode(msg):
+                        if "action" not in message:
+                            continue
+                        ws_request = Request(message, environ=request.environ)
+                        # Заголовки и cookies после установки соединения не отправляются
+                        ws_request.response = bottle.BaseResponse()
+                        result = await RequestPipe().process_async(self, app, ws_request, user, host)
+                        if isinstance(result, StreamingResponse):
+                            result = await app.run_sync(ws_request, b"".join, result)
+                        self._results.append(self._result(result, message))
+                        if not self.batch:
+                            await self._flush_async()
+                        await self._call_async(app, ws_request, self.tick, WebSocketController.tick,
+                                               app=app, request=ws_request, user=user, host=host)
+                await self._flush_async(outgoing + self._polled_messages(poll_interval))
+        finally:
+            self._leave_hubs()
+            await self._call_async(app, request, self.close, WebSocketController.close,
+                                   app=app, request=request, user=user, host=host)
+            await transport.close()
+
+    def _poll_interval(self):
+        """ Как часто опрашивать messages, секунды; None - не опрашивать """
+        return None
+
+    def _polled_messages(self, poll_interval) -> list:
+        return []
+
 
 class WebSocketControllerNb(WebSocketController):
-    """ Non-blocking версия для WS-контроллера, периодически заглядывает в messages и отправляет их в сокет """
+    """ Non-blocking версия для WS-контроллера: ждет сообщений клиента и сообщений, отправленных методом push,
+    и обрабатывает их сразу, не опрашивая сокет
+
+    Свойство messages устарело: если оно переопределено, оно опрашивается раз в poll_interval секунд
+    """
+
+    """ Интервал опроса переопределенного свойства messages, секунды """
+    poll_interval = 0.1
+
     def connect(self, app, request, user, host):
-        import uwsgi
-        uwsgi.websocket_handshake()
+        transport = self.transport = self.create_transport()
+        transport.handshake(request.environ, self._negotiate(request.environ))
         self.open(app=app, request=request, user=user, host=host)
+        poll_interval = self._poll_interval()
         try:
             while True:
                 try:
-                    msg = uwsgi.websocket_recv_nb()
-                    if msg:
-                        msg = msg.decode()
-                        try:
-                            msg = json.loads(msg, object_hook=json_loads_handler)
-                        except ValueError:
-                            msg = None
-
-                        if msg:
-                            self.process_request_from_browser(app, request, user, host, msg, uwsgi)
-                    else:
-                        for msg in self.messages:
-                            uwsgi.websocket_send(json.dumps(msg, default=json_dumps_handler))
-                    sleep(0.1)
-                except OSError:
+                    incoming, outgoing = transport.wait(poll_interval)
+                    for msg in incoming:
+                        self._dispatch(app, request, user, host, msg)
+                    self._flush(outgoing + self._polled_messages(poll_interval))
+                except WebSocketClosed:
                     raise SystemExit()
         finally:
+            self._leave_hubs()
             self.close(app=app, request=request, user=user, host=host)
+            transport.close()
+
+    def _poll_interval(self):
+        return self.poll_interval if type(self).messages is not WebSocketControllerNb.messages else None
+
+    def _polled_messages(self, poll_interval) -> list:
+        return list(self.messages) if poll_interval is not None else []
 
     @property
     def messages(self):
         return []
 
 
-class Request(object):
-    class RequiredArgumentIsMissing(Exception):
-        """ Исключение, возникающие если не предоставлен какой-либо из требуемых приложением параметров запроса """
-        pass
+class DecodedForms(Mapping):
+    """ Представление FormsDict bottle, декодирующее ключи и значения (как FormsDict.decode()) только при обращении
 
-    class ArgumentTypeError(Exception):
-        """ Исключение, возникающие при неудачной попытке приведения параметра запроса к желемому типу данных """
-        pass
+    Не копирует параметры запроса: чтение двух-трех параметров не требует перекодирования всех остальных
+    """
 
-    class Types(object):
-        """ Типы запросов """
-        STATIC = 0
-        AJAX = 1
-        PJAX = 2
-        JSON_RPC = 3
+    def __init__(self, forms: bottle.FormsDict):
+        self._forms = forms
 
-    def __init__(self, *args, **kwargs):
-        self._request = {}
-        self.environ = kwargs.get("environ", {})
-        self.response = Response()
+    def _fix(self, value):
+        if isinstance(value, str) and self._forms.recode_unicode:
+            return value.encode("latin1").decode(self._forms.input_encoding)
+        return value
 
-        for data in args:
-            self.update(data)
+    def _raw_key(self, key):
+        if isinstance(key, str) and self._forms.recode_unicode:
+            try:
+                return key.encode(self._forms.input_encoding).decode("latin1")
+            except UnicodeError:
+                return None
+        return key
 
-    def get(self, key, *args, **kwargs):
-        """
+    def __contains__(self, key):
+        return self._raw_key(key) in self._forms
+
+    def __getitem__(self, key):
+        raw_key = self._raw_key(key)
+        if raw_key not in self._forms:
+            raise KeyError(key)
+        return self._fix(self._forms[raw_key])
+
+    def __iter__(self):
+        return (self._fix(key) for key in self._forms)
+
+    def __len__(self):
+        return len(self._forms)
+
+
+class RequestStream(object):
+    """ Потоковое чтение тела запроса без загрузки его в память целиком (см. Application.route, параметр streaming)
+
+    Тело можно прочитать только один раз и только одним из способов: порциями, элементами JSON-массива,
+    строками NDJSON, парами urlencoded-формы или целиком во временный файл (например, для multipart-форм)
+    """
+
+    class AlreadyConsumed(Exception):
+        """ Исключение, возникающее при повторном чтении тела запроса """
+        pass
+
+    """ Размер порции чтения из wsgi.input, байт """
+    chunk_size = 64 * 1024
+
+    _json_whitespace_re = re.compile(r"[ \t\n\r]*")
+
+    def __init__(self, environ: dict):
+        self.environ = environ
+        self.consumed = False
+
+    @property
+    def content_length(self):
+        """ Длина тела по заголовку Content-Length (None, если заголовок не передан) """
+        try:
+            return int(self.environ["CONTENT_LENGTH"])
+        except (KeyError, ValueError):
+            return None
+
+    def chunks(self, size: int=None):
+        """
+        Итератор порций тела запроса (bytes)
+        :param size: максимальный размер порции, по умолчанию - chunk_size
+        """
+        if self.consumed:
+            raise self.AlreadyConsumed("request body has already been consumed")
+        self.consumed = True
+        return self._iter_chunks(size or self.chunk_size)
+
+    def _iter_chunks(self, size):
+        stream = self.environ.get("wsgi.input")
+        if stream is None:
+            return
+        if "bottle.request.body" in self.environ:
+            # Тело уже прочитано bottle (и при необходимости декодировано из chunked) - читаем его буфер
+            stream.seek(0)
+            remaining = None
+        elif "chunked" in self.environ.get("HTTP_TRANSFER_ENCODING", "").lower():
+            yield from bottle.BaseRequest._iter_chunked(stream.read, size)
+            return
+        else:
+            remaining = self.content_length
+            if remaining is None and not self.environ.get("wsgi.input_terminated"):
+                # Без Content-Length читать wsgi.input до конца небезопасно (PEP 3333)
+                return
+        while remaining is None or remaining > 0:
+            chunk = stream.read(size if remaining is None else min(size, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+    def json_array(self, object_hook=None):
+        """
+        Итератор элементов JSON-массива, переданного в теле запроса
+        В памяти одновременно находятся только текущая порция тела и разбираемый элемент
+        :param object_hook: object_hook для декодирования элементов (см. datetime_hook)
+        """
+        return self._iter_json_array(self.chunks(), json.JSONDecoder(object_hook=object_hook))
+
+    @classmethod
+    def _iter_json_array(cls, chunks, decoder):
+        utf8 = codecs.getincrementaldecoder("utf-8")()
+        buffer, position, state, eof = "", 0, "start", False
+        while True:
+            position = cls._json_whitespace_re.match(buffer, position).end()
+            if position < len(buffer):
+                char = buffer[position]
+                if state == "start":
+                    if char != "[":
+                        raise ValueError("request body is not a JSON array")
+                    position, state = position + 1, "first"
+                    continue
+                if char == "]" and state in ("first", "separator"):
+                    return
+                if state == "separator":
+                    if char != ",":
+                        raise ValueError("expecting ',' delimiter at position %s of JSON array chunk" % position)
+                    position, state = position + 1, "value"
+                    continue
+                try:
+                    value, end = decoder.raw_decode(buffer, position)
+                except ValueError:
+                    if eof:
+                        raise
+                else:
+                    # Число в конце буфера может продолжаться в следующей порции
+                    if end < len(buffer) or eof:
+                        yield value
+                        position, state = end, "separator"
+                        continue
+            elif eof:
+                raise ValueError("unexpected end of JSON array")
+            chunk = next(chunks, None)
+            if chunk is None:
+                eof = True
+            buffer = buffer[position:] + utf8.decode(chunk or b"", final=eof)
+            position = 0
+
+    def ndjson(self, object_hook=None):
+        """
+        Итератор объектов NDJSON (по одному JSON-документу в строке), пустые строки пропускаются
+        :param object_hook: object_hook для декодирования объектов (см. datetime_hook)
+        """
+        return (json_codec.loads(line, object_hook=object_hook) for line in self._iter_split(b"\n"))
+
+    def form(self, encoding: str="utf-8"):
+        """
+        Итератор пар (имя, значение) тела в формате application/x-www-form-urlencoded
+        :param encoding: кодировка имен и значений
+        """
+        for field in self._iter_split(b"&"):
+            name, _, value = field.partition(b"=")
+            yield (unquote_to_bytes(name.replace(b"+", b" ")).decode(encoding),
+                   unquote_to_bytes(value.replace(b"+", b" ")).decode(encoding))
+
+    def _iter_split(self, separator: bytes):
+        """ Итератор непустых частей тела, разделенных separator """
+        tail = b""
+        for chunk in self.chunks():
+            parts = (tail + chunk).split(separator)
+            tail = parts.pop()
+            for part in parts:
+                if part.strip():
+                    yield part
+        if tail.strip():
+            yield tail
+
+    def spool(self, max_memory: int=1024 * 1024):
+        """
+        Сохраняет тело запроса во временный файл и возвращает его, перемотанным на начало
+        :param max_memory: размер тела, до которого оно хранится в памяти, а не на диске
+        """
+        spooled = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        for chunk in self.chunks():
+            spooled.write(chunk)
+        spooled.seek(0)
+        return spooled
+
+
+class Request(object):
+    class RequiredArgumentIsMissing(Exception):
+        """ Исключение, возникающие если не предоставлен какой-либо из требуемых приложением параметров запроса """
+        pass
+
+    class ArgumentTypeError(Exception):
+        """ Исключение, возникающие при неудачной попытке приведения параметра запроса к желемому типу данных """
+        pass
+
+    class Types(object):
+        """ Типы запросов """
+        STATIC = 0
+        AJAX = 1
+        PJAX = 2
+        JSON_RPC = 3
+
+    def __init__(self, *args, **kwargs):
+        """
+        Запрос инициализируется любым количеством источников параметров: каждый следующий источник
+        переопределяет значения предыдущих, а значения, установленные через set() и update(), - значения всех.
+        Источником может быть словарь или функция без аргументов, возвращающая словарь (или другой Mapping);
+        функция вызывается только при первом обращении к параметрам, которых нет в более приоритетных источниках
+        @param environ: WSGI environ запроса (не копируется)
+        """
+        self._request = {}
+        self._sources = []
+        self.environ = kwargs.get("environ", {})
+        self.response = Response()
+        """ Контроллер и контекст, из которых по требованию строятся error_response и error_response2 """
+        self.error_controller = None
+        self.error_context = None
+        """ Исключение, превращенное при обработке запроса в ответ с ошибкой (см. RequestPipe) """
+        self.exception = None
+        """ Замер времени обработки запроса по фазам """
+        self.profiler = Profiler()
+        """ Двоичный формат ответа (BinaryCodec), выбранный по заголовку Accept; None - JSON """
+        self.codec = None
+        self._stream = None
+
+        for data in args:
+            if not isinstance(data, dict) and not callable(data):
+                raise TypeError("request cannot be updated by value of class %s" % data.__class__.__name__)
+            self._sources.append(data)
+
+    @classmethod
+    def from_bottle(cls, kwargs: dict, object_hook=None, streaming: bool=False):
+        """
+        Создает запрос на основе текущего запроса bottle. Параметры декодируются лениво, environ не копируется
+        Приоритет источников (по возрастанию): cookies, параметры роута, GET, POST (или тело в JSON, MessagePack
+        или CBOR - по Content-Type, см. BinaryCodec), параметр json
+        @param kwargs: Параметры роута
+        @param object_hook: object_hook для декодирования параметра json (см. datetime_hook), None - без обработки
+        @param streaming: не разбирать тело запроса (оно читается через request.stream)
+        """
+        return cls._from_http(bottle.request, kwargs, object_hook, streaming)
+
+    @classmethod
+    def from_environ(cls, environ: dict, kwargs: dict, object_hook=None, streaming: bool=False):
+        """
+        Создает запрос на основе WSGI environ (без thread-local запроса bottle, см. AsgiApplication)
+        Параметры - как у from_bottle
+        """
+        return cls._from_http(bottle.BaseRequest(environ), kwargs, object_hook, streaming)
+
+    @classmethod
+    def _from_http(cls, http: bottle.BaseRequest, kwargs: dict, object_hook, streaming):
+        cache = {}
+
+        def get():
+            if "get" not in cache:
+                cache["get"] = DecodedForms(http.GET)
+            return cache["get"]
+
+        def post():
+            if "post" not in cache:
+                try:
+                    codec = BinaryCodec.for_content_type(http.content_type) if http.content_length else None
+                    if codec is not None:
+                        data = codec.loads(http.body.read())
+                        cache["post"] = data if isinstance(data, dict) else {}
+                    else:
+                        cache["post"] = http.json or DecodedForms(http.POST)
+                except Exception:
+                    cache["post"] = DecodedForms(http.POST)
+            return cache["post"]
+
+        def json_param():
+            try:
+                raw = post().get("json", get().get("json"))
+                post_json = json_codec.loads(raw, object_hook=object_hook) if raw is not None else {}
+            except Exception:
+                post_json = {}
+            return {'json': post_json} if isinstance(post_json, list) else post_json
+
+        if streaming:
+            return cls(lambda: http.cookies, kwargs, get, environ=http.environ)
+        return cls(lambda: http.cookies, kwargs, get, post, json_param, environ=http.environ)
+
+    def _source(self, index):
+        """ Возвращает источник параметров, при необходимости вычисляя его """
+        source = self._sources[index]
+        if callable(source):
+            source = source()
+            if not isinstance(source, Mapping):
+                raise TypeError("request cannot be updated by value of class %s" % source.__class__.__name__)
+            self._sources[index] = source
+        return source
+
+    def _lookup(self, key):
+        """ Ищет параметр в порядке убывания приоритета. Возвращает пару (найден ли параметр, значение) """
+        if key in self._request:
+            return True, self._request[key]
+        if key in ("error_response", "error_response2"):
+            # Фабрики ответа об ошибке не могут быть подменены параметрами клиента
+            factory = self._error_factory(key)
+            return factory is not None, factory
+        for index in range(len(self._sources) - 1, -1, -1):
+            source = self._source(index)
+            if key in source:
+                return True, source[key]
+        return False, None
+
+    def _error_factory(self, key):
+        """
+        Строит фабрику ответа об ошибке (только когда она действительно понадобилась):
+        error_response - с применением apply_to_each_response контроллера, error_response2 - без него
+        (используется, если ошибка возникла до или во время setup контроллера)
+        """
+        if key == "error_response" and self.error_context is not None:
+            controller, app, user, host, domain_data = self.error_context
+            return lambda error_data: controller.apply_to_each_response(
+                response=ControllerMethodResponseWithTemplate(error_data, controller.error_template),
+                app=app, request=self, user=user, host=host, **domain_data)
+        if key == "error_response2" and self.error_controller is not None:
+            controller = self.error_controller
+            return lambda error_data: ControllerMethodResponseWithTemplate(error_data, controller.error_template)
+        return None
+
+    def get(self, key, *args, **kwargs):
+        """
         Возвращает значение параметра запроса по его имени
         @param key: Требуемый параметр
         @param default: Значение, используемое поумолчанию, если значения для key не предоставлено
@@ -406,8 +1728,8 @@ class Request(object):
         default = args[0] if len(args) > 0 else kwargs.get("default")
         cast_type = args[1] if len(args) > 1 else kwargs.get("cast_type")
 
-        if key in self._request.keys():
-            value = self._request.get(key)
+        found, value = self._lookup(key)
+        if found:
             try:
                 return cast_type(value) if cast_type is not None else value
             except ValueError:
@@ -431,6 +1753,19 @@ class Request(object):
         """
         self._request.update({key: value})
 
+    def copy(self):
+        """
+        Возвращает независимую копию запроса с общими environ и response
+        """
+        request = Request(environ=self.environ)
+        request.response = self.response
+        request._sources = [self._source(index) for index in range(len(self._sources))]
+        request._request = dict(self._request)
+        request._stream = self.stream
+        request.profiler = self.profiler
+        request.codec = self.codec
+        return request
+
     def update(self, other: dict):
         """
         Обновляет запрос данными из словаря
@@ -440,6 +1775,15 @@ class Request(object):
         else:
             raise TypeError("request cannot be updated by value of class %s" % other.__class__.__name__)
 
+    @property
+    def stream(self) -> RequestStream:
+        """
+        Потоковый доступ к телу запроса (см. RequestStream)
+        """
+        if self._stream is None:
+            self._stream = RequestStream(self.environ)
+        return self._stream
+
     def type(self):
         """
         Определяет тип запроса
@@ -456,37 +1800,46 @@ class Request(object):
         else:
             return self.Types.STATIC
 
+    @property
+    def _http(self) -> bottle.BaseRequest:
+        """ Запрос bottle для environ этого запроса (без environ - текущий запрос bottle) """
+        return bottle.BaseRequest(self.environ) if self.environ else bottle.request
+
     @property
     def method(self):
-        return bottle.request.method
+        return self._http.method
 
     @property
     def headers(self):
-        return dict(bottle.request.headers)
+        return dict(self._http.headers)
 
     @property
     def url(self):
-        return bottle.request.url
+        return self._http.url
 
     @property
     def host(self):
-        return bottle.request.environ.get("HTTP_HOST")
+        return self._http.environ.get("HTTP_HOST")
 
     @property
     def path(self):
-        return bottle.request.path
+        return self._http.path
 
     @property
     def cookies(self):
-        return dict(bottle.request.cookies)
+        return dict(self._http.cookies)
 
     @property
     def remote_ip(self):
-        return bottle.request.remote_addr
+        return self._http.remote_addr
 
     def items(self):
+        merged = {}
+        for index in range(len(self._sources)):
+            merged.update(self._source(index))
+        merged.update(self._request)
         return {
-            key: value for key, value in self._request.items()
+            key: value for key, value in merged.items()
             if key not in ["error_response", "error_response2"]
         }.items()
 
@@ -500,67 +1853,339 @@ class Response(object):
     delete_cookie = bottle.response.delete_cookie
 
 
+class StreamingResponse(object):
+    """ Потоковый ответ действия контроллера
+
+    Элементы кодируются и отправляются по мере получения (без Content-Length, т.е. chunked transfer encoding),
+    поэтому первые байты большой выгрузки уходят клиенту сразу. Действие может вернуть StreamingResponse
+    или просто генератор (итератор) - он отправляется как JSON-массив
+    """
+
+    """ JSON-массив """
+    JSON = "json"
+    """ По одному JSON-документу в строке """
+    NDJSON = "ndjson"
+    """ Элементы (bytes или str) отправляются как есть """
+    RAW = "raw"
+
+    content_types = {JSON: "application/json", NDJSON: "application/x-ndjson", RAW: "text/html; charset=UTF-8"}
+
+    """ Размер, до которого закодированные элементы накапливаются перед отправкой, байт """
+    buffer_size = 64 * 1024
+
+    def __init__(self, items, format: str=JSON, content_type: str=None):
+        """
+        :param items: итерируемый объект с элементами ответа
+        :param format: формат ответа: JSON, NDJSON или RAW
+        :param content_type: Content-Type ответа, по умолчанию определяется форматом
+        """
+        if format not in self.content_types:
+            raise ValueError("unknown streaming format '%s'" % format)
+        self.items = items
+        self.format = format
+        self.content_type = content_type or self.content_types[format]
+        """ Функция конвертации каждого элемента (устанавливается RequestPipe, см. output converters приложения) """
+        self.converter = None
+        """ Функция, возвращающая последний элемент ответа по исключению, возникшему после начала отправки.
+        None - исключение пробрасывается серверу (ответ обрывается) """
+        self.on_error = None
+        self._iterator = None
+        self._first = []
+
+    @classmethod
+    def of(cls, result):
+        """ Возвращает потоковый ответ для результата действия или None, если результат не потоковый """
+        if isinstance(result, cls):
+            return result
+        if isinstance(result, Iterator):
+            return cls(result)
+        return None
+
+    def prime(self):
+        """
+        Получает первый элемент заранее, чтобы исключения, возникшие до начала отправки,
+        обрабатывались как обычно (с кодом ответа и форматом ошибок приложения)
+        """
+        if self._iterator is None:
+            self._iterator = iter(self.items)
+            self._first = [self._convert(item) for item in self._take_first()]
+        return self
+
+    def _take_first(self):
+        for item in self._iterator:
+            return [item]
+        return []
+
+    def _convert(self, item):
+        return self.converter(item) if self.converter is not None else item
+
+    def _encode(self, item) -> bytes:
+        if self.format == self.RAW:
+            return item if isinstance(item, (bytes, bytearray)) else str(item).encode()
+        data = json_codec.dumps(item).encode()
+        return data + b"\n" if self.format == self.NDJSON else data
+
+    def _converted(self):
+        """ Сконвертированные элементы; исключение после начала отправки превращается в последний элемент """
+        self.prime()
+        yield from self._first
+        try:
+            for item in self._iterator:
+                yield self._convert(item)
+        except Exception as err:
+            if self.on_error is None or self.format == self.RAW:
+                raise
+            yield self.on_error(err)
+
+    def __iter__(self):
+        """ Закодированные порции ответа (bytes); первая порция отправляется без накопления """
+        opening, separator, closing = (b"[", b",", b"]") if self.format == self.JSON else (b"", b"", b"")
+        buffer, size, first = [opening], 0, True
+        for item in self._converted():
+            data = self._encode(item)
+            if not first:
+                buffer.append(separator)
+            buffer.append(data)
+            size += len(data)
+            if first or size >= self.buffer_size:
+                yield b"".join(buffer)
+                buffer, size = [], 0
+            first = False
+        buffer.append(closing)
+        data = b"".join(buffer)
+        if data:
+            yield data
+
+
+class RequestContext(object):
+    """ Перенос thread-local контекста bottle (request/response) текущего запроса в потоки пула
+
+    Заголовки ответа, добавленные в других потоках, попадают в ответ текущего запроса, cookies и код ответа -
+    после gather() (или merge())
+    """
+
+    def __init__(self, environ: dict=None, response: bottle.BaseResponse=None):
+        """
+        :param environ: WSGI environ запроса, по умолчанию - текущего запроса bottle
+        :param response: ответ запроса, по умолчанию - текущий ответ bottle
+        """
+        self.environ = bottle.request.environ if environ is None else environ
+        self.response = bottle.response if response is None else response
+        self.headers = self.response._headers
+        self.cookies = []
+        self.status = None
+
+    def run(self, fn, *args, **kwargs):
+        """ Выполняет fn в текущем (рабочем) потоке в контексте исходного запроса """
+        bottle.request.bind(self.environ)
+        bottle.response.bind()
+        bottle.response._headers = self.headers
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if bottle.response._cookies:
+                self.cookies.append(bottle.response._cookies)
+            if bottle.response.status_code != 200:
+                self.status = bottle.response.status_line
+
+    def gather(self, futures) -> list:
+        """ Дожидается результатов в исходном потоке и переносит установленные cookies в ответ """
+        results = [future.result() for future in futures]
+        self.merge()
+        return results
+
+    def merge(self):
+        """ Переносит cookies и код ответа, установленные в других потоках, в ответ запроса """
+        for cookies in self.cookies:
+            if not self.response._cookies:
+                from http.cookies import SimpleCookie
+                self.response._cookies = SimpleCookie()
+            self.response._cookies.update(cookies)
+        self.cookies = []
+        if self.status is not None:
+            self.response.status = self.status
+            self.status = None
+
+
 class RequestPipe(metaclass=ABCMeta):
     def process(self, controller, app, request, user, host):
         try:
-            result = controller.process(app, request, user, host)
-            if isinstance(result, ControllerMethodResponseWithTemplate):
+            return self.convert(controller.process(app, request, user, host), app, request)
+        except Exception as err:
+            return self.error(err, app, request)
+
+    async def process_async(self, controller, app, request, user, host):
+        """ Асинхронная обработка запроса (см. Controller.process_async) """
+        try:
+            return self.convert(await controller.process_async(app, request, user, host), app, request)
+        except Exception as err:
+            return self.error(err, app, request)
+
+    def convert(self, result, app, request):
+        """ Конвертирует результат контроллера в ответ (см. output converters приложения) """
+        with request.profiler.phase("convert"):
+            stream = StreamingResponse.of(
+                result.data if isinstance(result, ControllerMethodResponseWithTemplate) else result
+            )
+            if stream is not None:
+                result = self.stream(stream, result, app, request)
+            elif isinstance(result, ControllerMethodResponseWithTemplate):
                 result = app.static_output_converter(result) \
                     if request.type() == request.Types.STATIC else app.ajax_output_converter(result.data)
             elif request.type() != request.Types.STATIC:
                 result = app.ajax_output_converter(result)
-        except Exception as err:
-            if isinstance(err, bottle.HTTPResponse):
-                raise err
-            else:
-                app.log(err)
-                try:
-                    result = app.static_output_converter(request.get("error_response")(app.ajax_output_converter(err))) \
-                        if request.type() == request.Types.STATIC else app.ajax_output_converter(err)
-                except:
-                    result = app.static_output_converter(request.get("error_response2")(app.ajax_output_converter(err))) \
-                        if request.type() == request.Types.STATIC else app.ajax_output_converter(err)
         return result
 
+    @staticmethod
+    def error(err, app, request):
+        """ Превращает исключение в ответ с ошибкой (HTTPResponse, например, редирект, пробрасывается дальше) """
+        if isinstance(err, bottle.HTTPResponse):
+            raise err
+        app.log(err)
+        request.exception = err
+        try:
+            return app.static_output_converter(request.get("error_response")(app.ajax_output_converter(err))) \
+                if request.type() == request.Types.STATIC else app.ajax_output_converter(err)
+        except:
+            return app.static_output_converter(request.get("error_response2")(app.ajax_output_converter(err))) \
+                if request.type() == request.Types.STATIC else app.ajax_output_converter(err)
+
+    @staticmethod
+    def stream(stream: StreamingResponse, result, app, request) -> StreamingResponse:
+        """
+        Настраивает конвертацию элементов потокового ответа так же, как для обычных ответов:
+        при ajax-запросах каждый элемент проходит через ajax_output_converter, при статических загрузках
+        с шаблоном - через static_output_converter (ответ отправляется как есть, фрагмент за фрагментом)
+        """
+        if request.type() != request.Types.STATIC:
+            stream.converter = app.ajax_output_converter
+
+            def on_error(err):
+                app.log(err)
+                return app.ajax_output_converter(err)
+
+            stream.on_error = on_error
+        elif isinstance(result, ControllerMethodResponseWithTemplate):
+            stream.converter = lambda item: app.static_output_converter(
+                ControllerMethodResponseWithTemplate(item, result.template)
+            )
+            stream.format = StreamingResponse.RAW
+            stream.content_type = StreamingResponse.content_types[StreamingResponse.RAW]
+        return stream.prime()
+
 
 class JsonRpcRequestPipe(RequestPipe):
     """
     Реализация обработки JSON RPC запроса
     """
 
+    def __init__(self, executor=None):
+        """
+        :param executor: Пул (concurrent.futures.Executor) для параллельного выполнения вызовов пачки.
+                         Каждый вызов получает собственную копию запроса
+        """
+        self.executor = executor
+
     def process(self, controller: Controller, app: Application, request, user, host):
-        def wrapper(method, params):
+        def wrapper(method, params, call_request=request):
             if isinstance(params, dict):
-                request.update(params)
+                call_request.update(params)
+
+            call_request.set('params', params)
+            call_request.set('action', method)
+            result = controller.process(app, call_request, user, host)
+            # Ответ JSON-RPC отправляется целиком, поэтому потоковый результат собирается в список
+            stream = StreamingResponse.of(result)
+            return list(stream.items) if stream is not None else result
 
-            request.set('params', params)
-            request.set('action', method)
-            return controller.process(app, request, user, host)
+        def isolated_wrapper(method, params):
+            return wrapper(method, params, request.copy())
 
         try:
-            json_data = json.loads(request.get("q"))
+            json_data = JsonRpcRequestPipe.decode(request.get("q"))
 
             if isinstance(json_data, dict):
                 json_data = [json_data]
 
-            if isinstance(json_data, list) and len(json_data):
+            if isinstance(json_data, list) and len(json_data) > 1 and self.executor is not None:
+                context = RequestContext()
+                futures = [
+                    self.executor.submit(context.run, JsonRpcRequestPipe.response, j, isolated_wrapper)
+                    for j in json_data
+                ]
+                response = lambda: list(filter(None, context.gather(futures)))
+            elif isinstance(json_data, list) and len(json_data):
                 response = lambda: list(filter(None, [JsonRpcRequestPipe.response(j, wrapper) for j in json_data]))
             else:
                 response = JsonRpcRequestPipe.invalid_request
         except Exception:
             response = JsonRpcRequestPipe.parse_error
 
-        request.response.add_header("Content-Type", "application/json")
-        return JsonRpcRequestPipe.converter(response)
+        return JsonRpcRequestPipe.converter(response, request)
+
+    async def process_async(self, controller: Controller, app: Application, request, user, host):
+        """ Асинхронная обработка (AsgiApplication): вызовы пачки выполняются одновременно,
+        каждый - с собственной копией запроса
+        """
+        import asyncio
+
+        async def wrapper(method, params, call_request=request):
+            if isinstance(params, dict):
+                call_request.update(params)
+
+            call_request.set('params', params)
+            call_request.set('action', method)
+            if controller.asynchronous():
+                result = await controller.process_async(app, call_request, user, host)
+            else:
+                result = await app.run_sync(call_request, controller.process, app, call_request, user, host)
+            stream = StreamingResponse.of(result)
+            return list(stream.items) if stream is not None else result
+
+        def isolated_wrapper(method, params):
+            return wrapper(method, params, request.copy())
+
+        try:
+            json_data = JsonRpcRequestPipe.decode(request.get("q"))
+
+            if isinstance(json_data, dict):
+                json_data = [json_data]
+
+            if isinstance(json_data, list) and len(json_data) > 1:
+                results = await asyncio.gather(
+                    *[JsonRpcRequestPipe.response_async(j, isolated_wrapper) for j in json_data]
+                )
+                response = lambda: list(filter(None, results))
+            elif isinstance(json_data, list) and len(json_data):
+                result = await JsonRpcRequestPipe.response_async(json_data[0], wrapper)
+                response = lambda: list(filter(None, [result]))
+            else:
+                response = JsonRpcRequestPipe.invalid_request
+        except Exception:
+            response = JsonRpcRequestPipe.parse_error
+
+        return JsonRpcRequestPipe.converter(response, request)
 
     @staticmethod
-    def converter(cb):
+    def decode(q):
+        """ Вызовы из параметра q: строка JSON или уже декодированные данные (тело в MessagePack или CBOR) """
+        return q if isinstance(q, (dict, list)) else json_codec.loads(q)
+
+    @staticmethod
+    def converter(cb, request=None):
+        """ Кодирует ответ в формат, выбранный для запроса (см. Application.response_codec), по умолчанию - JSON """
+        codec = request.codec if request is not None else None
+        if request is not None:
+            request.response.add_header("Content-Type", "application/json" if codec is None else codec.content_type)
+            if codec is not None:
+                request.response.add_header("Vary", "Accept")
+        dumps = json_codec.dumps if codec is None else codec.dumps
         result = cb()
         if result:
             if isinstance(result, list) and len(result) == 1:
-                return json.dumps(result.pop())
+                return dumps(result.pop())
             else:
-                return json.dumps(result)
+                return dumps(result)
 
         return ''
 
@@ -605,29 +2230,59 @@ class JsonRpcRequestPipe(RequestPipe):
     @staticmethod
     def response(json, cb):
         """ Отвечает на один RPC запрос """
+        error, call = JsonRpcRequestPipe.parse(json)
+        if call is None:
+            return error
+        _id, method, params = call
+
+        # noinspection PyBroadException
+        try:
+            return JsonRpcRequestPipe.success(cb(method, params), _id) if _id else None
+        except BaseException as err:
+            return JsonRpcRequestPipe.failure(err, _id)
+
+    @staticmethod
+    async def response_async(json, cb):
+        """ Отвечает на один RPC запрос, cb - корутинная функция """
+        error, call = JsonRpcRequestPipe.parse(json)
+        if call is None:
+            return error
+        _id, method, params = call
+
+        try:
+            return JsonRpcRequestPipe.success(await cb(method, params), _id) if _id else None
+        except Exception as err:
+            return JsonRpcRequestPipe.failure(err, _id)
+
+    @staticmethod
+    def parse(json):
+        """ Проверяет RPC запрос. Возвращает (None, (id, method, params)) для корректного запроса
+        или (ответ об ошибке, None) - для некорректного (для уведомлений ответ - None)
+        """
         if not isinstance(json, dict) or len(json) == 0:
-            return JsonRpcRequestPipe.invalid_request()
+            return JsonRpcRequestPipe.invalid_request(), None
 
         _id, params, method, version = json.get('id'), json.get('params', []), json.get('method'), json.get('jsonrpc')
 
         if not version:
-            return JsonRpcRequestPipe.invalid_request(_id) if _id else None
+            return (JsonRpcRequestPipe.invalid_request(_id) if _id else None), None
 
         if not isinstance(method, str):
-            return JsonRpcRequestPipe.invalid_request(_id) if _id else None
+            return (JsonRpcRequestPipe.invalid_request(_id) if _id else None), None
 
         if not isinstance(params, (dict, list)):
-            return JsonRpcRequestPipe.invalid_params(_id) if _id else None
+            return (JsonRpcRequestPipe.invalid_params(_id) if _id else None), None
 
-        # noinspection PyBroadException
-        try:
-            return JsonRpcRequestPipe.success(cb(method, params), _id) if _id else None
-        except (Request.RequiredArgumentIsMissing, Request.ArgumentTypeError):
-            return JsonRpcRequestPipe.invalid_params(_id) if _id else None
-        except NotImplementedError:
-            return JsonRpcRequestPipe.method_not_found(_id) if _id else None
-        except:
-            return JsonRpcRequestPipe.server_error(0, _id) if _id else None
+        return None, (_id, method, params)
+
+    @staticmethod
+    def failure(err: BaseException, id):
+        """ Ответ на вызов, завершившийся исключением """
+        if isinstance(err, (Request.RequiredArgumentIsMissing, Request.ArgumentTypeError)):
+            return JsonRpcRequestPipe.invalid_params(id)
+        if isinstance(err, NotImplementedError):
+            return JsonRpcRequestPipe.method_not_found(id)
+        return JsonRpcRequestPipe.server_error(0, id)
 
 
 def template(template_name, if_true=None, if_exc=None):
@@ -639,49 +2294,273 @@ def template(template_name, if_true=None, if_exc=None):
     """
 
     def decorator(func):
+        def select(data):
+            # Если результат уже декорирован просто возвращаем его
+            # (очевидно, один из нескольких декораторов уже успешно отработал)
+            if isinstance(data, ControllerMethodResponseWithTemplate):
+                return data
+
+            # Если передана функция проверки результатов выполнения метода контроллера,
+            # то чтобы выбрать текуший template_name необходимо чтобы эта функция проверки вернула True
+            if if_true:
+                if if_true(data):
+                    return ControllerMethodResponseWithTemplate(data, template_name)
+                else:
+                    # Если функция проверки не возвращает True,
+                    # возвращаем только результат выполнения контроллера для других декораторов
+                    return data
+            elif if_exc:
+                # Если передано условия по типу исключения, но оно, очевидно, не возникло,
+                # возвращаем только результат выполнения контроллера для других декораторов
+                return data
+            else:
+                # Если не передано ничего - значит это дефолтный декоратор.
+                # Декорируем и возвращаем в виде ControllerMethodResponseWithTemplate,
+                # тем самым прерывая цепочку декорирования
+                return ControllerMethodResponseWithTemplate(data, template_name)
+
+        def on_error(err):
+            # Если возникло исключение и при декорировании этот тип исключения был описан, то
+            # # Декорируем и возвращаем в виде ControllerMethodResponseWithTemplate,
+            # тем самым прерывая цепочку декорирования и всплытия исключения
+            if if_exc and isinstance(err, if_exc):
+                return ControllerMethodResponseWithTemplate(
+                    {"name": re.search("'(.+)'", str(err.__class__)).group(1), "message": str(err)}, template_name
+                )
+            # В противном случае продолжаем поднимать исключение вверх по стеку
+            raise err
+
+        if inspect.iscoroutinefunction(func):
+            # Асинхронное действие (см. AsgiApplication): шаблон выбирается по результату корутины
+            async def wrapped_async(*args, **kwargs):
+                try:
+                    return select(await func(*args, **kwargs))
+                except Exception as err:
+                    return on_error(err)
+
+            return wrapped_async
+
         def wrapped(*args, **kwargs):
             try:
                 # Получаем данные контроллера или результат выполнения предыдущего в цепочке декоратора
-                data = func(*args, **kwargs)
-                # Если результат уже декорирован просто возвращаем его
-                # (очевидно, один из нескольких декораторов уже успешно отработал)
-                if isinstance(data, ControllerMethodResponseWithTemplate):
-                    return data
-
-                # Если передана функция проверки результатов выполнения метода контроллера,
-                # то чтобы выбрать текуший template_name необходимо чтобы эта функция проверки вернула True
-                if if_true:
-                    if if_true(data):
-                        return ControllerMethodResponseWithTemplate(data, template_name)
-                    else:
-                        # Если функция проверки не возвращает True,
-                        # возвращаем только результат выполнения контроллера для других декораторов
-                        return data
-                elif if_exc:
-                    # Если передано условия по типу исключения, но оно, очевидно, не возникло,
-                    # возвращаем только результат выполнения контроллера для других декораторов
-                    return data
-                else:
-                    # Если не передано ничего - значит это дефолтный декоратор.
-                    # Декорируем и возвращаем в виде ControllerMethodResponseWithTemplate,
-                    # тем самым прерывая цепочку декорирования
-                    return ControllerMethodResponseWithTemplate(data, template_name)
+                return select(func(*args, **kwargs))
             except Exception as err:
-                # Если возникло исключение и при декорировании этот тип исключения был описан, то
-                # # Декорируем и возвращаем в виде ControllerMethodResponseWithTemplate,
-                # тем самым прерывая цепочку декорирования и всплытия исключения
-                if if_exc and isinstance(err, if_exc):
-                    return ControllerMethodResponseWithTemplate(
-                        {"name": re.search("'(.+)'", str(err.__class__)).group(1), "message": str(err)}, template_name
-                    )
-                # В противном случае продолжаем поднимать исключение вверх по стеку
-                raise err
+                return on_error(err)
 
         return wrapped
 
     return decorator
 
 
+class JsonCodec(object):
+    """ Единая точка кодирования и декодирования JSON
+
+    Автоматически использует ускоренную библиотеку (orjson, ujson), если она установлена, иначе - стандартный json.
+    При использовании стандартного json вывод не отличается от json.dumps(obj, default=json_dumps_handler).
+    Ускоренные библиотеки выводят JSON без пробелов между элементами и не экранируют не-ASCII символы.
+    Объекты, которые ускоренная библиотека сериализовать не может (например, словари с нестроковыми ключами),
+    сериализуются стандартным json.
+    """
+    backends = ("orjson", "ujson", "json")
+
+    def __init__(self, backend: str=None):
+        """
+        :param backend: Имя библиотеки (orjson, ujson, json); по умолчанию - первая доступная из backends
+        """
+        self.backend = None
+        self._dumps = self._loads = None
+        self.use(backend)
+
+    def use(self, backend: str=None):
+        """ Переключает кодек на указанную библиотеку """
+        for name in ([backend] if backend else self.backends):
+            if name not in self.backends:
+                raise ValueError("unknown json backend '%s', expected one of %s" % (name, ", ".join(self.backends)))
+            try:
+                module = __import__(name)
+            except ImportError:
+                if backend:
+                    raise
+                continue
+            self.backend = name
+            self._dumps, self._loads = getattr(self, "_%s_dumps" % name)(module), module.loads
+            return self
+
+    def dumps(self, obj, default=None) -> str:
+        """ Сериализует объект в JSON-строку
+        :param default: Обработчик несериализуемых объектов (по умолчанию json_dumps_handler)
+        """
+        default = default or json_dumps_handler
+        if self._dumps is not None:
+            try:
+                return self._dumps(obj, default)
+            except (TypeError, OverflowError):
+                pass
+        return json.dumps(obj, default=default)
+
+    def loads(self, s, object_hook=None):
+        """ Десериализует JSON из строки или bytes
+        :param object_hook: Функция, применяемая к каждому декодированному объекту (как в json.loads)
+        """
+        if self.backend == "json":
+            return json.loads(s, object_hook=object_hook)
+        try:
+            result = self._loads(s)
+        except ValueError:
+            # NaN, Infinity, числа вне 64 бит и т.п. ускоренные библиотеки не принимают - их разбирает json
+            return json.loads(s, object_hook=object_hook)
+        return self._apply_object_hook(result, object_hook) if object_hook else result
+
+    @classmethod
+    def _apply_object_hook(cls, obj, object_hook):
+        """ Применяет object_hook к вложенным объектам снизу вверх, в том же порядке, что и json.loads """
+        if isinstance(obj, dict):
+            for key, value in obj.items():
+                if isinstance(value, (dict, list)):
+                    obj[key] = cls._apply_object_hook(value, object_hook)
+            return object_hook(obj)
+        if isinstance(obj, list):
+            for i, value in enumerate(obj):
+                if isinstance(value, (dict, list)):
+                    obj[i] = cls._apply_object_hook(value, object_hook)
+        return obj
+
+    @staticmethod
+    def _orjson_dumps(orjson):
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        return lambda obj, default: orjson.dumps(obj, default=default, option=option).decode("utf-8")
+
+    @staticmethod
+    def _ujson_dumps(ujson):
+        return lambda obj, default: ujson.dumps(obj, default=default, ensure_ascii=False, escape_forward_slashes=False)
+
+    @staticmethod
+    def _json_dumps(_):
+        return None
+
+
+""" Кодек, используемый envi. Библиотеку можно выбрать переменной окружения ENVI_JSON_BACKEND """
+json_codec = JsonCodec(os.environ.get("ENVI_JSON_BACKEND"))
+
+
+class BinaryCodec(object):
+    """ Кодирование данных в двоичные форматы MessagePack (библиотека msgpack) и CBOR (библиотека cbor2)
+
+    Библиотеки необязательны: BinaryCodec.get возвращает None, если библиотека формата не установлена.
+    Даты кодируются средствами формата (timestamp MessagePack, теги дат CBOR), а не строками ctime(): даты без
+    часового пояса считаются датами UTC, при декодировании даты приводятся к UTC без часового пояса.
+    Время (time) кодируется как дата 1 января 1970 года (как в JSON). Некорректные данные - ValueError (как у json)
+    """
+    libraries = {"msgpack": "msgpack", "cbor": "cbor2"}
+    content_types = {"msgpack": "application/msgpack", "cbor": "application/cbor"}
+
+    _instances = {}
+
+    def __init__(self, name: str):
+        """
+        :param name: формат: msgpack или cbor (ImportError, если библиотека не установлена)
+        """
+        if name not in self.libraries:
+            raise ValueError("unknown binary format '%s', expected one of %s" % (name, ", ".join(self.libraries)))
+        self.name = name
+        self.content_type = self.content_types[name]
+        self.module = __import__(self.libraries[name])
+
+    @classmethod
+    def get(cls, name: str):
+        """ Кодек формата или None, если формат неизвестен или библиотека не установлена """
+        if name not in cls._instances:
+            try:
+                cls._instances[name] = cls(name)
+            except (ImportError, ValueError):
+                cls._instances[name] = None
+        return cls._instances[name]
+
+    @classmethod
+    def for_content_type(cls, content_type: str):
+        """ Кодек по Content-Type (параметры вроде charset игнорируются); None - не двоичный формат """
+        media_type = content_type.split(";", 1)[0].strip().lower()
+        for name, value in cls.content_types.items():
+            if value == media_type:
+                return cls.get(name)
+        return None
+
+    def dumps(self, obj) -> bytes:
+        if self.name == "msgpack":
+            return self.module.packb(obj, default=self._msgpack_default, use_bin_type=True)
+        return self.module.dumps(obj, timezone=timezone.utc, datetime_as_timestamp=True, encoders=_CBOR_ENCODERS)
+
+    def loads(self, data, object_hook=None):
+        """ Декодирует данные; object_hook применяется к каждому словарю (как в json.loads) """
+        try:
+            if self.name == "msgpack":
+                result = self.module.unpackb(data, raw=False, strict_map_key=False, timestamp=3)
+            else:
+                result = self.module.loads(data)
+        except Exception as err:
+            raise ValueError("invalid %s data: %s" % (self.name, err))
+        return self._revive(result, object_hook)
+
+    def array(self, items: list) -> bytes:
+        """ Массив из уже закодированных элементов (без их повторного кодирования) """
+        size = len(items)
+        if self.name == "msgpack":
+            if size < 16:
+                header = bytes((0x90 | size,))
+            elif size < 0x10000:
+                header = b"\xdc" + size.to_bytes(2, "big")
+            else:
+                header = b"\xdd" + size.to_bytes(4, "big")
+        elif size < 24:
+            header = bytes((0x80 | size,))
+        elif size < 0x100:
+            header = b"\x98" + size.to_bytes(1, "big")
+        elif size < 0x10000:
+            header = b"\x99" + size.to_bytes(2, "big")
+        else:
+            header = b"\x9a" + size.to_bytes(4, "big")
+        return header + b"".join(items)
+
+    def _msgpack_default(self, obj):
+        if isinstance(obj, (datetime, date, time)):
+            return self.module.Timestamp.from_datetime(_utc_datetime(obj))
+        raise TypeError("Object of type %s is not msgpack serializable" % type(obj).__name__)
+
+    @classmethod
+    def _revive(cls, obj, object_hook):
+        """ Приводит даты к UTC без часового пояса и применяет object_hook к словарям снизу вверх """
+        if isinstance(obj, dict):
+            for key, value in obj.items():
+                if isinstance(value, (dict, list, datetime)):
+                    obj[key] = cls._revive(value, object_hook)
+            return object_hook(obj) if object_hook else obj
+        if isinstance(obj, list):
+            for i, value in enumerate(obj):
+                if isinstance(value, (dict, list, datetime)):
+                    obj[i] = cls._revive(value, object_hook)
+            return obj
+        if isinstance(obj, datetime) and obj.tzinfo is not None:
+            return obj.astimezone(timezone.utc).replace(tzinfo=None)
+        return obj
+
+
+def _utc_datetime(obj) -> datetime:
+    """ Дата для двоичных форматов: с часовым поясом (без пояса - UTC); time - 1 января 1970 года, date - полночь """
+    if isinstance(obj, time):
+        obj = datetime(1970, 1, 1, obj.hour, obj.minute, obj.second, obj.microsecond)
+    elif not isinstance(obj, datetime):
+        obj = datetime(obj.year, obj.month, obj.day)
+    return obj if obj.tzinfo is not None else obj.replace(tzinfo=timezone.utc)
+
+
+def _cbor_time(encoder, obj):
+    encoder.encode(_utc_datetime(obj))
+
+
+""" cbor2 кодирует datetime и date сам, time - нет """
+_CBOR_ENCODERS = {time: _cbor_time}
+
+
 def json_dumps_handler(obj):
     """ json dumps handler """
     if isinstance(obj, time):
@@ -692,17 +2571,60 @@ def json_dumps_handler(obj):
     return None
 
 
+_ctime_re = re.compile(r"\w\w\w[\s]+\w\w\w[\s]+\d[\d]*[\s]+\d\d:\d\d:\d\d[\s]+\d\d\d\d")
+""" Минимальная длина строки, которая может содержать дату в формате ctime(): 'Mon Jan 1 00:00:00 2016' """
+_CTIME_MIN_LENGTH = 23
+
+
+_CTIME_DAYS = frozenset(("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"))
+_CTIME_MONTHS = {name: i for i, name in enumerate(
+    ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"), 1)}
+
+
+def _parse_ctime(value):
+    """ Разбирает дату в формате ctime(); строки в нестандартном виде разбираются через strptime """
+    parts = value.split()
+    if len(parts) == 5 and parts[0] in _CTIME_DAYS and parts[1] in _CTIME_MONTHS and len(parts[2]) <= 2 \
+            and len(parts[3]) == 8 and parts[3][2] == parts[3][5] == ":" and len(parts[4]) == 4:
+        try:
+            return datetime(int(parts[4]), _CTIME_MONTHS[parts[1]], int(parts[2]),
+                            int(parts[3][0:2]), int(parts[3][3:5]), int(parts[3][6:8]))
+        except ValueError:
+            pass
+    return datetime.strptime(value, "%a %b %d %H:%M:%S %Y")
+
+
 def json_loads_handler(data):
     """ json loads handler """
     for k, v in data.items():
-        if isinstance(v, str) and re.search("\w\w\w[\s]+\w\w\w[\s]+\d[\d]*[\s]+\d\d:\d\d:\d\d[\s]+\d\d\d\d", v):
-            try:
-                data[k] = datetime.strptime(v, "%a %b %d %H:%M:%S %Y")
-            except Exception as err:
-                raise err
+        # Дешевые проверки отсекают подавляющее большинство строк до применения регулярного выражения
+        if isinstance(v, str) and len(v) >= _CTIME_MIN_LENGTH and ":" in v and _ctime_re.search(v):
+            data[k] = _parse_ctime(v)
     return data
 
 
+def datetime_hook(revive_datetimes=True):
+    """ Возвращает object_hook для декодирования JSON в соответствии с настройкой восстановления дат
+    :param revive_datetimes: True - даты восстанавливаются во всех ключах, False/None - не восстанавливаются,
+                             набор ключей - восстанавливаются только в перечисленных ключах
+    """
+    if revive_datetimes is True:
+        return json_loads_handler
+    if not revive_datetimes:
+        return None
+
+    keys = frozenset([revive_datetimes] if isinstance(revive_datetimes, str) else revive_datetimes)
+
+    def hook(data):
+        for k in keys.intersection(data):
+            v = data[k]
+            if isinstance(v, str) and len(v) >= _CTIME_MIN_LENGTH and ":" in v and _ctime_re.search(v):
+                data[k] = _parse_ctime(v)
+        return data
+
+    return hook
+
+
 def response_format(func):
     """ Декоратор для обработки любых исключений возникающих при работе сервиса
     :param func:
@@ -713,13 +2635,13 @@ def response_format(func):
         :param kwargs:
         """
         try:
-            return json.dumps({"result": func(*args, **kwargs)}, default=json_dumps_handler)
+            return json_codec.dumps({"result": func(*args, **kwargs)})
         except BaseServiceException as e:
-            return json.dumps({"error": {"code": e.code, "message": str(e)}}, default=json_dumps_handler)
+            return json_codec.dumps({"error": {"code": e.code, "message": str(e)}})
         except Exception as e:
             import traceback
             print(traceback.format_exc())
-            return json.dumps({"error": {"code": 0, "message": str(e)}}, default=json_dumps_handler)
+            return json_codec.dumps({"error": {"code": 0, "message": str(e)}})
     return wrapper
 
 
@@ -742,24 +2664,560 @@ class UnexpectedResultFromMicroService(BaseServiceException):
     pass
 
 
-def microservice(url: str, data: dict, target_key: str=None, headers=None):
+_MISSING = object()
+
+
+class MicroServiceClient(object):
+    """ Общий для процесса HTTP-клиент для работы с микросервисами
+
+    Держит пулы keep-alive соединений (по одному на хост), поэтому повторные вызовы microservice()
+    не открывают новое TCP-соединение, а также пул потоков для параллельных вызовов (microservice_many).
+    После fork (prefork-воркеры uwsgi) сессия и пул потоков пересоздаются автоматически,
+    чтобы дочерние процессы не делили сокеты и потоки родителя.
+    """
+    pool_connections = 10
+    pool_maxsize = 10
+    pool_block = False
+    max_retries = 0
+    max_workers = 32
+    """ Двоичный формат запросов и ответов микросервисов (msgpack или cbor, см. BinaryCodec); None - JSON.
+    Микросервис отвечает в двоичном формате, только если поддерживает его (ответ разбирается по Content-Type) """
+    format = None
+
+    _session = None
+    _executor = None
+    _pid = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, pool_connections=None, pool_maxsize=None, pool_block=None, max_retries=None,
+                  max_workers=None, format=_MISSING):
+        """ Изменяет параметры пулов соединений. Новые параметры применяются к следующей созданной сессии
+        :param pool_connections: Количество хостов, для которых хранятся пулы соединений
+        :param pool_maxsize: Максимальное количество соединений в пуле одного хоста
+        :param pool_block: Ждать ли освобождения соединения при исчерпании пула
+        :param max_retries: Количество повторных попыток при ошибках соединения
+        :param max_workers: Размер пула потоков для параллельных вызовов
+        :param format: Двоичный формат запросов и ответов (см. format)
+        """
+        if format is not _MISSING and format is not None and format not in BinaryCodec.libraries:
+            raise ValueError("unknown binary format '%s'" % format)
+        with cls._lock:
+            if pool_connections is not None:
+                cls.pool_connections = pool_connections
+            if pool_maxsize is not None:
+                cls.pool_maxsize = pool_maxsize
+            if pool_block is not None:
+                cls.pool_block = pool_block
+            if max_retries is not None:
+                cls.max_retries = max_retries
+            if max_workers is not None:
+                cls.max_workers = max_workers
+            if format is not _MISSING:
+                cls.format = format
+            cls._close()
+
+    @classmethod
+    def encode(cls, data, headers) -> tuple:
+        """ Кодирует данные запроса в формат format (если его библиотека установлена, иначе - в JSON)
+        :return: (тело запроса, заголовки с Content-Type и Accept)
+        """
+        headers = dict(headers or {})
+        codec = BinaryCodec.get(cls.format) if cls.format else None
+        if codec is None:
+            headers.setdefault("Content-Type", "application/json")
+            return json_codec.dumps(data).encode("utf-8"), headers
+        headers.setdefault("Content-Type", codec.content_type)
+        headers.setdefault("Accept", "%s, application/json;q=0.9" % codec.content_type)
+        return codec.dumps(data), headers
+
+    @classmethod
+    def session(cls):
+        """ Возвращает сессию текущего процесса, создавая ее при первом обращении или после fork """
+        session = cls._session
+        if session is not None and cls._pid == os.getpid():
+            return session
+        with cls._lock:
+            if cls._session is None or cls._pid != os.getpid():
+                import requests
+                from http.cookiejar import DefaultCookiePolicy
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                # Сессия общая для запросов разных пользователей: cookies микросервисов не сохраняются
+                session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+                adapter = HTTPAdapter(pool_connections=cls.pool_connections, pool_maxsize=cls.pool_maxsize,
+                                      max_retries=cls.max_retries, pool_block=cls.pool_block)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                cls._session, cls._executor, cls._pid = session, None, os.getpid()
+            return cls._session
+
+    @classmethod
+    def executor(cls):
+        """ Возвращает пул потоков текущего процесса для параллельных вызовов (см. microservice_many) """
+        executor = cls._executor
+        if executor is not None and cls._pid == os.getpid():
+            return executor
+        cls.session()
+        with cls._lock:
+            if cls._executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                cls._executor = ThreadPoolExecutor(max_workers=cls.max_workers, thread_name_prefix="microservice")
+            return cls._executor
+
+    @classmethod
+    def reset(cls):
+        """ Сбрасывает сессию и пул потоков. Вызывается автоматически в дочернем процессе после fork """
+        cls._lock = threading.Lock()
+        cls._session, cls._executor, cls._pid = None, None, None
+
+    @classmethod
+    def close(cls):
+        """ Закрывает все соединения текущего процесса """
+        with cls._lock:
+            cls._close()
+
+    @classmethod
+    def _close(cls):
+        if cls._pid == os.getpid():
+            if cls._executor is not None:
+                cls._executor.shutdown(wait=False)
+            if cls._session is not None:
+                cls._session.close()
+        cls._session, cls._executor, cls._pid = None, None, None
+
+
+class AsyncMicroServiceClient(object):
+    """ Асинхронный HTTP-клиент для работы с микросервисами из цикла событий (см. microservice_async)
+
+    Запросы выполняются без потоков, поэтому одновременно ожидать ответа могут тысячи корутин. Соединения
+    keep-alive хранятся в пулах по хостам, отдельно для каждого цикла событий; одновременных соединений
+    с одним хостом - не больше max_connections
+    """
+    max_connections = 100
+    pool_maxsize = 10
+    """ Время ожидания соединения и ответа, секунды (None - без ограничения) """
+    timeout = 60
+
+    _pools = {}
+    _pid = None
+
+    @classmethod
+    def configure(cls, max_connections=None, pool_maxsize=None, timeout=_MISSING):
+        """ Изменяет параметры клиента. Новые параметры применяются к пулам, созданным после вызова
+        :param max_connections: Максимальное количество одновременных соединений с одним хостом
+        :param pool_maxsize: Максимальное количество хранимых keep-alive соединений с одним хостом
+        :param timeout: Время ожидания соединения и ответа, секунды
+        """
+        if max_connections is not None:
+            cls.max_connections = max_connections
+        if pool_maxsize is not None:
+            cls.pool_maxsize = pool_maxsize
+        if timeout is not _MISSING:
+            cls.timeout = timeout
+
+    @classmethod
+    def _pool(cls, key):
+        import asyncio
+
+        if cls._pid != os.getpid():
+            cls._pools, cls._pid = {}, os.getpid()
+        loop = asyncio.get_running_loop()
+        pools = cls._pools.get(loop)
+        if pools is None or loop.is_closed():
+            cls._pools = {other: pool for other, pool in cls._pools.items() if not other.is_closed()}
+            pools = cls._pools[loop] = {}
+        pool = pools.get(key)
+        if pool is None:
+            pool = pools[key] = (asyncio.Semaphore(cls.max_connections), [])
+        return pool
+
+    @classmethod
+    async def post(cls, url: str, body: bytes, headers: dict) -> tuple:
+        """ Выполняет POST-запрос. Возвращает (код ответа, тело ответа) """
+        status, _, content = await cls.request(url, body, headers)
+        return status, content
+
+    @classmethod
+    async def request(cls, url: str, body: bytes, headers: dict) -> tuple:
+        """ Выполняет POST-запрос. Возвращает (код ответа, заголовки ответа в нижнем регистре, тело ответа) """
+        import asyncio
+        from urllib.parse import urlsplit
+
+        parts = urlsplit(url)
+        secure = parts.scheme == "https"
+        host, port = parts.hostname, parts.port or (443 if secure else 80)
+        target = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+        head = "POST %s HTTP/1.1\r\nHost: %s\r\nContent-Length: %s\r\n%s\r\n" % (
+            target, parts.netloc, len(body), "".join("%s: %s\r\n" % item for item in headers.items())
+        )
+        request = head.encode("latin-1") + body
+
+        limit, idle = cls._pool((host, port, secure))
+        async with limit:
+            retried = False
+            while True:
+                reused = bool(idle) and not retried
+                reader, writer = idle.pop() if reused else await asyncio.wait_for(
+                    asyncio.open_connection(host, port, ssl=secure or None), cls.timeout
+                )
+                progress = {"received": False}
+                try:
+                    writer.write(request)
+                    status, response_headers, content, keep_alive = await asyncio.wait_for(
+                        cls._read(reader, progress), cls.timeout
+                    )
+                except (OSError, EOFError, asyncio.IncompleteReadError, asyncio.TimeoutError) as err:
+                    writer.close()
+                    if reused and not progress["received"] and not isinstance(err, asyncio.TimeoutError):
+                        # Сервер мог закрыть простаивающее соединение, не начав отвечать, - повторяем запрос
+                        # один раз в новом соединении. Медленный ответ (таймаут) не повторяется: POST не идемпотентен
+                        retried = True
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                if keep_alive and len(idle) < cls.pool_maxsize:
+                    idle.append((reader, writer))
+                else:
+                    writer.close()
+                return status, response_headers, content
+
+    @staticmethod
+    async def _read(reader, progress: dict=None) -> tuple:
+        """ Читает ответ. Возвращает (код ответа, заголовки, тело, можно ли переиспользовать соединение)
+        :param progress: в progress["received"] отмечается, что сервер начал отвечать
+        """
+        while True:
+            status_line = await reader.readline()
+            if not status_line:
+                raise EOFError("connection closed")
+            if progress is not None:
+                progress["received"] = True
+            version, status = status_line.split(None, 2)[:2]
+            status = int(status)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            # Промежуточные ответы (100 Continue, 103 Early Hints) пропускаются
+            if not 100 <= status < 200 or status == 101:
+                break
+        keep_alive = version == b"HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        if status in (101, 204, 304):
+            # Ответы без тела: Content-Length у них нет или он описывает тело, которое не передается
+            content = b""
+        elif headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            content = b"".join(chunks)
+        elif "content-length" in headers:
+            content = await reader.readexactly(int(headers["content-length"]))
+        else:
+            content, keep_alive = await reader.read(), False
+        return status, headers, content, keep_alive
+
+    @classmethod
+    async def close(cls):
+        """ Закрывает keep-alive соединения текущего цикла событий """
+        import asyncio
+
+        for limit, idle in cls._pools.pop(asyncio.get_running_loop(), {}).values():
+            while idle:
+                idle.pop()[1].close()
+
+    @classmethod
+    def reset(cls):
+        """ Сбрасывает пулы соединений. Вызывается автоматически в дочернем процессе после fork """
+        cls._pools, cls._pid = {}, None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=MicroServiceClient.reset)
+    os.register_at_fork(after_in_child=AsyncMicroServiceClient.reset)
+
+
+class LRUCache(object):
+    """ Потокобезопасный кеш с ограничением размера (вытеснение давно не используемых записей) и временем жизни """
+
+    def __init__(self, maxsize: int=1024, ttl: float=None):
+        """
+        :param maxsize: Максимальное количество записей
+        :param ttl: Время жизни записи в секундах (None - без ограничения)
+        """
+        from collections import OrderedDict
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Возвращает значение по ключу или default, если записи нет или она устарела """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires is None or expires > profiler_time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl: float=None):
+        """ Сохраняет значение; ttl переопределяет время жизни по умолчанию """
+        ttl = self.ttl if ttl is None else ttl
+        expires = profiler_time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key=None):
+        """ Удаляет запись по ключу или, если ключ не передан, очищает кеш целиком """
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def stats(self) -> dict:
+        """ Счетчики кеша для экспорта в метрики """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "size": len(self._data), "maxsize": self.maxsize}
+
+    def __len__(self):
+        return len(self._data)
+
+
+class MicroServiceCache(LRUCache):
+    """ Кеш ответов микросервисов для идемпотентных запросов (справочники, настройки, профили)
+
+    Ключ кеша - url, канонизированные данные запроса и target_key.
+    Закешированные результаты разделяются между вызовами - их нельзя изменять.
+    """
+
+    def __init__(self, ttl: float=60, maxsize: int=1024, cache_errors: bool=False, error_ttl: float=None):
+        """
+        :param ttl: Время жизни успешного ответа в секундах
+        :param maxsize: Максимальное количество записей
+        :param cache_errors: Кешировать ли UnexpectedResultFromMicroService (негативное кеширование)
+        :param error_ttl: Время жизни закешированной ошибки (по умолчанию совпадает с ttl)
+        """
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.cache_errors = cache_errors
+        self.error_ttl = ttl if error_ttl is None else error_ttl
+
+    @staticmethod
+    def key(url: str, data, target_key: str=None):
+        """ Формирует ключ кеша """
+        return url, json.dumps(data, sort_keys=True, separators=(",", ":"), default=json_dumps_handler), target_key
+
+    def call(self, url: str, data, target_key: str=None, headers=None, fetch=None):
+        """ Возвращает ответ из кеша или выполняет запрос к микросервису и кеширует его
+        :param fetch: Функция выполнения запроса с сигнатурой microservice (по умолчанию - запрос без кеширования)
+        """
+        key = self.key(url, data, target_key)
+        found, value = self.lookup(key)
+        if found:
+            return value
+        try:
+            result = (fetch or _microservice)(url, data, target_key, headers)
+        except UnexpectedResultFromMicroService as err:
+            self.store_error(key, err)
+            raise
+        self.store(key, result)
+        return result
+
+    def lookup(self, key):
+        """ Ищет ответ в кеше. Возвращает пару (найден ли ответ, ответ); закешированная ошибка поднимается заново """
+        item = self.get(key, _MISSING)
+        if item is _MISSING:
+            return False, None
+        is_error, value = item
+        if is_error:
+            raise UnexpectedResultFromMicroService(value.message, value.code)
+        return True, value
+
+    def store(self, key, result):
+        """ Сохраняет успешный ответ """
+        self.set(key, (False, result))
+
+    def store_error(self, key, err: UnexpectedResultFromMicroService):
+        """ Сохраняет ошибку, если включено негативное кеширование """
+        if self.cache_errors:
+            self.set(key, (True, err), self.error_ttl)
+
+
+class SingleFlight(object):
+    """ Объединение одинаковых одновременных вызовов
+
+    Пока выполняется вызов с некоторым ключом, все остальные вызовы с тем же ключом (из других потоков
+    или корутин) не выполняются, а дожидаются его и получают тот же результат или то же исключение.
+    """
+
+    def __init__(self):
+        """ Ключ -> concurrent.futures.Future выполняющегося вызова """
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        """ Выполняет fn в текущем потоке либо дожидается уже выполняющегося вызова с тем же ключом """
+        from concurrent.futures import Future
+
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as err:
+            self._forget(key, future)
+            future.set_exception(err)
+            raise
+        self._forget(key, future)
+        future.set_result(result)
+        return result
+
+    async def do_coroutine(self, key, fn, *args, **kwargs):
+        """ Вариант do для корутинной fn: вызов выполняется в текущем цикле событий, а одинаковые вызовы
+        из корутин (в том числе других циклов событий) и из потоков (do) дожидаются его без блокировки цикла
+        """
+        import asyncio
+        from concurrent.futures import Future
+
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            # shield: отмена одного ожидающего не должна отменять общий вызов для остальных
+            return await asyncio.shield(asyncio.wrap_future(future))
+
+        def done(task):
+            self._forget(key, future)
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+
+        task = asyncio.ensure_future(fn(*args, **kwargs))
+        task.add_done_callback(done)
+        return await asyncio.shield(task)
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+    def __len__(self):
+        return len(self._calls)
+
+
+_microservice_flight = SingleFlight()
+
+
+def microservice(url: str, data: dict, target_key: str=None, headers=None, cache: MicroServiceCache=None,
+                 coalesce: bool=False):
     """ Функция для работы с микросервисами
     :param url: URL микросервиса
     :param data: Данные для передачи в микросервис
     :param target_key: Ключ, который необходимо вернуть из ответа микросервиса
+    :param cache: Кеш ответов (MicroServiceCache), если запрос идемпотентный
+    :param coalesce: Объединять одинаковые (url, data, target_key) одновременные вызовы в один HTTP-запрос
     :return:
     """
-    import json
+    fetch = _coalesced_microservice if coalesce else _microservice
+    if cache is not None:
+        return cache.call(url, data, target_key, headers, fetch=fetch)
+    return fetch(url, data, target_key, headers)
+
+
+async def microservice_async(url: str, data: dict, target_key: str=None, headers=None,
+                             cache: MicroServiceCache=None, coalesce: bool=False):
+    """ Асинхронный вариант microservice: запрос выполняется в цикле событий (см. AsyncMicroServiceClient),
+    не занимая поток. Параметры и исключения совпадают с microservice; при coalesce объединяются одинаковые
+    одновременные вызовы в одном цикле событий
+    """
+    key = MicroServiceCache.key(url, data, target_key) if cache is not None or coalesce else None
+    if cache is not None:
+        found, value = cache.lookup(key)
+        if found:
+            return value
+    try:
+        if coalesce:
+            result = await _microservice_flight.do_coroutine(key, _microservice_async, url, data, target_key, headers)
+        else:
+            result = await _microservice_async(url, data, target_key, headers)
+    except UnexpectedResultFromMicroService as err:
+        if cache is not None:
+            cache.store_error(key, err)
+        raise
+    if cache is not None:
+        cache.store(key, result)
+    return result
+
+
+async def _microservice_async(url: str, data: dict, target_key: str=None, headers=None):
+    """ Выполняет запрос к микросервису из цикла событий без кеширования """
+    import asyncio
+
+    body, headers = MicroServiceClient.encode(data, headers)
+    try:
+        status_code, response_headers, content = await AsyncMicroServiceClient.request(url, body, headers)
+    except (OSError, EOFError, ValueError, asyncio.TimeoutError):
+        raise UnexpectedResultFromMicroService("Сервис временно недоступен")
+    return _microservice_result(status_code, content, target_key, response_headers.get("content-type"))
+
+
+def _coalesced_microservice(url: str, data: dict, target_key: str=None, headers=None):
+    """ Выполняет запрос к микросервису, объединяя его с одинаковыми одновременными запросами """
+    key = MicroServiceCache.key(url, data, target_key)
+    return _microservice_flight.do(key, _microservice, url, data, target_key, headers)
+
+
+def _microservice(url: str, data: dict, target_key: str=None, headers=None):
+    """ Выполняет запрос к микросервису без кеширования """
     import requests
 
+    body, headers = MicroServiceClient.encode(data, headers)
     try:
-        r = requests.post(url, json=data, headers=headers)
+        r = MicroServiceClient.session().post(url, data=body, headers=headers)
     except requests.ConnectionError:
         raise UnexpectedResultFromMicroService("Сервис временно недоступен")
 
-    if r.status_code == 200:
+    return _microservice_result(r.status_code, r.content, target_key, r.headers.get("Content-Type"))
+
+
+def _microservice_result(status_code: int, content: bytes, target_key: str=None, content_type: str=None):
+    """ Разбирает ответ микросервиса (в JSON или в двоичном формате - по content_type) """
+    if status_code == 200:
         try:
-            result = json.loads(r.text)
+            codec = BinaryCodec.for_content_type(content_type) if content_type else None
+            result = codec.loads(content) if codec is not None else json_codec.loads(content)
         except:
             raise UnexpectedResultFromMicroService("Не удалось выполнить запрос")
 
@@ -781,3 +3239,54 @@ def microservice(url: str, data: dict, target_key: str=None, headers=None):
             return result
     else:
         raise UnexpectedResultFromMicroService("Не удалось выполнить запрос")
+
+
+def microservice_many(specs, fail_fast: bool=True, max_workers: int=None, cache: MicroServiceCache=None,
+                      coalesce: bool=False):
+    """ Параллельно выполняет несколько запросов к микросервисам
+    :param specs: Список запросов в формате (url, data[, target_key[, headers]])
+    :param fail_fast: Если True - при первой ошибке оставшиеся запросы отменяются, а исключение поднимается;
+                      если False - исключения возвращаются на местах соответствующих результатов
+    :param max_workers: Максимальное количество одновременных запросов (по умолчанию MicroServiceClient.max_workers)
+    :param cache: Кеш ответов (MicroServiceCache) для всех запросов пачки
+    :param coalesce: Объединять одинаковые запросы (в том числе с одновременными вызовами microservice)
+    :return: Список результатов в порядке следования запросов
+    """
+    from concurrent.futures import wait, FIRST_EXCEPTION, ALL_COMPLETED
+
+    specs = [tuple(spec) for spec in specs]
+    for spec in specs:
+        if not 2 <= len(spec) <= 4:
+            raise ValueError("microservice spec must be (url, data[, target_key[, headers]]), got %r" % (spec,))
+
+    executor = MicroServiceClient.executor()
+    slots = threading.BoundedSemaphore(max_workers) if max_workers else None
+    failed = threading.Event()
+    futures = []
+
+    def done(f):
+        if not f.cancelled() and f.exception() is not None:
+            failed.set()
+        if slots is not None:
+            slots.release()
+
+    for spec in specs:
+        if slots is not None:
+            slots.acquire()
+        if fail_fast and failed.is_set():
+            if slots is not None:
+                slots.release()
+            break
+        future = executor.submit(microservice, *(spec + (None,) * (4 - len(spec))), cache=cache, coalesce=coalesce)
+        future.add_done_callback(done)
+        futures.append(future)
+
+    done, not_done = wait(futures, return_when=FIRST_EXCEPTION if fail_fast else ALL_COMPLETED)
+    if fail_fast:
+        for future in futures:
+            if future in done and future.exception() is not None:
+                for pending in not_done:
+                    pending.cancel()
+                raise future.exception()
+
+    return [future.exception() or future.result() for future in futures]
@@ -0,0 +1,321 @@
+import os
+import json
+import uuid
+import tempfile
+import threading
+from contextlib import contextmanager
+from time import perf_counter, monotonic
+import bottle
+from envi.classes import Controller
+
+
+class Metrics(object):
+    """ Метрики обработки запросов: количество запросов, время обработки (гистограммы), ошибки и запросы в работе
+
+    Каждый процесс (например, воркер uwsgi) накапливает метрики в памяти и периодически сохраняет их снимок
+    в собственный файл в directory; при выгрузке метрики всех процессов суммируются. Без directory учитываются
+    только метрики текущего процесса. Запросы в работе учитываются только для живых процессов.
+    Снимки завершившихся процессов (в том числе снимок прежнего процесса с тем же pid) переносятся в общий итог
+    retired_filename и удаляются, поэтому файлы не накапливаются, а счетчики не уменьшаются
+    """
+
+    """ Файл с суммой метрик завершившихся процессов """
+    retired_filename = "retired-metrics.json"
+
+    """ Границы корзин гистограммы времени обработки, секунды """
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, directory: str=None, buckets=None, flush_interval: float=1.0, max_series: int=5000,
+                 prefix: str="envi"):
+        """
+        :param directory: директория для файлов метрик процессов (общая для всех воркеров приложения)
+        :param buckets: границы корзин гистограммы, по умолчанию - default_buckets
+        :param flush_interval: как часто (в секундах) процесс сохраняет снимок своих метрик
+        :param max_series: максимальное количество различных пар (роут, действие);
+                           последующие действия учитываются как action="other"
+        :param prefix: префикс имен метрик
+        """
+        self.directory = directory
+        self.buckets = tuple(sorted(buckets or self.default_buckets))
+        self.flush_interval = flush_interval
+        self.max_series = max_series
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        """ Идентификатор процесса, отличающий его от прежних процессов с тем же pid """
+        self._instance = uuid.uuid4().hex
+        """ Файл снимка с pid процесса проверен: снимок прежнего процесса перенесен в итог """
+        self._claimed = False
+        self._flushed = monotonic()
+        self._requests = {}
+        self._errors = {}
+        self._durations = {}
+        self._in_flight = {}
+
+    def _check_pid(self):
+        """ После fork процесс-потомок начинает учет заново, не повторяя метрики родителя """
+        if self._pid != os.getpid():
+            self._reset()
+
+    def started(self, route: str):
+        """ Отмечает начало обработки запроса """
+        with self._lock:
+            self._check_pid()
+            self._in_flight[route] = self._in_flight.get(route, 0) + 1
+
+    def finished(self, route: str, action: str, duration: float, exception: BaseException=None):
+        """
+        Учитывает завершение обработки запроса
+        :param route: роут (шаблон пути)
+        :param action: действие контроллера
+        :param duration: время обработки, секунды (по time.perf_counter)
+        :param exception: исключение, возникшее при обработке запроса
+        """
+        with self._lock:
+            self._check_pid()
+            self._in_flight[route] = self._in_flight.get(route, 0) - 1
+            key = (route, action)
+            if key not in self._durations and len(self._durations) >= self.max_series:
+                key = (route, "other")
+            self._requests[key] = self._requests.get(key, 0) + 1
+            if key not in self._durations:
+                self._durations[key] = [0] * (len(self.buckets) + 2)
+            observation = self._durations[key]
+            for index, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    observation[index] += 1
+                    break
+            observation[-2] += duration
+            observation[-1] += 1
+            if exception is not None:
+                error_key = key + (type(exception).__name__,)
+                self._errors[error_key] = self._errors.get(error_key, 0) + 1
+            if self.directory and monotonic() - self._flushed >= self.flush_interval:
+                self._flush()
+
+    def track(self, route: str):
+        """ Контекстный менеджер для учета обработки запроса (см. Tracker) """
+        return Tracker(self, route)
+
+    def snapshot(self) -> dict:
+        """ Метрики текущего процесса """
+        with self._lock:
+            self._check_pid()
+            return self._serialize()
+
+    def flush(self):
+        """ Сохраняет снимок метрик текущего процесса """
+        with self._lock:
+            self._check_pid()
+            self._flush()
+
+    def _flush(self):
+        self._flushed = monotonic()
+        if not self.directory:
+            return
+        data = self._serialize()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, "metrics-%s.json" % self._pid)
+            if not self._claimed:
+                with self._directory_lock():
+                    previous = self._read(path)
+                    if previous is not None and previous.get("instance") != self._instance:
+                        self._retire(path, previous)
+                self._claimed = True
+            self._write(path, data)
+        except OSError:
+            pass
+
+    def _serialize(self) -> dict:
+        """ Снимок метрик процесса: ключи серий - JSON-массивы меток (вызывается под self._lock) """
+        return {
+            "pid": self._pid, "instance": self._instance, "buckets": list(self.buckets),
+            "requests": {json.dumps(key): value for key, value in self._requests.items()},
+            "errors": {json.dumps(key): value for key, value in self._errors.items()},
+            "durations": {json.dumps(key): list(value) for key, value in self._durations.items()},
+            "in_flight": dict(self._in_flight),
+        }
+
+    def _write(self, path: str, data: dict):
+        """ Атомарно записывает файл: читатели видят либо прежнее, либо новое содержимое """
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(temp, path)
+
+    @staticmethod
+    def _read(path: str):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @contextmanager
+    def _directory_lock(self):
+        """ Блокировка директории метрик между процессами (перенос снимков в итог и их чтение) """
+        try:
+            import fcntl
+        except ImportError:
+            yield
+            return
+        with open(os.path.join(self.directory, "metrics.lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _retire(self, path: str, data: dict):
+        """ Переносит снимок завершившегося процесса в итог и удаляет его файл (вызывается под _directory_lock) """
+        if data.get("buckets") == list(self.buckets):
+            retired_path = os.path.join(self.directory, self.retired_filename)
+            retired = self._read(retired_path)
+            if retired is None or retired.get("buckets") != list(self.buckets):
+                retired = {"buckets": list(self.buckets), "requests": {}, "errors": {}, "durations": {}}
+            _merge(retired, data)
+            self._write(retired_path, retired)
+        os.remove(path)
+
+    def _snapshots(self) -> list:
+        """ Снимки метрик всех процессов и итог завершившихся; для текущего процесса - актуальные данные из памяти """
+        own = self.snapshot()
+        snapshots = [own]
+        if not self.directory or not os.path.isdir(self.directory):
+            return snapshots
+        with self._directory_lock():
+            for filename in os.listdir(self.directory):
+                if not filename.startswith("metrics-") or not filename.endswith(".json"):
+                    continue
+                path = os.path.join(self.directory, filename)
+                data = self._read(path)
+                if data is None:
+                    continue
+                if data.get("pid") == own["pid"]:
+                    # Актуальные данные текущего процесса - в памяти; файл с его pid мог остаться от прежнего
+                    if data.get("instance") == self._instance:
+                        continue
+                elif self._alive(data["pid"]):
+                    if data.get("buckets") == own["buckets"]:
+                        snapshots.append(data)
+                    continue
+                try:
+                    self._retire(path, data)
+                except OSError:
+                    # Снимок не удалось перенести - учитывается как есть, без запросов в работе
+                    if data.get("buckets") == own["buckets"]:
+                        snapshots.append(dict(data, in_flight={}))
+            retired = self._read(os.path.join(self.directory, self.retired_filename))
+            if retired is not None and retired.get("buckets") == own["buckets"]:
+                snapshots.append(dict(retired, in_flight={}))
+        return snapshots
+
+    @staticmethod
+    def _alive(pid) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            pass
+        return True
+
+    def collect(self) -> dict:
+        """ Метрики всех процессов, просуммированные по ключам """
+        merged = {"requests": {}, "errors": {}, "durations": {}, "in_flight": {}}
+        for snapshot in self._snapshots():
+            _merge(merged, snapshot)
+        return merged
+
+    def exposition(self) -> str:
+        """ Метрики всех процессов в текстовом формате Prometheus """
+        merged = self.collect()
+        lines = []
+
+        def series(name, labels, value):
+            lines.append("%s{%s} %s" % (name, ",".join('%s="%s"' % (label, _escape(label_value))
+                                                      for label, label_value in labels), _number(value)))
+
+        name = "%s_requests_total" % self.prefix
+        lines += ["# HELP %s Total number of processed requests." % name, "# TYPE %s counter" % name]
+        for key, value in sorted(merged["requests"].items()):
+            series(name, zip(("route", "action"), json.loads(key)), value)
+
+        name = "%s_request_errors_total" % self.prefix
+        lines += ["# HELP %s Requests failed with an exception, by exception class." % name,
+                  "# TYPE %s counter" % name]
+        for key, value in sorted(merged["errors"].items()):
+            series(name, zip(("route", "action", "exception"), json.loads(key)), value)
+
+        name = "%s_request_duration_seconds" % self.prefix
+        lines += ["# HELP %s Request processing time." % name, "# TYPE %s histogram" % name]
+        for key, value in sorted(merged["durations"].items()):
+            labels = list(zip(("route", "action"), json.loads(key)))
+            cumulative = 0
+            for bound, amount in zip(self.buckets, value):
+                cumulative += amount
+                series(name + "_bucket", labels + [("le", _number(bound))], cumulative)
+            series(name + "_bucket", labels + [("le", "+Inf")], value[-1])
+            series(name + "_sum", labels, value[-2])
+            series(name + "_count", labels, value[-1])
+
+        name = "%s_requests_in_flight" % self.prefix
+        lines += ["# HELP %s Requests being processed." % name, "# TYPE %s gauge" % name]
+        for route, value in sorted(merged["in_flight"].items()):
+            series(name, [("route", route)], value)
+        return "\n".join(lines) + "\n"
+
+
+class Tracker(object):
+    """ Учет обработки одного запроса: время - по time.perf_counter, исключение - из блока with или error """
+
+    def __init__(self, metrics: Metrics, route: str):
+        self.metrics = metrics
+        self.route = route
+        """ Действие контроллера, устанавливается в процессе обработки """
+        self.action = "unknown"
+        """ Исключение, обработанное внутри блока (например, превращенное в ответ с ошибкой) """
+        self.error = None
+        self._started = 0.0
+
+    def __enter__(self):
+        self.metrics.started(self.route)
+        self._started = perf_counter()
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        self.metrics.finished(self.route, self.action, perf_counter() - self._started, value or self.error)
+
+
+def _merge(total: dict, snapshot: dict):
+    """ Добавляет счетчики снимка к total (запросы в работе - только если они есть в total) """
+    for name in ("requests", "errors", "in_flight"):
+        if name in total:
+            for key, value in snapshot.get(name, {}).items():
+                total[name][key] = total[name].get(key, 0) + value
+    for key, value in snapshot["durations"].items():
+        counts = total["durations"].setdefault(key, [0] * len(value))
+        for index, amount in enumerate(value):
+            counts[index] += amount
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsController(Controller):
+    """ Выгрузка метрик приложения (см. Application.route_metrics) """
+    default_action = "metrics"
+
+    @staticmethod
+    def metrics(app, **kwargs):
+        bottle.response.content_type = "text/plain; version=0.0.4; charset=utf-8"
+        return app.metrics.exposition()
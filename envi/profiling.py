@@ -0,0 +1,246 @@
+import os
+import re
+import sys
+import pstats
+import cProfile
+import threading
+import tempfile
+from time import sleep
+from itertools import count
+
+
+class SamplingProfiler(object):
+    """ Выборочное профилирование запросов в production
+
+    Профилируется каждый every-й запрос и все запросы к перечисленным роутам и действиям. Результаты
+    накапливаются по парам (роут, действие) и сохраняются в directory: в режиме CPROFILE - файлы pstats
+    (python -m pstats, snakeviz), в режиме STACKS - свернутые стеки статистического семплера (flamegraph.pl,
+    speedscope). Каждый процесс пишет собственные файлы; после rotate_after профилированных запросов
+    файл ротируется (file.pstats -> file.pstats.1 ...), хранится backups старых файлов
+    """
+
+    """ Детерминированное профилирование cProfile (точнее, но замедляет профилируемый запрос) """
+    CPROFILE = "cprofile"
+    """ Снимки стека потока запроса с интервалом interval (почти не замедляет запрос) """
+    STACKS = "stacks"
+
+    def __init__(self, directory: str, every: int=None, routes=(), actions=(), mode: str=CPROFILE,
+                 interval: float=0.005, flush_every: int=10, rotate_after: int=1000, backups: int=5):
+        """
+        :param directory: директория для результатов профилирования
+        :param every: профилировать каждый every-й запрос (None - только запросы к routes и actions)
+        :param routes: роуты (шаблоны путей), запросы к которым профилируются всегда
+        :param actions: действия, запросы к которым профилируются всегда
+        :param mode: CPROFILE или STACKS
+        :param interval: интервал снимков стека в режиме STACKS, секунды
+        :param flush_every: сохранять результаты после каждого flush_every профилированного запроса роута
+        :param rotate_after: количество профилированных запросов роута в одном файле
+        :param backups: количество хранимых старых файлов роута
+        """
+        if mode not in (self.CPROFILE, self.STACKS):
+            raise ValueError("unknown profiling mode '%s'" % mode)
+        self.directory = directory
+        self.every = every
+        self.routes = set(routes)
+        self.actions = set(actions)
+        self.mode = mode
+        self.interval = interval
+        self.flush_every = flush_every
+        self.rotate_after = rotate_after
+        self.backups = backups
+        self._counter = count(1)
+        self._lock = threading.Lock()
+        self._aggregates = {}
+        self._sampler = None
+
+    def selected(self, route: str, action: str) -> bool:
+        """ Проверяет, нужно ли профилировать запрос """
+        if route in self.routes or action in self.actions:
+            return True
+        return bool(self.every) and next(self._counter) % self.every == 0
+
+    def sample(self, route: str, action: str):
+        """ Контекстный менеджер профилирования запроса (если запрос выбран для профилирования) """
+        if not self.selected(route, action):
+            return _not_sampled
+        return ProfileSample(self, route, action)
+
+    def _sampler_thread(self):
+        with self._lock:
+            if self._sampler is None or not self._sampler.alive():
+                self._sampler = StackSampler(self.interval)
+            return self._sampler
+
+    def add(self, route: str, action: str, result):
+        """ Добавляет результат профилирования запроса (cProfile.Profile или словарь стек -> количество) """
+        with self._lock:
+            aggregate = self._aggregates.get((route, action))
+            if aggregate is None:
+                aggregate = self._aggregates[(route, action)] = Aggregate(self.mode)
+            aggregate.add(result)
+            if aggregate.samples % self.flush_every == 0 or aggregate.samples >= self.rotate_after:
+                self._write(route, action, aggregate)
+            if aggregate.samples >= self.rotate_after:
+                self._rotate(self.path(route, action))
+                del self._aggregates[(route, action)]
+
+    def flush(self):
+        """ Сохраняет накопленные результаты всех роутов """
+        with self._lock:
+            for (route, action), aggregate in self._aggregates.items():
+                self._write(route, action, aggregate)
+
+    def path(self, route: str, action: str) -> str:
+        """ Файл результатов профилирования роута и действия в текущем процессе """
+        name = re.sub(r"[^A-Za-z0-9_.-]+", "_", "%s.%s" % (route, action)).strip("_.") or "root"
+        extension = "pstats" if self.mode == self.CPROFILE else "collapsed"
+        return os.path.join(self.directory, "%s.%s.%s" % (name, os.getpid(), extension))
+
+    def _write(self, route, action, aggregate):
+        path = self.path(route, action)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            os.close(fd)
+            aggregate.dump(tmp)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+
+    def _rotate(self, path):
+        try:
+            for index in range(self.backups - 1, 0, -1):
+                if os.path.exists("%s.%s" % (path, index)):
+                    os.replace("%s.%s" % (path, index), "%s.%s" % (path, index + 1))
+            if self.backups > 0 and os.path.exists(path):
+                os.replace(path, path + ".1")
+            elif os.path.exists(path):
+                os.remove(path)
+        except OSError:
+            pass
+
+
+class ProfileSample(object):
+    """ Профилирование одного запроса """
+
+    def __init__(self, profiler: SamplingProfiler, route: str, action: str):
+        self.profiler = profiler
+        self.route = route
+        self.action = action
+        self._profile = None
+        self._sampler = None
+
+    def __enter__(self):
+        if self.profiler.mode == SamplingProfiler.CPROFILE:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Профилировщик уже запущен (например, для другого запроса в Python 3.12+)
+                return self
+            self._profile = profile
+        else:
+            self._sampler = self.profiler._sampler_thread()
+            self._sampler.watch(threading.get_ident())
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        if self._profile is not None:
+            self._profile.disable()
+            self.profiler.add(self.route, self.action, self._profile)
+        elif self._sampler is not None:
+            stacks = self._sampler.unwatch(threading.get_ident())
+            if stacks:
+                self.profiler.add(self.route, self.action, stacks)
+
+
+class Aggregate(object):
+    """ Накопленные результаты профилирования одного роута """
+
+    def __init__(self, mode: str):
+        self.mode = mode
+        self.samples = 0
+        self.stats = None
+        self.stacks = {}
+
+    def add(self, result):
+        self.samples += 1
+        if self.mode == SamplingProfiler.CPROFILE:
+            if self.stats is None:
+                self.stats = pstats.Stats(result)
+            else:
+                self.stats.add(result)
+        else:
+            for stack, amount in result.items():
+                self.stacks[stack] = self.stacks.get(stack, 0) + amount
+
+    def dump(self, path):
+        if self.mode == SamplingProfiler.CPROFILE:
+            self.stats.dump_stats(path)
+        else:
+            with open(path, "w") as f:
+                for stack, amount in sorted(self.stacks.items()):
+                    f.write("%s %d\n" % (stack, amount))
+
+
+class StackSampler(object):
+    """ Фоновый поток, снимающий стеки наблюдаемых потоков (sys._current_frames) каждые interval секунд """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.pid = os.getpid()
+        self._watched = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="envi-stack-sampler", daemon=True)
+        self._thread.start()
+
+    def alive(self) -> bool:
+        """ После fork поток семплера в процессе-потомке не существует """
+        return self.pid == os.getpid() and self._thread.is_alive()
+
+    def watch(self, thread_id):
+        with self._lock:
+            self._watched[thread_id] = {}
+        self._wakeup.set()
+
+    def unwatch(self, thread_id) -> dict:
+        with self._lock:
+            return self._watched.pop(thread_id, {})
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while self._watched:
+                self._sample()
+                sleep(self.interval)
+
+    def _sample(self):
+        frames = sys._current_frames()
+        with self._lock:
+            for thread_id, stacks in self._watched.items():
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    filename = os.path.basename(code.co_filename)
+                    stack.append("%s (%s:%d)" % (code.co_name, filename, code.co_firstlineno))
+                    frame = frame.f_back
+                key = ";".join(reversed(stack))
+                stacks[key] = stacks.get(key, 0) + 1
+
+
+class _NotSampled(object):
+    """ Запрос не выбран для профилирования """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        pass
+
+
+_not_sampled = _NotSampled()
@@ -0,0 +1,330 @@
+import os
+import select
+import asyncio
+import threading
+from collections import deque
+
+
+class WebSocketClosed(Exception):
+    """ Соединение закрыто клиентом или сервером """
+
+
+class Frame(object):
+    """ Сериализованное сообщение: отправляется клиенту как есть (см. BroadcastHub)
+    Для соединений с двоичным форматом сообщение кодируется один раз для каждого формата
+    """
+    __slots__ = ("data", "message", "encoded")
+
+    def __init__(self, data, message=None):
+        """
+        :param data: сообщение в JSON
+        :param message: исходное сообщение (если не задано, для двоичных форматов декодируется из data)
+        """
+        self.data = data
+        self.message = message
+        self.encoded = {}
+
+    def encode(self, codec):
+        """ Данные сообщения в формате codec (BinaryCodec); None - JSON """
+        if codec is None:
+            return self.data
+        data = self.encoded.get(codec.name)
+        if data is None:
+            if self.message is None:
+                from envi.classes import json_codec
+                self.message = json_codec.loads(self.data)
+            data = self.encoded[codec.name] = codec.dumps(self.message)
+        return data
+
+
+class WebSocketTransport(object):
+    """ Транспорт WebSocket-соединения для WebSocketController
+
+    Обработчик соединения ждет событий в wait(): прихода сообщений от клиента или сообщений, добавленных
+    в исходящую очередь методами push() и offer() (из любого потока). Пока событий нет, поток (или корутина) спит,
+    не опрашивая сокет. Сообщения, добавленные до пробуждения обработчика, будят его один раз
+    """
+
+    def __init__(self):
+        """ Исходящая очередь """
+        self.outbox = deque()
+        """ Обработчик уже разбужен и еще не забрал сообщения из очереди """
+        self.waking = False
+        """ Соединение закрывается по требованию сервера (см. abort) """
+        self.aborted = False
+        self.closed = False
+
+    def handshake(self, environ=None, protocol=None):
+        """
+        Установка соединения
+        :param environ: WSGI environ запроса соединения
+        :param protocol: выбранный подпротокол (Sec-WebSocket-Protocol); None - без подпротокола
+        """
+        raise NotImplementedError()
+
+    def receive(self):
+        """ Блокирующее чтение сообщения от клиента. При закрытии соединения - WebSocketClosed """
+        raise NotImplementedError()
+
+    def wait(self, timeout=None) -> tuple:
+        """
+        Ждет сообщений от клиента или из исходящей очереди
+        :param timeout: наибольшее время ожидания, секунды; None - без ограничения
+        :return: (полученные сообщения, сообщения из исходящей очереди); оба списка пусты, если истек timeout
+        """
+        raise NotImplementedError()
+
+    def send(self, data, binary=False):
+        """ Отправляет сообщение клиенту (вызывается только обработчиком соединения)
+        :param binary: отправить двоичное сообщение (иначе - текстовое)
+        """
+        raise NotImplementedError()
+
+    def push(self, message):
+        """ Добавляет сообщение в исходящую очередь и будит обработчик соединения. Можно вызывать из любого потока """
+        self.outbox.append(message)
+        self.wake()
+
+    def offer(self, message, limit: int) -> bool:
+        """ Как push, но если в очереди уже limit сообщений, сообщение не добавляется (возвращается False) """
+        if len(self.outbox) >= limit:
+            return False
+        self.push(message)
+        return True
+
+    def discard(self) -> bool:
+        """ Удаляет из исходящей очереди самое старое сообщение """
+        try:
+            self.outbox.popleft()
+            return True
+        except IndexError:
+            return False
+
+    def pending(self) -> int:
+        """ Количество неотправленных сообщений в очереди """
+        return len(self.outbox)
+
+    def abort(self):
+        """ Закрывает соединение по требованию сервера (из любого потока): wait() обработчика вызовет WebSocketClosed """
+        self.aborted = True
+        self.wake()
+
+    def drain(self) -> list:
+        """ Забирает все сообщения из исходящей очереди (вызывается обработчиком соединения) """
+        # Флаг сбрасывается до чтения очереди: сообщение, добавленное после этого, разбудит обработчик снова
+        self.waking = False
+        outgoing = []
+        while True:
+            try:
+                outgoing.append(self.outbox.popleft())
+            except IndexError:
+                break
+        if self.aborted:
+            raise WebSocketClosed()
+        return outgoing
+
+    def wake(self):
+        if not self.waking:
+            self.waking = True
+            self.notify()
+
+    def notify(self):
+        """ Будит обработчик соединения """
+        raise NotImplementedError()
+
+    def close(self):
+        """ Освобождает ресурсы транспорта """
+
+
+class UwsgiWebSocketTransport(WebSocketTransport):
+    """ WebSocket-транспорт uwsgi
+
+    wait() спит в select() на сокете соединения и на self-pipe, в который пишет notify(), поэтому простаивающее
+    соединение не расходует процессор, а сообщения из очереди отправляются сразу. Не реже раза в ping_interval
+    секунд вызывается websocket_recv_nb(): при этом uwsgi отправляет ping клиенту (см. websockets-ping-freq)
+    """
+
+    """ Интервал, с которым uwsgi получает управление для отправки ping, секунды """
+    ping_interval = 10.0
+
+    """ Максимум сообщений, читаемых из сокета за одно пробуждение (чтобы не задерживать исходящую очередь) """
+    max_batch = 64
+
+    def __init__(self, uwsgi=None):
+        """
+        :param uwsgi: модуль uwsgi (по умолчанию импортируется; параметр нужен для тестов)
+        """
+        super().__init__()
+        if uwsgi is None:
+            import uwsgi
+        self.uwsgi = uwsgi
+        self.fd = None
+        self.wake_reader, self.wake_writer = os.pipe()
+        os.set_blocking(self.wake_reader, False)
+        os.set_blocking(self.wake_writer, False)
+        """ notify (из любого потока) и close не выполняются одновременно: иначе запись могла бы попасть
+        в закрытый или уже занятый другим файлом дескриптор """
+        self.pipe_lock = threading.Lock()
+
+    def handshake(self, environ=None, protocol=None):
+        if protocol is None:
+            self.uwsgi.websocket_handshake()
+        else:
+            self.uwsgi.websocket_handshake(environ["HTTP_SEC_WEBSOCKET_KEY"], environ.get("HTTP_ORIGIN", ""), protocol)
+        self.fd = self.uwsgi.connection_fd()
+
+    def receive(self):
+        try:
+            return self.uwsgi.websocket_recv()
+        except OSError:
+            raise WebSocketClosed()
+
+    def wait(self, timeout=None) -> tuple:
+        # Сначала - то, что уже есть в очереди или в буфере uwsgi (select о нем не сообщит)
+        incoming, outgoing = self.read(), self.drain()
+        if incoming or outgoing:
+            return incoming, outgoing
+        interval = self.ping_interval if timeout is None else min(timeout, self.ping_interval)
+        while True:
+            ready = select.select([self.fd, self.wake_reader], [], [], interval)[0]
+            if self.wake_reader in ready:
+                try:
+                    while os.read(self.wake_reader, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+            incoming, outgoing = self.read(), self.drain()
+            if incoming or outgoing or timeout is not None:
+                return incoming, outgoing
+
+    def read(self) -> list:
+        """ Сообщения, которые можно прочитать без ожидания """
+        messages = []
+        try:
+            while len(messages) < self.max_batch:
+                msg = self.uwsgi.websocket_recv_nb()
+                if not msg:
+                    break
+                messages.append(msg)
+        except OSError:
+            raise WebSocketClosed()
+        return messages
+
+    def send(self, data, binary=False):
+        try:
+            if binary:
+                self.uwsgi.websocket_send_binary(data)
+            else:
+                self.uwsgi.websocket_send(data)
+        except OSError:
+            raise WebSocketClosed()
+
+    def notify(self):
+        with self.pipe_lock:
+            if not self.closed:
+                try:
+                    os.write(self.wake_writer, b"\0")
+                except BlockingIOError:
+                    # Канал заполнен - обработчик и так будет разбужен
+                    pass
+
+    def close(self):
+        with self.pipe_lock:
+            if not self.closed:
+                self.closed = True
+                os.close(self.wake_reader)
+                os.close(self.wake_writer)
+
+
+class AsgiWebSocketTransport(WebSocketTransport):
+    """ WebSocket-транспорт ASGI (см. AsgiApplication) на asyncio
+
+    Методы handshake, receive, wait и send - корутины; push можно вызывать как из цикла событий,
+    так и из других потоков
+    """
+
+    def __init__(self, receive, send, loop=None):
+        """
+        :param receive: receive ASGI-соединения
+        :param send: send ASGI-соединения
+        :param loop: цикл событий соединения (по умолчанию - текущий)
+        """
+        super().__init__()
+        self._receive = receive
+        self._send = send
+        self.loop = loop or asyncio.get_running_loop()
+        self.pushed = asyncio.Event()
+        self.receiving = None
+
+    async def handshake(self, environ=None, protocol=None):
+        message = await self._receive()
+        if message["type"] != "websocket.connect":
+            raise WebSocketClosed()
+        if protocol is None:
+            await self._send({"type": "websocket.accept"})
+        else:
+            await self._send({"type": "websocket.accept", "subprotocol": protocol})
+
+    async def reject(self):
+        """ Отклоняет соединение до установки (клиент получит ответ 403) """
+        message = await self._receive()
+        if message["type"] == "websocket.connect":
+            await self._send({"type": "websocket.close", "code": 1008})
+        self.closed = True
+
+    async def receive(self):
+        if self.receiving is None:
+            message = await self._receive()
+        else:
+            message, self.receiving = await self.receiving, None
+        return self.payload(message)
+
+    def payload(self, message):
+        if message["type"] == "websocket.disconnect":
+            self.closed = True
+            raise WebSocketClosed()
+        return message.get("bytes") if message.get("bytes") is not None else message.get("text")
+
+    async def wait(self, timeout=None) -> tuple:
+        if not self.outbox and not self.aborted:
+            # Ожидание receive не отменяется: сообщение клиента не должно потеряться при срабатывании push
+            if self.receiving is None:
+                self.receiving = asyncio.ensure_future(self._receive())
+            waiting = asyncio.ensure_future(self.pushed.wait())
+            await asyncio.wait({self.receiving, waiting}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            waiting.cancel()
+        self.pushed.clear()
+        outgoing = self.drain()
+        incoming = []
+        if self.receiving is not None and self.receiving.done():
+            message, self.receiving = self.receiving.result(), None
+            incoming.append(self.payload(message))
+        return incoming, outgoing
+
+    async def send(self, data, binary=False):
+        if binary:
+            await self._send({"type": "websocket.send", "bytes": bytes(data)})
+        else:
+            await self._send({"type": "websocket.send", "text": data if isinstance(data, str) else data.decode()})
+
+    def notify(self):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self.pushed.set()
+        else:
+            try:
+                self.loop.call_soon_threadsafe(self.pushed.set)
+            except RuntimeError:
+                # Цикл событий соединения уже закрыт
+                pass
+
+    async def close(self, code=1000):
+        if self.receiving is not None:
+            self.receiving.cancel()
+            self.receiving = None
+        if not self.closed:
+            self.closed = True
+            await self._send({"type": "websocket.close", "code": code})
@@ -1,5 +1,6 @@
 import unittest
 import json
+from datetime import datetime
 from webtest import TestApp
 from envi import Application, Controller, ProxyController, Request, template, ControllerMethodResponseWithTemplate
 
@@ -69,6 +70,10 @@ class ReflectionController(Controller):
     def return_user(user, **kwargs):
         return "User Is None" if not user else "User Is Not None"
 
+    @staticmethod
+    def return_arg_type(request, **kwargs):
+        return type(request.get('arg')).__name__
+
 
 class FirstException(Exception):
     def __init__(self):
@@ -93,6 +98,7 @@ class ControllerTestsFixture(unittest.TestCase):
         self.app.route("/options/", TestProxyController)
         self.app.route("/reflection/<action>/", ReflectionController)
         self.app.route("/reflection/<action>/<arg>/", ReflectionController)
+        self.app.route("/raw/<action>/", ReflectionController, revive_datetimes=False)
 
         self.test_app = TestApp(self.app)
 
@@ -140,6 +146,13 @@ class ControllerTests(ControllerTestsFixture):
             self.get_query("/return_exception/")
         )
 
+    def test_error_response_is_not_overridden_by_client(self):
+        """ Параметры запроса error_response и error_response2 не подменяют фабрики ответа об ошибке """
+        self.assertEqual(
+            self.get_query("/return_exception/"),
+            self.get_query("/return_exception/", {"error_response": "1", "error_response2": "1"})
+        )
+
     def test_action_routing_post_method(self):
         """ Контроллер корректно проксирует POST-запрос на метод, соответствующий переданному параметру action
         и корректно форматирует ответ в соответствии с типом возвращаемого значения """
@@ -162,6 +175,33 @@ class ControllerTests(ControllerTestsFixture):
             json.loads(self.post_query("/return_exception/"))
         )
 
+    def test_framework_methods_are_not_actions(self):
+        """ Методы фреймворка и приватные атрибуты контроллера нельзя вызвать как действие """
+        for action in ("process", "setup", "apply_to_each_response", "__init__", "_actions", "error_template"):
+            self.assertIn("NotImplementedError", self.post_query("/", {"action": action}), action)
+        self.assertIn("return_dict", TestController.actions())
+        self.assertNotIn("process", TestController.actions())
+
+    def test_stateless_controller(self):
+        """ Stateless-контроллер создается один раз на все запросы, обычный - на каждый запрос """
+        class StatelessController(Controller):
+            stateless = True
+            default_action = "index"
+            instances = 0
+
+            def __init__(self):
+                StatelessController.instances += 1
+
+            @staticmethod
+            def index(**kwargs):
+                return "ok"
+
+        self.app.route("/stateless/", StatelessController)
+        for _ in range(3):
+            self.assertEqual("ok", self.get_query("/stateless/"))
+        self.assertEqual(1, StatelessController.instances)
+        self.assertIsNot(TestController.instance(), TestController.instance())
+
     def test_headers(self):
         """ Контроллер корректно возвращает все хедеры переданные сервером в ответ на запрос """
         headers = self.get_headers_from_get_query("/return_html_by_templating/")
@@ -175,6 +215,36 @@ class ProxyControllerTests(ControllerTestsFixture):
         self.assertEqual("Hello", self.post_query("/options/", {"action": "return_str", "option": 1}))
         self.assertEqual("Goodbye", self.post_query("/options/", {"action": "return_str", "option": 2}))
 
+    def test_cached_resolution(self):
+        """ Выбор целевого контроллера кешируется по параметрам из depends_on """
+        calls = []
+
+        class InnerProxyController(ProxyController):
+            @staticmethod
+            def factory_method(app, request, user, host):
+                calls.append("inner")
+                return TestController if request.get("option") == "1" else TestController2
+
+        class CachedProxyController(ProxyController):
+            depends_on = ("option",)
+
+            @staticmethod
+            def factory_method(app, request, user, host):
+                calls.append("outer")
+                return InnerProxyController
+
+        self.app.route("/cached/", CachedProxyController)
+        for _ in range(3):
+            self.assertEqual("Hello", self.post_query("/cached/", {"action": "return_str", "option": 1}))
+            self.assertEqual("Goodbye", self.post_query("/cached/", {"action": "return_str", "option": 2}))
+        self.assertEqual(["outer", "inner"] * 2, calls)
+        self.assertEqual({"hits": 4, "misses": 2, "evictions": 0, "size": 2, "maxsize": 1024},
+                         CachedProxyController.cache_info())
+
+        CachedProxyController.cache_clear()
+        self.assertEqual("Hello", self.post_query("/cached/", {"action": "return_str", "option": 1}))
+        self.assertEqual(["outer", "inner"] * 3, calls)
+
 
 class RequestTests(unittest.TestCase):
     def setUp(self):
@@ -244,6 +314,26 @@ class RequestTests(unittest.TestCase):
         request.update({'prop': 4})
         self.assertEqual(4, request.get('prop'))
 
+    def test_lazy_sources(self):
+        """ Источники-функции вызываются только при обращении к отсутствующим в более приоритетных источниках ключам """
+        calls = []
+        request = Request(lambda: calls.append("low") or {'a': 1, 'b': 1}, {'b': 2},
+                          lambda: calls.append("high") or {'c': 3})
+        request.set('c', 4)
+        self.assertEqual(4, request.get('c'))
+        self.assertEqual([], calls)
+        self.assertEqual(2, request.get('b'))
+        self.assertEqual(["high"], calls)
+        self.assertEqual(1, request.get('a'))
+        self.assertEqual(["high", "low"], calls)
+        self.assertCountEqual([('a', 1), ('b', 2), ('c', 4)], request.items())
+        self.assertEqual(["high", "low"], calls)
+
+    def test_lazy_source_type_check(self):
+        """ Источник-функция должна вернуть словарь """
+        self.assertRaises(TypeError, Request(lambda: []).get, 'a')
+        self.assertRaises(TypeError, Request, 1)
+
     def test_ajax_type_detection(self):
         """ Ajax запрос определяется по заголовку HTTP_X_REQUESTED_WITH """
         request = Request(environ={"HTTP_X_REQUESTED_WITH": "XMLHttpRequest"})
@@ -297,6 +387,12 @@ class EnvironmentReflectionTests(ControllerTestsFixture):
             ).body
         )
 
+    def test_datetime_revival(self):
+        """ Даты в параметре json восстанавливаются, если это не отключено для роута """
+        data = {"json": json.dumps({"arg": datetime(2016, 1, 2, 3, 4, 5).ctime()})}
+        self.assertEqual("datetime", self.get_query("/reflection/return_arg_type/", data))
+        self.assertEqual("str", self.get_query("/raw/return_arg_type/", data))
+
     def test_user_initialization(self):
         """ Если в приложении Apllication не переопределен user_initialization_hook,
         то в контроллер приходит user = None, иначе - в соответствии с переопределением """
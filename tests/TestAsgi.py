@@ -0,0 +1,308 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from urllib.parse import urlencode
+import bottle
+from envi import AsgiApplication, Controller, ProxyController, SamplingProfiler, template, microservice_async
+from tests.TestMicroservice import MicroServiceFixture, MicroServiceHandler
+
+
+class AsyncController(Controller):
+    url = None
+
+    async def setup(self, request, **kwargs):
+        await asyncio.sleep(0)
+        return {"prefix": request.get("prefix", "")}
+
+    @staticmethod
+    async def hello(request, prefix, **kwargs):
+        await asyncio.sleep(0.01)
+        request.response.set_cookie("seen", "1")
+        return {"hello": prefix + request.get("name")}
+
+    @staticmethod
+    async def remote(request, **kwargs):
+        return await microservice_async(AsyncController.url, {"i": request.get("i"), "sleep": 0.2}, "result.i")
+
+    @staticmethod
+    async def add(request, **kwargs):
+        await asyncio.sleep(0.2)
+        return sum(request.get("params"))
+
+    @staticmethod
+    @template("error", if_exc=ValueError)
+    @template("page")
+    async def page(request, **kwargs):
+        if request.get("fail", False):
+            raise ValueError("bad page")
+        return {"page": 1}
+
+    @staticmethod
+    async def failure(**kwargs):
+        raise RuntimeError("async failure")
+
+
+class SyncController(Controller):
+    @staticmethod
+    def hello(request, **kwargs):
+        bottle.response.set_header("X-Thread", threading.current_thread().name)
+        bottle.response.set_cookie("sync", "1")
+        return {"hello": request.get("name"), "method": request.method}
+
+    @staticmethod
+    def add(request, **kwargs):
+        return sum(request.get("params"))
+
+    @staticmethod
+    def items(**kwargs):
+        return ({"i": i} for i in range(3))
+
+    @staticmethod
+    def moved(**kwargs):
+        bottle.redirect("/sync/hello?name=moved")
+
+    @staticmethod
+    def leave(**kwargs):
+        raise SystemExit()
+
+
+class AsyncProxyController(ProxyController):
+    @staticmethod
+    def factory_method(app, request, user, host):
+        return AsyncController
+
+
+class AsyncUserApplication(AsgiApplication):
+    async def user_initialization_hook(self, request):
+        await asyncio.sleep(0)
+        return {"id": 1}
+
+    def static_output_converter(self, result):
+        return "%s + %s" % (json.dumps(result.data), result.template)
+
+
+class AsgiClient(object):
+    """ Выполняет запросы к ASGI-приложению без сервера """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def request(self, method, path, query=None, data=None, headers=None):
+        body = urlencode(data).encode() if data else b""
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+        sent = []
+        raw_headers = [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]
+        if body:
+            raw_headers.append((b"content-type", b"application/x-www-form-urlencoded"))
+            raw_headers.append((b"content-length", str(len(body)).encode()))
+
+        async def receive():
+            return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+
+        await self.app({
+            "type": "http", "method": method, "path": path, "query_string": urlencode(query or {}).encode(),
+            "headers": raw_headers, "server": ("testserver", 80), "client": ("127.0.0.1", 5000),
+            "scheme": "http", "http_version": "1.1", "root_path": "",
+        }, receive, send)
+        response_headers = {}
+        for name, value in sent[0]["headers"]:
+            response_headers.setdefault(name.decode().lower(), []).append(value.decode())
+        return sent[0]["status"], response_headers, b"".join(m.get("body", b"") for m in sent[1:])
+
+    def get(self, path, query=None, ajax=True, **kwargs):
+        headers = {"X-Requested-With": "XMLHttpRequest"} if ajax else {}
+        return asyncio.run(self.request("GET", path, query, headers=headers, **kwargs))
+
+
+class TestAsgiApplication(unittest.TestCase):
+    def setUp(self):
+        app = AsyncUserApplication()
+        app.route("/async/<action>/", AsyncController)
+        app.route("/sync/<action>/", SyncController)
+        app.route("/proxy/<action>/", AsyncProxyController)
+        self.app = app
+        self.client = AsgiClient(app)
+
+    def test_async_action(self):
+        """ Асинхронные setup и действие выполняются в цикле событий """
+        status, headers, body = self.client.get("/async/hello", {"name": "world", "prefix": "dear "})
+        self.assertEqual(200, status)
+        self.assertEqual({"hello": "dear world"}, json.loads(body))
+        self.assertIn("seen=1", headers["set-cookie"][0])
+        self.assertEqual(str(len(body)), headers["content-length"][0])
+
+    def test_sync_controller(self):
+        """ Синхронный контроллер выполняется в пуле потоков с привязанными bottle.request и bottle.response """
+        status, headers, body = self.client.get("/sync/hello/", {"name": "world"})
+        self.assertEqual({"hello": "world", "method": "GET"}, json.loads(body))
+        self.assertTrue(headers["x-thread"][0].startswith("envi-sync"))
+        self.assertIn("sync=1", headers["set-cookie"][0])
+
+    def test_body_size_limit(self):
+        """ Тело больше max_body_size отклоняется с кодом 413 - по Content-Length или по мере чтения """
+        self.app.max_body_size = 32
+        ajax = {"X-Requested-With": "XMLHttpRequest"}
+        status, _, body = asyncio.run(self.client.request("POST", "/sync/hello", data={"name": "w"}, headers=ajax))
+        self.assertEqual((200, "w"), (status, json.loads(body)["hello"]))
+        status, _, _ = asyncio.run(self.client.request("POST", "/sync/hello", data={"name": "w" * 64}, headers=ajax))
+        self.assertEqual(413, status)
+
+        async def chunked():
+            messages = [{"type": "http.request", "body": b"name=" + b"w" * 20, "more_body": True}] * 3
+            sent = []
+            await self.app({"type": "http", "method": "POST", "path": "/sync/hello", "query_string": b"",
+                            "headers": [(b"content-type", b"application/x-www-form-urlencoded")]},
+                           lambda: asyncio.sleep(0, messages.pop(0)), lambda m: asyncio.sleep(0, sent.append(m)))
+            return sent[0]["status"], len(messages)
+
+        self.assertEqual((413, 1), asyncio.run(chunked()))
+
+    def test_body_is_not_read_without_route(self):
+        """ Тело запроса к несуществующему роуту не читается """
+        async def main():
+            sent = []
+
+            async def receive():
+                raise AssertionError("body must not be read")
+
+            await self.app({"type": "http", "method": "POST", "path": "/missing", "query_string": b"",
+                            "headers": []}, receive, lambda m: asyncio.sleep(0, sent.append(m)))
+            return sent[0]["status"]
+
+        self.assertEqual(404, asyncio.run(main()))
+
+    def test_redirect(self):
+        """ HTTPResponse из синхронного контроллера превращается в ответ """
+        status, headers, body = self.client.get("/sync/moved")
+        self.assertEqual(303, status)
+        self.assertTrue(headers["location"][0].endswith("/sync/hello?name=moved"))
+
+    def test_streaming(self):
+        """ Потоковый ответ читается в пуле потоков """
+        status, headers, body = self.client.get("/sync/items")
+        self.assertEqual([{"i": 0}, {"i": 1}, {"i": 2}], json.loads(body))
+        self.assertEqual("application/json", headers["content-type"][0])
+
+    def test_errors(self):
+        """ Исключения асинхронных действий превращаются в ответы с ошибкой """
+        status, headers, body = self.client.get("/async/failure")
+        self.assertEqual(200, status)
+        self.assertEqual("async failure", json.loads(body)["error"]["message"])
+        status, headers, body = self.client.get("/async/missing")
+        self.assertEqual("<class 'NotImplementedError'>", json.loads(body)["error"]["type"])
+
+    def test_template(self):
+        """ Декоратор template работает с асинхронными действиями """
+        self.assertEqual(b'{"page": 1} + page', self.client.get("/async/page", ajax=False)[2])
+        self.assertEqual(
+            b'{"name": "ValueError", "message": "bad page"} + error',
+            self.client.get("/async/page", {"fail": 1}, ajax=False)[2]
+        )
+
+    def test_proxy(self):
+        """ Проксирующий контроллер передает запрос асинхронному контроллеру """
+        self.assertEqual({"hello": "proxy"}, json.loads(self.client.get("/proxy/hello", {"name": "proxy"})[2]))
+
+    def test_not_found(self):
+        status, headers, body = self.client.get("/nowhere")
+        self.assertEqual(404, status)
+
+    def test_json_rpc_batch(self):
+        """ Вызовы пачки JSON-RPC выполняются одновременно (асинхронные - в цикле событий, синхронные - в потоках) """
+        for prefix, limit in (("/async", 0.5), ("/sync", None)):
+            started = time.time()
+            status, headers, body = asyncio.run(self.client.request("POST", prefix + "/add", data={"q": json.dumps([
+                {"jsonrpc": "2.0", "method": "add", "params": [i, 1], "id": i + 1} for i in range(5)
+            ])}))
+            self.assertEqual([i + 1 for i in range(5)], [r["result"] for r in json.loads(body)])
+            self.assertEqual("application/json", headers["content-type"][0])
+            if limit:
+                self.assertLess(time.time() - started, limit)
+
+    def test_system_exit(self):
+        """ SystemExit завершает запрос без ответа, в том числе из вызова пачки JSON-RPC, и не останавливает цикл """
+        async def main():
+            sent = []
+            for query in ({}, {"q": json.dumps([{"jsonrpc": "2.0", "method": name, "id": i}
+                                                for i, name in enumerate(("items", "leave"))])}):
+                await self.app({"type": "http", "method": "GET", "path": "/sync/leave", "headers": [],
+                                "query_string": urlencode(query).encode()},
+                               lambda: asyncio.sleep(0, {"type": "http.request"}),
+                               lambda m: asyncio.sleep(0, sent.append(m)))
+            return sent
+
+        self.assertEqual([], asyncio.run(main()))
+        self.assertEqual("after", json.loads(self.client.get("/sync/hello", {"name": "after"})[2])["hello"])
+
+    def test_sampling_profiler(self):
+        """ Выборочно профилируются и асинхронные, и синхронные контроллеры """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.app.sampling_profiler = SamplingProfiler(directory, actions=["hello"])
+        self.client.get("/async/hello", {"name": "a"})
+        self.client.get("/sync/hello", {"name": "s"})
+        self.client.get("/sync/items")
+        aggregates = self.app.sampling_profiler._aggregates
+        self.assertEqual([("/async/<action>", "hello"), ("/sync/<action>", "hello")], sorted(aggregates))
+
+    def test_lifespan(self):
+        messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message["type"])
+
+        asyncio.run(self.app({"type": "lifespan"}, receive, send))
+        self.assertEqual(["lifespan.startup.complete", "lifespan.shutdown.complete"], sent)
+
+
+class TestAsgiStatic(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        with open(os.path.join(self.root, "app.js"), "w") as f:
+            f.write("var a = 1;")
+        app = AsgiApplication()
+        app.route_static("/static", self.root)
+        self.client = AsgiClient(app)
+
+    def test_static(self):
+        status, headers, body = self.client.get("/static/app.js", ajax=False)
+        self.assertEqual(200, status)
+        self.assertEqual(b"var a = 1;", body)
+        self.assertEqual(404, self.client.get("/static/missing.js", ajax=False)[0])
+        status, headers, body = asyncio.run(AsgiClient(self.client.app).request("HEAD", "/static/app.js"))
+        self.assertEqual((200, b""), (status, body))
+
+
+class TestAsgiConcurrency(MicroServiceFixture):
+    def test_concurrent_slow_requests(self):
+        """ Запросы, ожидающие микросервис, не занимают потоки: 100 запросов по 0.2 с выполняются одновременно """
+        AsyncController.url = self.url
+        MicroServiceHandler.requests = 0
+        app = AsgiApplication()
+        app.route("/async/<action>/", AsyncController)
+        client = AsgiClient(app)
+
+        async def main():
+            return await asyncio.gather(*[
+                client.request("GET", "/async/remote", {"i": i}, headers={"X-Requested-With": "XMLHttpRequest"})
+                for i in range(100)
+            ])
+
+        started = time.time()
+        responses = asyncio.run(main())
+        self.assertLess(time.time() - started, 3)
+        self.assertEqual(list(range(100)), [json.loads(body) for status, headers, body in responses])
+        self.assertEqual(100, MicroServiceHandler.requests)
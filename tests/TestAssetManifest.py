@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import unittest
+from webtest import TestApp
+from envi import Application, AssetManifest
+
+
+class AssetsFixture(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache_file = os.path.join(tempfile.mkdtemp(), "assets.json")
+        os.makedirs(os.path.join(self.root, "js"))
+        self.write("js/app.js", b"console.log(1);")
+        self.write("js/app.js.gz", b"compressed")
+        self.write("jquery.min.js", b"jquery")
+        self.write("LICENSE", b"license")
+        self.write(".hidden", b"hidden")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        shutil.rmtree(os.path.dirname(self.cache_file))
+
+    def write(self, name, content):
+        with open(os.path.join(self.root, name), "wb") as f:
+            f.write(content)
+
+
+class TestAssetManifest(AssetsFixture):
+    def manifest(self):
+        return AssetManifest(self.root, cache_file=self.cache_file).build()
+
+    def test_build(self):
+        """ Отпечатки строятся для всех файлов, кроме скрытых и сжатых копий """
+        self.assertEqual({"js/app.js", "jquery.min.js", "LICENSE"}, set(self.manifest().versions))
+
+    def test_url(self):
+        manifest = self.manifest()
+        self.assertRegex(manifest.url("js/app.js"), r"^/static/js/app\.v[0-9]+\.js$")
+        self.assertRegex(manifest.url("/jquery.min.js"), r"^/static/jquery\.min\.v[0-9]+\.js$")
+        self.assertEqual("/static/LICENSE", manifest.url("LICENSE"))
+        self.assertEqual("/static/missing.js", manifest.url("missing.js"))
+
+    def test_url_changes_with_content(self):
+        before = self.manifest().url("js/app.js")
+        self.write("js/app.js", b"console.log(2);")
+        self.assertNotEqual(before, self.manifest().url("js/app.js"))
+
+    def test_incremental(self):
+        """ При повторной сборке пересчитываются хеши только измененных файлов """
+        self.assertEqual(3, self.manifest().hashed)
+        self.assertEqual(0, self.manifest().hashed)
+        self.write("js/app.js", b"console.log(2); // longer")
+        self.assertEqual(1, self.manifest().hashed)
+
+    def test_no_cache_file(self):
+        """ Без кеш-файла хеши вычисляются при каждой сборке и никуда не записываются """
+        self.assertEqual(3, AssetManifest(self.root).build().hashed)
+        self.assertEqual(3, AssetManifest(self.root).build().hashed)
+
+    @unittest.skipUnless(hasattr(os, "geteuid"), "POSIX only")
+    def test_writable_cache_is_ignored(self):
+        """ Кеш-файл, доступный на запись другим пользователям, не читается: его могли подменить """
+        versions = self.manifest().versions
+        self.assertEqual(0o600, os.stat(self.cache_file).st_mode & 0o777)
+        with open(self.cache_file, "w") as f:
+            f.write('{"js/app.js": [%s, 15, "%s"]}' % (os.stat(os.path.join(self.root, "js/app.js")).st_mtime_ns,
+                                                      "0" * 40))
+        os.chmod(self.cache_file, 0o666)
+        manifest = self.manifest()
+        self.assertEqual((3, versions), (manifest.hashed, manifest.versions))
+
+    def test_is_current(self):
+        manifest = self.manifest()
+        version = manifest.versions["js/app.js"]
+        self.assertTrue(manifest.is_current("js/app.v%s.js" % version))
+        self.assertFalse(manifest.is_current("js/app.v1.js"))
+        self.assertFalse(manifest.is_current("js/app.js"))
+
+
+class TestFingerprintedStatic(AssetsFixture):
+    def setUp(self):
+        super().setUp()
+        self.app = Application()
+        self.app.route_static("/assets/", self.root, manifest=AssetManifest(self.root, self.cache_file).build())
+        self.test_app = TestApp(self.app)
+
+    def test_asset_url(self):
+        """ URL с актуальным отпечатком отдается с заголовками для вечного кеширования """
+        url = self.app.asset_url("js/app.js")
+        self.assertTrue(url.startswith("/assets/js/app.v"))
+        response = self.test_app.get(url)
+        self.assertEqual(b"console.log(1);", response.body)
+        self.assertEqual(AssetManifest.cache_control, response.headers["Cache-Control"])
+
+    def test_stale_fingerprint(self):
+        """ Устаревший отпечаток и URL без отпечатка не кешируются навсегда """
+        self.assertNotIn("Cache-Control", self.test_app.get("/assets/js/app.v1.js").headers)
+        self.assertNotIn("Cache-Control", self.test_app.get("/assets/js/app.js").headers)
+
+    def test_not_configured(self):
+        self.assertRaises(RuntimeError, Application().asset_url, "js/app.js")
@@ -0,0 +1,159 @@
+import json
+import asyncio
+import threading
+import unittest
+from datetime import datetime, date
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+from webtest import TestApp
+from envi import Application, AsgiApplication, Controller, BinaryCodec, MicroServiceClient, microservice, \
+    microservice_async
+
+msgpack = BinaryCodec.get("msgpack")
+cbor = BinaryCodec.get("cbor")
+
+
+class DataController(Controller):
+    @staticmethod
+    def echo(request, **kwargs):
+        return {"moment": request.get("moment"), "items": request.get("items", [])}
+
+    @staticmethod
+    def today(**kwargs):
+        return {"date": datetime(2016, 1, 2, 3, 4, 5)}
+
+
+class TestBinaryCodec(unittest.TestCase):
+    @unittest.skipUnless(msgpack and cbor, "msgpack or cbor2 is not installed")
+    def test_datetimes(self):
+        """ Даты кодируются средствами формата и декодируются в UTC без часового пояса """
+        for codec in (msgpack, cbor):
+            data = {"moment": datetime(2016, 1, 2, 3, 4, 5, 6), "nested": [{"ctime": "Sat Jan  2 03:04:05 2016"}]}
+            self.assertEqual(data, codec.loads(codec.dumps(data)))
+            self.assertNotIn(b"2016", codec.dumps(data["moment"]))
+
+    @unittest.skipUnless(msgpack and cbor, "msgpack or cbor2 is not installed")
+    def test_array(self):
+        for codec in (msgpack, cbor):
+            for size in (0, 3, 30, 300, 70000):
+                self.assertEqual(list(range(size)), codec.loads(codec.array([codec.dumps(i) for i in range(size)])))
+
+    def test_unknown(self):
+        self.assertIsNone(BinaryCodec.get("xml"))
+        self.assertIsNone(BinaryCodec.for_content_type("application/json"))
+
+    @unittest.skipUnless(msgpack, "msgpack is not installed")
+    def test_invalid(self):
+        self.assertRaises(ValueError, msgpack.loads, b"\xc1")
+
+
+class TestNegotiation(unittest.TestCase):
+    def setUp(self):
+        self.app = Application()
+        self.app.route("/<action>/", DataController)
+        self.test_app = TestApp(self.app)
+
+    def post(self, path, body, content_type):
+        """ Запрос и ответ в двоичном формате """
+        return self.test_app.post(path, body, content_type=content_type, headers={
+            "Accept": content_type, "X-Requested-With": "XMLHttpRequest"
+        })
+
+    def test_response_codec(self):
+        """ Двоичный формат выбирается, только если клиент указал его явно и не предпочел ему JSON """
+        codec = self.app.response_codec
+        environ = lambda accept: type("R", (), {"environ": {"HTTP_ACCEPT": accept}})
+        self.assertIsNone(codec(environ("*/*")))
+        self.assertIsNone(codec(environ("application/json, application/msgpack;q=0.5")))
+        self.assertIsNone(codec(environ("application/msgpack;q=0")))
+        if msgpack and cbor:
+            self.assertIs(msgpack, codec(environ("application/msgpack, application/json;q=0.9")))
+            self.assertIs(cbor, codec(environ("application/msgpack;q=0.5, application/cbor")))
+            self.assertIs(msgpack, codec(environ("application/cbor, application/msgpack")))
+        self.app.binary_formats = ()
+        self.assertIsNone(codec(environ("application/msgpack")))
+
+    def test_json(self):
+        response = self.test_app.get("/today/", headers={"X-Requested-With": "XMLHttpRequest"})
+        self.assertEqual({"date": "Sat Jan  2 03:04:05 2016"}, json.loads(response.text))
+
+    @unittest.skipUnless(msgpack and cbor, "msgpack or cbor2 is not installed")
+    def test_binary(self):
+        """ Ответ и тело запроса в двоичном формате, даты - без преобразования в строки """
+        for codec in (msgpack, cbor):
+            moment = datetime(2016, 1, 2, 3, 4, 5)
+            response = self.post("/echo/", codec.dumps({"moment": moment, "items": [1, "a"]}), codec.content_type)
+            self.assertEqual(codec.content_type, response.headers["Content-Type"])
+            self.assertEqual("Accept", response.headers["Vary"])
+            self.assertEqual({"moment": moment, "items": [1, "a"]}, codec.loads(response.body))
+
+    @unittest.skipUnless(msgpack, "msgpack is not installed")
+    def test_json_rpc(self):
+        """ JSON-RPC в двоичном формате: вызовы передаются в ключе q тела запроса """
+        calls = [
+            {"jsonrpc": "2.0", "method": "echo", "params": {"moment": date(2016, 1, 2)}, "id": 1},
+            {"jsonrpc": "2.0", "method": "today", "id": 2},
+        ]
+        response = self.post("/rpc/", msgpack.dumps({"q": calls}), "application/msgpack")
+        self.assertEqual("application/msgpack", response.headers["Content-Type"])
+        self.assertEqual([
+            {"jsonrpc": "2.0", "result": {"moment": datetime(2016, 1, 2), "items": []}, "id": 1},
+            {"jsonrpc": "2.0", "result": {"date": datetime(2016, 1, 2, 3, 4, 5)}, "id": 2},
+        ], msgpack.loads(response.body))
+
+    @unittest.skipUnless(cbor, "cbor2 is not installed")
+    def test_asgi(self):
+        app = AsgiApplication()
+        app.route("/<action>/", DataController)
+
+        async def main():
+            sent = []
+            body = cbor.dumps({"moment": datetime(2016, 1, 2)})
+            messages = iter([{"type": "http.request", "body": body, "more_body": False}])
+            await app({
+                "type": "http", "method": "POST", "path": "/echo/", "query_string": b"", "server": ("test", 80),
+                "headers": [(b"content-type", b"application/cbor"), (b"accept", b"application/cbor"),
+                            (b"x-requested-with", b"XMLHttpRequest")],
+            }, lambda: asyncio.sleep(0, next(messages)), lambda message: asyncio.sleep(0, sent.append(message)))
+            return sent
+
+        start, body = asyncio.run(main())
+        self.assertIn((b"Content-Type", b"application/cbor"), start["headers"])
+        self.assertEqual({"moment": datetime(2016, 1, 2), "items": []}, cbor.loads(body["body"]))
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@unittest.skipUnless(msgpack, "msgpack is not installed")
+class TestMicroServiceFormat(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        app = Application()
+        app.route("/<action>/", DataController)
+        cls.server = make_server("127.0.0.1", 0, app, handler_class=QuietHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = "http://127.0.0.1:%s/echo/" % cls.server.server_port
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        MicroServiceClient.configure(format="msgpack")
+
+    def tearDown(self):
+        MicroServiceClient.configure(format=None)
+
+    def test_sync(self):
+        moment = datetime(2016, 1, 2, 3, 4, 5)
+        self.assertEqual(moment, microservice(self.url, {"moment": moment}, "moment"))
+
+    def test_async(self):
+        moment = datetime(2016, 1, 2, 3, 4, 5)
+        self.assertEqual(moment, asyncio.run(microservice_async(self.url, {"moment": moment}, "moment")))
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, MicroServiceClient.configure, format="xml")
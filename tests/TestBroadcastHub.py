@@ -0,0 +1,185 @@
+import json
+import queue
+import asyncio
+import threading
+import unittest
+from envi import AsgiApplication, Request, BroadcastHub, WebSocketControllerNb, WebSocketTransport, \
+    UwsgiWebSocketTransport, Frame
+from tests.TestWebSocket import FakeUwsgi, start_connection
+
+
+class QueueTransport(WebSocketTransport):
+    """ Транспорт без сокета: считает пробуждения обработчика """
+
+    def __init__(self):
+        super().__init__()
+        self.notified = 0
+
+    def notify(self):
+        self.notified += 1
+
+
+class Connection(object):
+    hubs = frozenset()
+
+    def __init__(self):
+        self.transport = QueueTransport()
+
+
+class TestBroadcastHub(unittest.TestCase):
+    def setUp(self):
+        self.serialized = []
+
+        def serializer(message):
+            self.serialized.append(message)
+            return json.dumps(message)
+
+        self.serializer = serializer
+
+    def test_publish(self):
+        """ Сообщение сериализуется один раз и попадает в очереди всех подписчиков темы """
+        hub = BroadcastHub(serializer=self.serializer)
+        connections = [Connection() for _ in range(1000)]
+        for connection in connections:
+            hub.subscribe(connection, "news")
+        hub.subscribe(connections[0], "private")
+        self.assertEqual(1000, hub.publish("news", {"n": 1}))
+        self.assertEqual(1, hub.publish("private", {"n": 2}))
+        self.assertEqual(0, hub.publish("nobody", {"n": 3}))
+        self.assertEqual(3, len(self.serialized))
+        frame = connections[1].transport.drain()[0]
+        self.assertIsInstance(frame, Frame)
+        self.assertEqual('{"n": 1}', frame.data)
+        self.assertTrue(all(c.transport.outbox[0] is frame for c in connections[2:]))
+        self.assertEqual(['{"n": 1}', '{"n": 2}'], [m.data for m in connections[0].transport.drain()])
+        self.assertEqual({"news", "private"}, set(hub.topics()))
+        self.assertEqual(1000, hub.subscribers("news"))
+
+    def test_wake_coalescing(self):
+        """ Сообщения, добавленные до пробуждения обработчика, будят его один раз """
+        hub = BroadcastHub()
+        connection = Connection()
+        hub.subscribe(connection, "news")
+        for i in range(10):
+            hub.publish("news", i)
+        self.assertEqual(1, connection.transport.notified)
+        self.assertEqual(10, len(connection.transport.drain()))
+        hub.publish("news", 10)
+        self.assertEqual(2, connection.transport.notified)
+
+    def test_drop_oldest(self):
+        hub = BroadcastHub(queue_size=2)
+        connection = Connection()
+        hub.subscribe(connection, "news")
+        for i in range(5):
+            self.assertEqual(1, hub.publish("news", i))
+        self.assertEqual(["3", "4"], [m.data for m in connection.transport.drain()])
+        stats = hub.stats()
+        self.assertEqual((5, 5, 3, 0), (stats["published"], stats["delivered"], stats["dropped"], stats["disconnected"]))
+
+    def test_disconnect_slow_consumer(self):
+        hub = BroadcastHub(queue_size=2, policy=BroadcastHub.DISCONNECT)
+        slow, fast = Connection(), Connection()
+        hub.subscribe(slow, "news", "other")
+        hub.subscribe(fast, "news")
+        for i in range(3):
+            fast.transport.drain()
+            hub.publish("news", i)
+        self.assertTrue(slow.transport.aborted)
+        self.assertFalse(fast.transport.aborted)
+        self.assertEqual(frozenset(), slow.hubs)
+        self.assertEqual(0, hub.subscribers("other"))
+        self.assertEqual(1, hub.stats()["disconnected"])
+        self.assertEqual(1, hub.publish("news", 3))
+
+    def test_unsubscribe(self):
+        hub = BroadcastHub()
+        connection = Connection()
+        hub.subscribe(connection, "a", "b")
+        self.assertEqual(frozenset({hub}), connection.hubs)
+        hub.unsubscribe(connection, "a")
+        self.assertEqual((0, 1), (hub.subscribers("a"), hub.subscribers("b")))
+        self.assertEqual(frozenset({hub}), connection.hubs)
+        hub.unsubscribe(connection)
+        self.assertEqual(frozenset(), connection.hubs)
+        self.assertEqual({"topics": 0, "connections": 0, "subscriptions": 0}, {
+            key: value for key, value in hub.stats().items() if key in ("topics", "connections", "subscriptions")
+        })
+
+    def test_policy(self):
+        self.assertRaises(ValueError, BroadcastHub, policy="block")
+
+
+hub = BroadcastHub(queue_size=10)
+
+
+class NewsController(WebSocketControllerNb):
+    uwsgi = None
+    connections = None
+
+    def create_transport(self):
+        return UwsgiWebSocketTransport(self.uwsgi)
+
+    def open(self, app, request, user, host):
+        hub.subscribe(self, "news")
+        self.connections.put(self)
+
+
+class TestBroadcastUwsgi(unittest.TestCase):
+    def test_broadcast(self):
+        """ Соединения uwsgi получают рассылку сразу и отписываются при закрытии """
+        clients = []
+        NewsController.connections = queue.Queue()
+        for _ in range(3):
+            NewsController.uwsgi = uwsgi = FakeUwsgi()
+            thread, exits = start_connection(NewsController, Request())
+            NewsController.connections.get(timeout=1)
+            clients.append((uwsgi, thread, exits))
+        self.assertEqual(3, hub.publish("news", {"title": "hello"}))
+        for uwsgi, thread, exits in clients:
+            self.assertEqual({"title": "hello"}, uwsgi.received())
+            uwsgi.client.close()
+            thread.join(1)
+            self.assertEqual(1, len(exits))
+            uwsgi.server.close()
+        self.assertEqual(0, hub.subscribers("news"))
+
+
+class AsyncNewsController(WebSocketControllerNb):
+    opened = None
+
+    async def open(self, app, request, user, host):
+        hub.subscribe(self, "news")
+        self.opened.put_nowait(self)
+
+
+class TestBroadcastAsgi(unittest.TestCase):
+    def test_broadcast(self):
+        """ Рассылка из другого потока доходит до всех ASGI-соединений """
+        app = AsgiApplication()
+        app.route("/news/", AsyncNewsController)
+
+        async def main():
+            AsyncNewsController.opened = asyncio.Queue()
+            clients = []
+            for _ in range(3):
+                incoming, sent = asyncio.Queue(), asyncio.Queue()
+                incoming.put_nowait({"type": "websocket.connect"})
+                task = asyncio.ensure_future(app({
+                    "type": "websocket", "path": "/news", "query_string": b"", "headers": [],
+                    "server": ("testserver", 80), "client": ("127.0.0.1", 5000), "scheme": "ws",
+                }, incoming.get, sent.put))
+                self.assertEqual("websocket.accept", (await sent.get())["type"])
+                await AsyncNewsController.opened.get()
+                clients.append((incoming, sent, task))
+
+            publisher = threading.Thread(target=hub.publish, args=("news", {"title": "hello"}))
+            publisher.start()
+            for incoming, sent, task in clients:
+                self.assertEqual({"title": "hello"}, json.loads((await asyncio.wait_for(sent.get(), 1))["text"]))
+                incoming.put_nowait({"type": "websocket.disconnect", "code": 1000})
+                await asyncio.wait_for(task, 1)
+            publisher.join()
+
+        asyncio.run(main())
+        self.assertEqual(0, hub.subscribers("news"))
@@ -0,0 +1,134 @@
+import gzip
+import json
+import unittest
+import zlib
+from urllib.parse import urlencode
+from webtest import TestApp
+from envi import Application, Controller, ResponseCompressor, StreamingResponse
+from tests import wsgi_request
+
+
+class DataController(Controller):
+    @staticmethod
+    def big(**kwargs):
+        return {"items": [{"i": i, "name": "item %d" % i} for i in range(500)]}
+
+    @staticmethod
+    def small(**kwargs):
+        return {"ok": True}
+
+    @staticmethod
+    def export(**kwargs):
+        return StreamingResponse(({"i": i, "name": "item %d" % i} for i in range(2000)), StreamingResponse.NDJSON)
+
+
+class ReportingApplication(Application):
+    compressor = ResponseCompressor()
+    reports = []
+
+    @classmethod
+    def compression_report(cls, request, encoding, original_size, compressed_size):
+        cls.reports.append((encoding, original_size, compressed_size))
+
+
+class TestResponseCompressor(unittest.TestCase):
+    def test_negotiate(self):
+        """ Кодировка выбирается по q-значениям клиента, при равенстве - по предпочтению сервера """
+        compressor = ResponseCompressor(encodings=("gzip", "deflate"))
+        self.assertEqual("gzip", compressor.negotiate("gzip, deflate, br"))
+        self.assertEqual("deflate", compressor.negotiate("deflate"))
+        self.assertEqual("deflate", compressor.negotiate("gzip;q=0.5, deflate;q=0.8"))
+        self.assertEqual("deflate", compressor.negotiate("gzip;q=0, *"))
+        self.assertIsNone(compressor.negotiate("identity"))
+        self.assertIsNone(compressor.negotiate("gzip;q=0"))
+        self.assertIsNone(compressor.negotiate(""))
+
+    def test_available(self):
+        """ Кодировки без установленных библиотек не используются """
+        compressor = ResponseCompressor()
+        self.assertIn("gzip", compressor.encodings)
+        for encoding in ("br", "zstd"):
+            self.assertEqual(ResponseCompressor.available(encoding), encoding in compressor.encodings)
+
+    def test_compress(self):
+        compressor = ResponseCompressor(levels={"gzip": 1})
+        self.assertEqual(b"x" * 1000, gzip.decompress(compressor.compress(b"x" * 1000, "gzip")))
+        self.assertEqual(b"x" * 1000, zlib.decompress(compressor.compress(b"x" * 1000, "deflate")))
+
+    def test_stream(self):
+        """ Каждая порция потока сжимается и сбрасывается сразу """
+        reports = []
+        chunks = list(ResponseCompressor().stream(iter([b"a" * 100, b"b" * 100]), "gzip",
+                                                  lambda *sizes: reports.append(sizes)))
+        self.assertEqual(3, len(chunks))
+        self.assertEqual(b"a" * 100, zlib.decompressobj(31).decompress(chunks[0]))
+        self.assertEqual(b"a" * 100 + b"b" * 100, gzip.decompress(b"".join(chunks)))
+        self.assertEqual([(200, len(b"".join(chunks)))], reports)
+
+
+class TestCompressedRoute(unittest.TestCase):
+    def setUp(self):
+        ReportingApplication.reports = []
+        self.app = ReportingApplication()
+        self.app.route("/<action>/", DataController)
+        self.app.route("/plain/<action>/", DataController, compress=False)
+
+    def call(self, path, **environ):
+        return wsgi_request(self.app, path, HTTP_X_REQUESTED_WITH="XMLHttpRequest", **environ)
+
+    def test_gzip(self):
+        headers, body = self.call("/big/", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual("gzip", headers["Content-Encoding"])
+        self.assertEqual("Accept-Encoding", headers["Vary"])
+        self.assertEqual(str(len(body)), headers["Content-Length"])
+        self.assertEqual(DataController.big(), json.loads(gzip.decompress(body).decode()))
+        [(encoding, original, compressed)] = ReportingApplication.reports
+        self.assertEqual(("gzip", len(body)), (encoding, compressed))
+        self.assertGreater(original, compressed)
+
+    def test_not_accepted(self):
+        headers, body = self.call("/big/")
+        self.assertNotIn("Content-Encoding", headers)
+        self.assertEqual("Accept-Encoding", headers["Vary"])
+        self.assertEqual(DataController.big(), json.loads(body.decode()))
+
+    def test_min_size(self):
+        headers, body = self.call("/small/", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertNotIn("Content-Encoding", headers)
+        self.assertEqual({"ok": True}, json.loads(body.decode()))
+
+    def test_route_opt_out(self):
+        headers, body = self.call("/plain/big/", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertNotIn("Content-Encoding", headers)
+        self.assertEqual(DataController.big(), json.loads(body.decode()))
+
+    def test_disabled(self):
+        self.app.compressor = None
+        self.assertNotIn("Content-Encoding", self.call("/big/", HTTP_ACCEPT_ENCODING="gzip")[0])
+
+    def test_disabled_by_default(self):
+        """ Сжатие не меняет ответы приложений, которые его не включили """
+        app = Application()
+        app.route("/<action>/", DataController)
+        headers, _ = wsgi_request(app, "/big/", HTTP_X_REQUESTED_WITH="XMLHttpRequest", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertNotIn("Content-Encoding", headers)
+        self.assertNotIn("Vary", headers)
+
+    def test_stream(self):
+        headers, body = self.call("/export/", HTTP_ACCEPT_ENCODING="deflate")
+        self.assertEqual("deflate", headers["Content-Encoding"])
+        self.assertNotIn("Content-Length", headers)
+        lines = zlib.decompress(body).decode().splitlines()
+        self.assertEqual(2000, len(lines))
+        self.assertEqual([("deflate", sum(len(line) + 1 for line in lines), len(body))], ReportingApplication.reports)
+
+    def test_json_rpc(self):
+        query = urlencode({"q": json.dumps({"jsonrpc": "2.0", "method": "big", "id": 1})})
+        headers, body = self.call("/big/", HTTP_ACCEPT_ENCODING="gzip", QUERY_STRING=query)
+        self.assertEqual("gzip", headers["Content-Encoding"])
+        self.assertEqual(DataController.big(), json.loads(gzip.decompress(body).decode())["result"])
+
+    def test_webtest(self):
+        """ Клиенты, принимающие сжатые ответы, получают те же данные """
+        response = TestApp(self.app).get("/big/", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(DataController.big(), json.loads(response.body.decode()))
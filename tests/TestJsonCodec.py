@@ -0,0 +1,77 @@
+import json
+import unittest
+from datetime import datetime, date, time
+from envi import JsonCodec, json_dumps_handler, json_loads_handler, datetime_hook
+
+
+def available_codecs():
+    codecs = []
+    for backend in JsonCodec.backends:
+        try:
+            codecs.append(JsonCodec(backend))
+        except ImportError:
+            pass
+    return codecs
+
+
+class TestJsonCodec(unittest.TestCase):
+    payload = {
+        "int": 1, "float": 1.5, "str": "строка", "none": None, "bool": True, "list": [1, "2", {"a": [3]}],
+        "datetime": datetime(2016, 1, 2, 3, 4, 5), "date": date(2016, 1, 2), "time": time(3, 4, 5),
+    }
+
+    def test_stdlib_output(self):
+        """ Стандартная библиотека выводит то же, что и json.dumps с json_dumps_handler """
+        self.assertEqual(json.dumps(self.payload, default=json_dumps_handler), JsonCodec("json").dumps(self.payload))
+
+    def test_backends_are_equivalent(self):
+        """ Все доступные библиотеки кодируют и декодируют одинаково """
+        expected = json.loads(json.dumps(self.payload, default=json_dumps_handler), object_hook=json_loads_handler)
+        for codec in available_codecs():
+            self.assertEqual(expected, codec.loads(codec.dumps(self.payload), object_hook=json_loads_handler),
+                             codec.backend)
+            self.assertEqual(expected, codec.loads(codec.dumps(self.payload).encode(), object_hook=json_loads_handler),
+                             codec.backend)
+
+    def test_object_hook_order(self):
+        """ object_hook применяется к вложенным объектам раньше, чем к внешним """
+        for codec in available_codecs():
+            calls = []
+            codec.loads('{"a": {"b": {"c": 1}}, "d": [{"e": 2}]}', object_hook=lambda o: calls.append(sorted(o)) or o)
+            self.assertEqual([["c"], ["b"], ["e"], ["a", "d"]], calls, codec.backend)
+
+    def test_fallback(self):
+        """ Объекты, неподдерживаемые ускоренной библиотекой, сериализуются стандартным json """
+        for codec in available_codecs():
+            self.assertEqual({"1": 2}, json.loads(codec.dumps({1: 2})), codec.backend)
+            self.assertEqual(2 ** 70, json.loads(codec.dumps(2 ** 70)), codec.backend)
+            self.assertEqual(2 ** 70, codec.loads(str(2 ** 70)), codec.backend)
+
+    def test_invalid_json(self):
+        """ Некорректный JSON вызывает ValueError """
+        for codec in available_codecs():
+            self.assertRaises(ValueError, codec.loads, "{")
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, JsonCodec, "pickle")
+
+
+class TestDatetimeRevival(unittest.TestCase):
+    ctime = datetime(2016, 1, 2, 3, 4, 5).ctime()
+
+    def test_json_loads_handler(self):
+        """ Строки в формате ctime() восстанавливаются в datetime, остальные строки не меняются """
+        data = json_loads_handler({"a": self.ctime, "b": "short", "c": "no colons in this long string at all", "d": 1})
+        self.assertEqual({"a": datetime(2016, 1, 2, 3, 4, 5), "b": "short",
+                          "c": "no colons in this long string at all", "d": 1}, data)
+
+    def test_disabled(self):
+        """ Восстановление дат можно отключить """
+        self.assertIsNone(datetime_hook(False))
+        self.assertIs(json_loads_handler, datetime_hook(True))
+
+    def test_declared_keys(self):
+        """ Восстановление дат можно ограничить набором ключей """
+        hook = datetime_hook(("a",))
+        self.assertEqual({"a": datetime(2016, 1, 2, 3, 4, 5), "b": self.ctime}, hook({"a": self.ctime, "b": self.ctime}))
+        self.assertEqual({"b": self.ctime}, datetime_hook("a")({"b": self.ctime}))
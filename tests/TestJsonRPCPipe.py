@@ -1,5 +1,7 @@
 import unittest
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from webtest import TestApp
 from envi import Application, Controller
 
@@ -44,6 +46,16 @@ class JsonRpcController(Controller):
     def dummy_action(**kwargs):
         pass
 
+    @staticmethod
+    def sleep(request, **kwargs):
+        time.sleep(request.get("seconds"))
+        request.response.add_header("X-Slept", str(request.get("seconds")))
+        return request.get("seconds")
+
+    @staticmethod
+    def get_a(request, **kwargs):
+        return request.get("a", None)
+
 
 class TestJsonRpcPipe(unittest.TestCase):
     def setUp(self):
@@ -185,6 +197,13 @@ class TestJsonRpcPipe(unittest.TestCase):
             self.test_app.get("/", params={'q': '{"jsonrpc": "2.0", "method": "qwerty", "id": 1}'}).body.decode()
         )
 
+    def test_framework_method_not_found(self):
+        """ Методы фреймворка недоступны как методы JSON-RPC """
+        self.assertJsonEqual(
+            '{"jsonrpc": "2.0", "error": {"code": -32601, "message": "Method not found"}, "id": 1}',
+            self.test_app.get("/", params={'q': '{"jsonrpc": "2.0", "method": "setup", "id": 1}'}).body.decode()
+        )
+
     def test_server_error(self):
         """ Корректный ответ для явно не отловленных исключений """
         self.assertJsonEqual(
@@ -205,3 +224,49 @@ class TestJsonRpcPipe(unittest.TestCase):
             '{"jsonrpc": "2.0", "result": null, "id": 1}',
             self.test_app.get("/", params={'q': '{"jsonrpc": "2.0", "method": "dummy_action", "id": 1}'}).body.decode()
         )
+
+
+class TestParallelJsonRpcPipe(TestJsonRpcPipe):
+    """ Все тесты JSON-RPC выполняются и при параллельной обработке пачек """
+    def setUp(self):
+        app = Application()
+        app.json_rpc_executor = ThreadPoolExecutor(max_workers=8)
+        app.route("/", JsonRpcController)
+        self.test_app = TestApp(app)
+
+    def test_parallel_batch(self):
+        """ Пачка медленных вызовов выполняется за время самого медленного, порядок ответов сохраняется """
+        started = time.time()
+        response = self.test_app.get("/", params={'q': json.dumps([
+            {"jsonrpc": "2.0", "method": "sleep", "params": {"seconds": 0.3}, "id": 1},
+            {"jsonrpc": "2.0", "method": "sleep", "params": {"seconds": 0.1}},
+            {"jsonrpc": "2.0", "method": "sleep", "params": {"seconds": 0.2}, "id": 2},
+            {"jsonrpc": "2.0", "method": "sleep", "params": {"seconds": 0.1}, "id": 3},
+        ])})
+        self.assertLess(time.time() - started, 0.6)
+        self.assertJsonEqual(
+            """
+            [
+                {"jsonrpc": "2.0", "result": 0.3, "id": 1},
+                {"jsonrpc": "2.0", "result": 0.2, "id": 2},
+                {"jsonrpc": "2.0", "result": 0.1, "id": 3}
+            ]
+            """,
+            response.body.decode()
+        )
+        self.assertIn("X-Slept", response.headers)
+
+    def test_isolated_requests(self):
+        """ Параметры одного вызова пачки не видны другим вызовам """
+        self.assertJsonEqual(
+            """
+            [
+                {"jsonrpc": "2.0", "result": 1, "id": 1},
+                {"jsonrpc": "2.0", "result": null, "id": 2}
+            ]
+            """,
+            self.test_app.get("/", params={'q': json.dumps([
+                {"jsonrpc": "2.0", "method": "get_a", "params": {"a": 1}, "id": 1},
+                {"jsonrpc": "2.0", "method": "get_a", "params": {}, "id": 2},
+            ])}).body.decode()
+        )
@@ -0,0 +1,132 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+from webtest import TestApp
+from envi import Application, Controller, Metrics
+
+
+class MeteredController(Controller):
+    @staticmethod
+    def ok(**kwargs):
+        return "ok"
+
+    @staticmethod
+    def fail(**kwargs):
+        raise ValueError("fail")
+
+
+class QuietApplication(Application):
+    @classmethod
+    def log(cls, err):
+        pass
+
+
+def serve_requests(directory, count):
+    """ Обработка запросов в отдельном процессе (воркере) """
+    app = QuietApplication()
+    app.metrics = Metrics(directory)
+    app.route("/<action>/", MeteredController)
+    for _ in range(count):
+        TestApp(app).get("/ok/")
+    app.metrics.flush()
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = QuietApplication()
+        self.app.route_metrics(metrics=Metrics(self.directory))
+        self.app.route("/<action>/", MeteredController)
+        self.test_app = TestApp(self.app)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def exposition(self):
+        response = self.test_app.get("/metrics")
+        self.assertTrue(response.headers["Content-Type"].startswith("text/plain; version=0.0.4"))
+        return response.body.decode()
+
+    def test_requests(self):
+        """ Количество запросов и гистограмма времени обработки по роутам и действиям """
+        self.test_app.get("/ok/")
+        self.test_app.get("/ok/")
+        text = self.exposition()
+        self.assertIn('envi_requests_total{route="/<action>",action="ok"} 2', text)
+        self.assertIn('envi_request_duration_seconds_bucket{route="/<action>",action="ok",le="+Inf"} 2', text)
+        self.assertIn('envi_request_duration_seconds_count{route="/<action>",action="ok"} 2', text)
+        self.assertIn("# TYPE envi_request_duration_seconds histogram", text)
+
+    def test_errors(self):
+        """ Ошибки учитываются по классам исключений """
+        self.test_app.get("/fail/")
+        self.assertIn('envi_request_errors_total{route="/<action>",action="fail",exception="ValueError"} 1',
+                      self.exposition())
+
+    def test_in_flight(self):
+        """ Запрос к метрикам учитывается как выполняющийся """
+        self.assertIn('envi_requests_in_flight{route="/metrics"} 1', self.exposition())
+
+    def test_unknown_action(self):
+        """ Произвольные значения action не порождают новых серий """
+        self.test_app.get("/", params={"action": "a b"}, status=404)
+        self.test_app.get("/x-y/")
+        self.test_app.get("/no_such_action/")
+        text = self.exposition()
+        self.assertNotIn('action="x-y"', text)
+        self.assertNotIn('action="no_such_action"', text)
+        self.assertIn('envi_requests_total{route="/<action>",action="other"} 2', text)
+
+    def test_histogram_buckets(self):
+        metrics = Metrics(buckets=(0.1, 1.0))
+        for duration in (0.05, 0.5, 0.7, 5.0):
+            metrics.finished("/", "index", duration)
+        text = metrics.exposition()
+        self.assertIn('envi_request_duration_seconds_bucket{route="/",action="index",le="0.1"} 1', text)
+        self.assertIn('envi_request_duration_seconds_bucket{route="/",action="index",le="1.0"} 3', text)
+        self.assertIn('envi_request_duration_seconds_bucket{route="/",action="index",le="+Inf"} 4', text)
+        self.assertIn('envi_request_duration_seconds_sum{route="/",action="index"} 6.25', text)
+
+    def test_max_series(self):
+        metrics = Metrics(max_series=1)
+        metrics.finished("/", "a", 0.1)
+        metrics.finished("/", "b", 0.1)
+        self.assertIn('envi_requests_total{route="/",action="other"} 1', metrics.exposition())
+
+    def test_escaping(self):
+        metrics = Metrics()
+        metrics.finished('/"quoted"\\', "a", 0.1)
+        self.assertIn('route="/\\"quoted\\"\\\\"', metrics.exposition())
+
+    @unittest.skipUnless(hasattr(os, "fork"), "fork is not available")
+    def test_processes(self):
+        """ Метрики воркеров суммируются; запросы в работе завершившихся воркеров не учитываются """
+        context = multiprocessing.get_context("fork")
+        workers = [context.Process(target=serve_requests, args=(self.directory, 3)) for _ in range(2)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.test_app.get("/ok/")
+        text = self.exposition()
+        self.assertIn('envi_requests_total{route="/<action>",action="ok"} 7', text)
+        self.assertIn('envi_requests_in_flight{route="/<action>"} 0', text)
+        # Снимки завершившихся воркеров перенесены в итог
+        self.assertEqual([], [name for name in os.listdir(self.directory) if name.startswith("metrics-")])
+        self.assertIn(Metrics.retired_filename, os.listdir(self.directory))
+        self.assertIn('envi_requests_total{route="/<action>",action="ok"} 7', self.exposition())
+
+    def test_reused_pid(self):
+        """ Снимок прежнего процесса с тем же pid переносится в итог, а не перезаписывается """
+        previous = Metrics(self.directory)
+        previous.finished("/<action>", "ok", 0.1)
+        previous.finished("/<action>", "ok", 0.1)
+        previous.flush()
+        metrics = Metrics(self.directory)
+        metrics.finished("/<action>", "ok", 0.1)
+        self.assertEqual(3, metrics.collect()["requests"]['["/<action>", "ok"]'])
+        metrics.flush()
+        self.assertEqual(3, metrics.collect()["requests"]['["/<action>", "ok"]'])
+        self.assertEqual(3, Metrics(self.directory).collect()["requests"]['["/<action>", "ok"]'])
@@ -0,0 +1,374 @@
+import asyncio
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from envi import microservice, microservice_many, microservice_async, MicroServiceClient, MicroServiceCache
+from envi.classes import AsyncMicroServiceClient
+from envi.classes import UnexpectedResultFromMicroService
+
+
+class MicroServiceHandler(BaseHTTPRequestHandler):
+    """ Тестовый микросервис: возвращает полученные данные в ключе result """
+    protocol_version = "HTTP/1.1"
+    connections = set()
+    requests = 0
+    cookies = []
+
+    def do_POST(self):
+        MicroServiceHandler.connections.add(self.client_address)
+        MicroServiceHandler.requests += 1
+        MicroServiceHandler.cookies.append(self.headers.get("Cookie"))
+        data = json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode())
+        if data.get("sleep"):
+            time.sleep(data["sleep"])
+        if data.get("fail"):
+            body = json.dumps({"error": {"code": 7, "message": "fail"}}).encode()
+        else:
+            body = json.dumps({"result": data}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        if data.get("set_cookie"):
+            self.send_header("Set-Cookie", "sid=%s; Path=/" % data["set_cookie"])
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # Очередь по умолчанию (5) переполняется при одновременных подключениях, и клиенты ждут повтора SYN
+    request_queue_size = 128
+
+
+class MicroServiceFixture(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), MicroServiceHandler)
+        cls.url = "http://127.0.0.1:%s/" % cls.server.server_address[1]
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        MicroServiceClient.close()
+
+
+class MicroServiceTests(MicroServiceFixture):
+    """ Тесты функции microservice """
+
+    def test_target_key(self):
+        """ Из ответа микросервиса возвращается значение по составному ключу """
+        self.assertEqual(1, microservice(self.url, {"a": {"b": 1}}, "result.a.b"))
+        self.assertRaises(UnexpectedResultFromMicroService, microservice, self.url, {"a": 1}, "result.b")
+
+    def test_error(self):
+        """ Ошибка микросервиса превращается в UnexpectedResultFromMicroService с его кодом """
+        with self.assertRaises(UnexpectedResultFromMicroService) as cm:
+            microservice(self.url, {"fail": True})
+        self.assertEqual(7, cm.exception.code)
+
+    def test_connection_error(self):
+        """ Недоступный сервис превращается в UnexpectedResultFromMicroService """
+        self.assertRaises(UnexpectedResultFromMicroService, microservice, "http://127.0.0.1:1/", {})
+
+    def test_keep_alive(self):
+        """ Последовательные вызовы переиспользуют одно соединение из пула """
+        MicroServiceClient.close()
+        MicroServiceHandler.connections.clear()
+        for i in range(5):
+            self.assertEqual(i, microservice(self.url, {"i": i}, "result.i"))
+        self.assertEqual(1, len(MicroServiceHandler.connections))
+
+    def test_cookies_are_not_shared(self):
+        """ Cookies, установленные микросервисом, не отправляются в последующих вызовах (сессия общая) """
+        MicroServiceHandler.cookies = []
+        microservice(self.url, {"set_cookie": "user1"})
+        microservice(self.url, {"a": 1})
+        self.assertEqual([None, None], MicroServiceHandler.cookies)
+
+    def test_reset(self):
+        """ После сброса (например, после fork) создается новая сессия """
+        session = MicroServiceClient.session()
+        self.assertIs(session, MicroServiceClient.session())
+        MicroServiceClient.reset()
+        self.assertIsNot(session, MicroServiceClient.session())
+
+
+class AsyncMicroServiceClientTests(MicroServiceFixture):
+    """ Тесты повторов запросов асинхронного клиента """
+
+    def setUp(self):
+        MicroServiceHandler.requests = 0
+
+    def tearDown(self):
+        AsyncMicroServiceClient.configure(timeout=60)
+
+    def test_timeout_is_not_retried(self):
+        """ Медленный ответ в переиспользованном соединении не приводит к повторной отправке запроса """
+        AsyncMicroServiceClient.configure(timeout=0.3)
+
+        async def main():
+            await microservice_async(self.url, {"i": 1})
+            with self.assertRaises(UnexpectedResultFromMicroService):
+                await microservice_async(self.url, {"sleep": 0.6})
+
+        asyncio.run(main())
+        time.sleep(0.4)
+        self.assertEqual(2, MicroServiceHandler.requests)
+
+    def test_closed_idle_connection_is_retried(self):
+        """ Запрос, отправленный в закрытое сервером простаивающее соединение, повторяется в новом один раз """
+        connections = []
+
+        async def handle(reader, writer):
+            connections.append(writer)
+            await reader.readuntil(b"\r\n\r\n")
+            body = b'{"result": 1}'
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n%s" % (
+                len(body), body
+            ))
+            await writer.drain()
+            writer.close()
+
+        async def main():
+            server = await asyncio.start_server(handle, "127.0.0.1", 0)
+            url = "http://127.0.0.1:%s/" % server.sockets[0].getsockname()[1]
+            results = [await microservice_async(url, {}, "result") for _ in range(2)]
+            server.close()
+            return results
+
+        self.assertEqual([1, 1], asyncio.run(main()))
+        self.assertEqual(2, len(connections))
+
+
+    def serve(self, responses):
+        """ Запускает сервер, отвечающий на запросы в одном соединении заранее заданными ответами """
+        connections = []
+
+        async def handle(reader, writer):
+            connections.append(writer)
+            for response in responses:
+                await reader.readuntil(b"\r\n\r\n")
+                writer.write(response)
+                await writer.drain()
+
+        async def main():
+            server = await asyncio.start_server(handle, "127.0.0.1", 0)
+            url = "http://127.0.0.1:%s/" % server.sockets[0].getsockname()[1]
+            AsyncMicroServiceClient.configure(timeout=2)
+            results = []
+            for _ in responses:
+                status, headers, content = await AsyncMicroServiceClient.request(url, b"", {})
+                results.append((status, content))
+            await AsyncMicroServiceClient.close()
+            server.close()
+            return results
+
+        return asyncio.run(main()), connections
+
+    def test_no_content(self):
+        """ Ответы 204 и 304 без Content-Length не имеют тела: соединение не ждет закрытия и переиспользуется """
+        results, connections = self.serve([
+            b"HTTP/1.1 204 No Content\r\n\r\n",
+            b"HTTP/1.1 304 Not Modified\r\nETag: \"a\"\r\n\r\n",
+            b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok",
+        ])
+        self.assertEqual([(204, b""), (304, b""), (200, b"ok")], results)
+        self.assertEqual(1, len(connections))
+
+    def test_interim_response(self):
+        """ Промежуточные ответы 1xx пропускаются, возвращается окончательный ответ """
+        results, connections = self.serve([
+            b"HTTP/1.1 100 Continue\r\n\r\nHTTP/1.1 103 Early Hints\r\nLink: </a.css>\r\n\r\n"
+            b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok",
+        ])
+        self.assertEqual([(200, b"ok")], results)
+
+
+class MicroServiceManyTests(MicroServiceFixture):
+    """ Тесты параллельных вызовов microservice_many """
+
+    def test_order(self):
+        """ Результаты возвращаются в порядке запросов """
+        specs = [(self.url, {"i": i, "sleep": 0.05 * (5 - i)}, "result.i") for i in range(5)]
+        self.assertEqual([0, 1, 2, 3, 4], microservice_many(specs))
+
+    def test_concurrency(self):
+        """ Запросы выполняются одновременно: общее время близко ко времени самого медленного """
+        started = time.time()
+        microservice_many([(self.url, {"sleep": 0.2}) for _ in range(5)])
+        self.assertLess(time.time() - started, 0.6)
+
+    def test_bounded_concurrency(self):
+        """ max_workers ограничивает количество одновременных запросов """
+        started = time.time()
+        microservice_many([(self.url, {"sleep": 0.1}) for _ in range(4)], max_workers=2)
+        self.assertGreaterEqual(time.time() - started, 0.2)
+
+    def test_fail_fast(self):
+        """ В режиме fail_fast поднимается исключение первого неудачного запроса """
+        specs = [(self.url, {"i": 1}, "result.i"), (self.url, {"fail": True})]
+        with self.assertRaises(UnexpectedResultFromMicroService) as cm:
+            microservice_many(specs)
+        self.assertEqual(7, cm.exception.code)
+
+    def test_collect_all(self):
+        """ Без fail_fast ошибки возвращаются на местах соответствующих результатов """
+        results = microservice_many(
+            [(self.url, {"i": 1}, "result.i"), (self.url, {"fail": True}), (self.url, {"i": 3}, "result.i", {})],
+            fail_fast=False
+        )
+        self.assertEqual(1, results[0])
+        self.assertIsInstance(results[1], UnexpectedResultFromMicroService)
+        self.assertEqual(3, results[2])
+
+    def test_invalid_spec(self):
+        """ Некорректный формат запроса """
+        self.assertRaises(ValueError, microservice_many, [(self.url,)])
+
+
+class MicroServiceCacheTests(MicroServiceFixture):
+    """ Тесты кеширования ответов микросервисов """
+
+    def setUp(self):
+        MicroServiceHandler.requests = 0
+
+    def test_cache_hit(self):
+        """ Повторный запрос с теми же данными не уходит в микросервис """
+        cache = MicroServiceCache(ttl=60)
+        self.assertEqual(1, microservice(self.url, {"a": 1, "b": 2}, "result.a", cache=cache))
+        self.assertEqual(1, microservice(self.url, {"b": 2, "a": 1}, "result.a", cache=cache))
+        self.assertEqual(2, microservice(self.url, {"a": 1, "b": 2}, "result.b", cache=cache))
+        self.assertEqual(2, MicroServiceHandler.requests)
+        self.assertEqual({"hits": 1, "misses": 2, "evictions": 0, "size": 2, "maxsize": 1024}, cache.stats())
+
+    def test_ttl(self):
+        """ Устаревшие записи запрашиваются заново """
+        cache = MicroServiceCache(ttl=0.05)
+        microservice(self.url, {"a": 1}, cache=cache)
+        time.sleep(0.1)
+        microservice(self.url, {"a": 1}, cache=cache)
+        self.assertEqual(2, MicroServiceHandler.requests)
+
+    def test_lru_eviction(self):
+        """ При переполнении вытесняются давно не использованные записи """
+        cache = MicroServiceCache(maxsize=2)
+        microservice(self.url, {"a": 1}, cache=cache)
+        microservice(self.url, {"a": 2}, cache=cache)
+        microservice(self.url, {"a": 1}, cache=cache)
+        microservice(self.url, {"a": 3}, cache=cache)
+        self.assertEqual(1, cache.evictions)
+        microservice(self.url, {"a": 1}, cache=cache)
+        self.assertEqual(3, MicroServiceHandler.requests)
+
+    def test_errors(self):
+        """ Ошибки кешируются только при включенном негативном кешировании """
+        for cache_errors, expected_requests in ((False, 2), (True, 1)):
+            MicroServiceHandler.requests = 0
+            cache = MicroServiceCache(cache_errors=cache_errors)
+            for _ in range(2):
+                with self.assertRaises(UnexpectedResultFromMicroService) as cm:
+                    microservice(self.url, {"fail": True}, cache=cache)
+                self.assertEqual(7, cm.exception.code)
+            self.assertEqual(expected_requests, MicroServiceHandler.requests)
+
+    def test_invalidate(self):
+        """ Кеш можно сбросить """
+        cache = MicroServiceCache()
+        microservice(self.url, {"a": 1}, cache=cache)
+        cache.invalidate()
+        microservice(self.url, {"a": 1}, cache=cache)
+        self.assertEqual(2, MicroServiceHandler.requests)
+
+
+class MicroServiceCoalescingTests(MicroServiceFixture):
+    """ Тесты объединения одинаковых одновременных вызовов """
+
+    def setUp(self):
+        MicroServiceHandler.requests = 0
+
+    def call_in_threads(self, data, count=5):
+        results = [None] * count
+
+        def call(i):
+            try:
+                results[i] = microservice(self.url, data, "result", coalesce=True)
+            except Exception as err:
+                results[i] = err
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_threads(self):
+        """ Одновременные одинаковые вызовы из потоков выполняют один HTTP-запрос """
+        results = self.call_in_threads({"a": 1, "sleep": 0.2})
+        self.assertEqual([{"a": 1, "sleep": 0.2}] * 5, results)
+        self.assertEqual(1, MicroServiceHandler.requests)
+
+    def test_shared_exception(self):
+        """ Исключение единственного запроса получают все ожидающие """
+        results = self.call_in_threads({"fail": True, "sleep": 0.2})
+        self.assertTrue(all(isinstance(r, UnexpectedResultFromMicroService) for r in results))
+        self.assertEqual(1, MicroServiceHandler.requests)
+
+    def test_async(self):
+        """ Одновременные одинаковые вызовы из корутин выполняют один HTTP-запрос """
+        async def main():
+            return await asyncio.gather(
+                *[microservice_async(self.url, {"a": 1, "sleep": 0.2}, "result.a", coalesce=True) for _ in range(5)]
+            )
+
+        self.assertEqual([1] * 5, asyncio.run(main()))
+        self.assertEqual(1, MicroServiceHandler.requests)
+
+    def test_threads_and_coroutines(self):
+        """ Одинаковые вызовы из потоков и корутин объединяются в один HTTP-запрос (кто бы ни начал первым) """
+        data = {"a": 1, "sleep": 0.3}
+        for async_first in (True, False):
+            MicroServiceHandler.requests = 0
+            results = []
+            started = threading.Event()
+
+            async def main():
+                if not async_first:
+                    started.wait()
+                    await asyncio.sleep(0.05)
+                task = asyncio.ensure_future(
+                    asyncio.gather(*[microservice_async(self.url, data, "result.a", coalesce=True) for _ in range(3)])
+                )
+                await asyncio.sleep(0.05)
+                started.set()
+                return await task
+
+            def call():
+                if async_first:
+                    started.wait()
+                else:
+                    started.set()
+                results.append(microservice(self.url, data, "result.a", coalesce=True))
+
+            threads = [threading.Thread(target=call) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            self.assertEqual([1] * 3, asyncio.run(main()))
+            for thread in threads:
+                thread.join()
+            self.assertEqual([1] * 3, results)
+            self.assertEqual(1, MicroServiceHandler.requests)
+
+    def test_sequential_calls_are_not_coalesced(self):
+        """ Завершенный вызов не переиспользуется последующими """
+        microservice(self.url, {"a": 1}, coalesce=True)
+        microservice(self.url, {"a": 1}, coalesce=True)
+        self.assertEqual(2, MicroServiceHandler.requests)
@@ -0,0 +1,125 @@
+import json
+import unittest
+from datetime import datetime
+from io import BytesIO
+from webtest import TestApp
+from envi import Application, Controller, RequestStream, json_loads_handler
+
+
+class StreamingController(Controller):
+    """ Действия, читающие тело запроса потоком """
+
+    @staticmethod
+    def json_array(request, **kwargs):
+        return {"count": sum(1 for _ in request.stream.json_array()), "mode": request.get("mode", None)}
+
+    @staticmethod
+    def ndjson(request, **kwargs):
+        return [item["i"] for item in request.stream.ndjson()]
+
+    @staticmethod
+    def form(request, **kwargs):
+        return dict(request.stream.form())
+
+    @staticmethod
+    def spool(request, **kwargs):
+        return len(request.stream.spool(max_memory=16).read())
+
+    @staticmethod
+    def twice(request, **kwargs):
+        request.stream.spool()
+        try:
+            request.stream.spool()
+        except RequestStream.AlreadyConsumed:
+            return "consumed"
+
+
+def stream(body, environ=None, chunk_size=7):
+    """ Поток над телом body, читаемый маленькими порциями, чтобы элементы пересекали границы порций """
+    stream = RequestStream(dict({"wsgi.input": BytesIO(body), "CONTENT_LENGTH": str(len(body))}, **(environ or {})))
+    stream.chunk_size = chunk_size
+    return stream
+
+
+class TestRequestStream(unittest.TestCase):
+    def test_json_array(self):
+        """ Элементы JSON-массива разбираются независимо от границ порций """
+        items = [1, 12345, -1.5e3, "строка, с запятой ]", {"a": [1, {"b": None}]}, [], True, None]
+        self.assertEqual(items, list(stream(json.dumps(items, ensure_ascii=False).encode()).json_array()))
+        self.assertEqual([12345], list(stream(b" [ 12345 ] ").json_array()))
+        self.assertEqual([], list(stream(b"[]").json_array()))
+
+    def test_json_array_object_hook(self):
+        """ К элементам массива применяется object_hook """
+        items = list(stream(b'[{"d": "Mon Jan  1 10:00:00 2018"}]').json_array(object_hook=json_loads_handler))
+        self.assertEqual([{"d": datetime(2018, 1, 1, 10, 0)}], items)
+
+    def test_invalid_json_array(self):
+        """ Некорректное тело приводит к ValueError """
+        for body in (b"", b"{}", b"[1, 2", b"[1 2]", b"[1,]"):
+            with self.assertRaises(ValueError):
+                list(stream(body).json_array())
+
+    def test_ndjson(self):
+        """ Строки NDJSON разбираются по одной, пустые строки пропускаются """
+        self.assertEqual([{"i": 1}, {"i": "два"}, {"i": 3}],
+                         list(stream('{"i": 1}\n\n{"i": "два"}\r\n{"i": 3}'.encode()).ndjson()))
+
+    def test_form(self):
+        """ Пары urlencoded-формы декодируются """
+        self.assertEqual([("a", "1"), ("имя", "два слова"), ("empty", "")],
+                         list(stream(b"a=1&%D0%B8%D0%BC%D1%8F=%D0%B4%D0%B2%D0%B0+%D1%81%D0%BB%D0%BE%D0%B2%D0%B0&empty=")
+                              .form()))
+
+    def test_chunked(self):
+        """ Тело в chunked-кодировке """
+        body = b"5\r\n[1, 2\r\n4\r\n, 3]\r\n0\r\n\r\n"
+        self.assertEqual([1, 2, 3], list(stream(body, {"HTTP_TRANSFER_ENCODING": "chunked"}).json_array()))
+
+    def test_content_length(self):
+        """ Читается не больше Content-Length байт; без Content-Length тело не читается """
+        self.assertEqual(b"[1]", stream(b"[1]garbage", {"CONTENT_LENGTH": "3"}).spool().read())
+        self.assertEqual(b"", stream(b"[1]", {"CONTENT_LENGTH": ""}).spool().read())
+
+    def test_already_consumed(self):
+        """ Тело читается только один раз """
+        body = stream(b"[1]")
+        list(body.chunks())
+        self.assertRaises(RequestStream.AlreadyConsumed, body.chunks)
+
+
+class TestStreamingRoute(unittest.TestCase):
+    def setUp(self):
+        app = Application()
+        app.route("/stream/<action>/", StreamingController, streaming=True)
+        app.route("/buffered/<action>/", StreamingController)
+        self.test_app = TestApp(app)
+
+    def test_json_array(self):
+        """ Тело не разбирается в параметры запроса, параметры строки запроса доступны """
+        body = json.dumps([{"i": i} for i in range(1000)]).encode()
+        response = self.test_app.post("/stream/json_array/?mode=bulk", body, content_type="application/json")
+        self.assertEqual({"count": 1000, "mode": "bulk"}, json.loads(response.body.decode()))
+
+    def test_ndjson(self):
+        body = "\n".join(json.dumps({"i": i}) for i in range(5)).encode()
+        response = self.test_app.post("/stream/ndjson/", body, content_type="application/x-ndjson")
+        self.assertEqual([0, 1, 2, 3, 4], json.loads(response.body.decode()))
+
+    def test_form(self):
+        response = self.test_app.post("/stream/form/", {"a": "1", "b": "два"})
+        self.assertEqual({"a": "1", "b": "два"}, json.loads(response.body.decode()))
+
+    def test_spool(self):
+        response = self.test_app.post("/stream/spool/", b"x" * 100000, content_type="application/octet-stream")
+        self.assertEqual("100000", response.body.decode())
+
+    def test_twice(self):
+        response = self.test_app.post("/stream/twice/", b"x", content_type="application/octet-stream")
+        self.assertEqual("consumed", response.body.decode())
+
+    def test_buffered_route(self):
+        """ На обычном роуте тело, уже прочитанное bottle, доступно через поток """
+        body = "\n".join(json.dumps({"i": i}) for i in range(3)).encode()
+        response = self.test_app.post("/buffered/ndjson/", body, content_type="application/octet-stream")
+        self.assertEqual([0, 1, 2], json.loads(response.body.decode()))
@@ -0,0 +1,88 @@
+import os
+import json
+import time
+import pstats
+import shutil
+import tempfile
+import unittest
+from webtest import TestApp
+from envi import Application, Controller, SamplingProfiler
+
+
+class ProfiledController(Controller):
+    @staticmethod
+    def fast(**kwargs):
+        return {"ok": True}
+
+    @staticmethod
+    def slow(**kwargs):
+        time.sleep(0.05)
+        return {"ok": True}
+
+
+class TestSamplingProfiler(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def app(self, **options):
+        app = Application()
+        app.sampling_profiler = SamplingProfiler(self.directory, **options)
+        app.route("/<action>/", ProfiledController)
+        return app, TestApp(app)
+
+    def samples(self, app, action):
+        aggregate = app.sampling_profiler._aggregates.get(("/<action>", action))
+        return aggregate.samples if aggregate else 0
+
+    def test_every(self):
+        """ Профилируется каждый every-й запрос """
+        app, test_app = self.app(every=3)
+        for _ in range(9):
+            self.assertEqual({"ok": True}, json.loads(test_app.get("/fast/").text))
+        self.assertEqual(3, self.samples(app, "fast"))
+
+    def test_selected_actions(self):
+        """ Запросы к выбранным действиям профилируются всегда, остальные - только выборочно """
+        app, test_app = self.app(actions=["slow"])
+        for _ in range(2):
+            test_app.get("/fast/")
+            test_app.get("/slow/")
+        self.assertEqual(0, self.samples(app, "fast"))
+        self.assertEqual(2, self.samples(app, "slow"))
+
+    def test_pstats(self):
+        """ Результаты cProfile сохраняются в файл pstats роута """
+        app, test_app = self.app(actions=["slow"], flush_every=2)
+        test_app.get("/slow/")
+        test_app.get("/slow/")
+        path = app.sampling_profiler.path("/<action>", "slow")
+        self.assertEqual("action_.slow.%s.pstats" % os.getpid(), os.path.basename(path))
+        functions = [function for _, _, function in pstats.Stats(path).stats]
+        self.assertIn("slow", functions)
+
+    def test_stacks(self):
+        """ Статистический семплер сохраняет свернутые стеки """
+        app, test_app = self.app(actions=["slow"], mode=SamplingProfiler.STACKS, interval=0.002)
+        test_app.get("/slow/")
+        app.sampling_profiler.flush()
+        with open(app.sampling_profiler.path("/<action>", "slow")) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        self.assertTrue(any("slow (TestSamplingProfiler.py" in line for line in lines))
+        stack, amount = lines[0].rsplit(" ", 1)
+        self.assertGreater(int(amount), 0)
+
+    def test_rotation(self):
+        """ Файлы ротируются, старые сверх backups удаляются """
+        app, test_app = self.app(every=1, rotate_after=2, backups=2)
+        for _ in range(8):
+            test_app.get("/fast/")
+        path = app.sampling_profiler.path("/<action>", "fast")
+        self.assertTrue(os.path.exists(path + ".1"))
+        self.assertTrue(os.path.exists(path + ".2"))
+        self.assertFalse(os.path.exists(path + ".3"))
+        self.assertEqual([], [name for name in os.listdir(self.directory) if name.endswith(".tmp")])
+
+    def test_unknown_mode(self):
+        self.assertRaises(ValueError, SamplingProfiler, self.directory, mode="perf")
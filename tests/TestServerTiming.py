@@ -0,0 +1,86 @@
+import json
+import time
+import unittest
+from webtest import TestApp
+from envi import Application, Controller, ProxyController
+
+
+class SlowController(Controller):
+    def setup(self, **kwargs):
+        time.sleep(0.02)
+        return {}
+
+    @staticmethod
+    def slow(**kwargs):
+        time.sleep(0.05)
+        return {"ok": True}
+
+
+class SlowProxyController(ProxyController):
+    @staticmethod
+    def factory_method(app, request, user, host):
+        return SlowController
+
+
+class TimedApplication(Application):
+    server_timing = True
+    reports = []
+
+    def user_initialization_hook(self, request):
+        time.sleep(0.01)
+
+    @classmethod
+    def performance_report(cls, user, request, result, amount):
+        cls.reports.append((dict(request.profiler.phases), amount))
+
+
+class TestServerTiming(unittest.TestCase):
+    def setUp(self):
+        TimedApplication.reports = []
+        self.app = TimedApplication()
+        self.app.route("/<action>/", SlowController)
+        self.app.route("/proxy/<action>/", SlowProxyController)
+        self.test_app = TestApp(self.app)
+
+    def timings(self, response):
+        result = {}
+        for item in response.headers["Server-Timing"].split(","):
+            name, _, duration = item.strip().partition(";dur=")
+            result[name] = float(duration) / 1000
+        return result
+
+    def test_header(self):
+        """ Фазы обработки запроса выводятся в заголовке Server-Timing """
+        timings = self.timings(self.test_app.get("/slow/"))
+        self.assertEqual(["decode", "user", "setup", "action", "apply", "convert", "serialize", "compress", "total"],
+                         list(timings))
+        self.assertGreaterEqual(timings["user"], 0.01)
+        self.assertGreaterEqual(timings["setup"], 0.02)
+        self.assertGreaterEqual(timings["action"], 0.05)
+        self.assertGreaterEqual(timings["total"], sum(v for k, v in timings.items() if k != "total"))
+
+    def test_performance_report(self):
+        """ Разбивка по фазам доступна в performance_report """
+        self.test_app.get("/slow/")
+        [(phases, amount)] = TimedApplication.reports
+        self.assertGreaterEqual(phases["action"], 0.05)
+        self.assertGreaterEqual(amount, sum(phases.values()))
+
+    def test_nested_phases(self):
+        """ Время вложенных фаз (контроллер за проксирующим контроллером) не учитывается дважды """
+        timings = self.timings(self.test_app.get("/proxy/slow/"))
+        self.assertGreaterEqual(timings["action"], 0.05)
+        self.assertLess(timings["action"], 0.07)
+        self.assertGreaterEqual(timings["total"], sum(v for k, v in timings.items() if k != "total"))
+
+    def test_json_rpc(self):
+        """ Фазы вызовов пачки JSON-RPC суммируются """
+        response = self.test_app.get("/slow/", params={"q": json.dumps([
+            {"jsonrpc": "2.0", "method": "slow", "id": 1}, {"jsonrpc": "2.0", "method": "slow", "id": 2}
+        ])})
+        self.assertGreaterEqual(self.timings(response)["action"], 0.1)
+
+    def test_disabled(self):
+        app = Application()
+        app.route("/<action>/", SlowController)
+        self.assertNotIn("Server-Timing", TestApp(app).get("/slow/").headers)
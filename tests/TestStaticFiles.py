@@ -0,0 +1,125 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+import bottle
+from webtest import TestApp
+from envi import Application
+from tests import wsgi_request
+
+
+class TestStaticFiles(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, "js"))
+        self.write("js/app.js", b"console.log(1);" * 10)
+        self.write("big.bin", b"x" * 100000)
+        self.app = Application()
+        self.static = self.app.route_static("/static/", self.root, memory_cache_max_file=1024)
+        self.test_app = TestApp(self.app)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, name, content, mtime=None):
+        path = os.path.join(self.root, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_versioned_name(self):
+        """ Версия в имени файла игнорируется """
+        response = self.test_app.get("/static/js/app.v123.js")
+        self.assertEqual(b"console.log(1);" * 10, response.body)
+        self.assertEqual(self.static.content_type("app.js"), response.headers["Content-Type"])
+        self.assertTrue(response.headers["ETag"].startswith('"'))
+
+    def test_not_found(self):
+        self.assertEqual(404, self.test_app.get("/static/js/missing.js", status=404).status_int)
+        self.assertEqual(404, self.test_app.get("/static/js", status=404).status_int)
+
+    def test_access_denied(self):
+        """ Файлы за пределами root недоступны """
+        with self.assertRaises(bottle.HTTPError) as cm:
+            self.static.resolve("../../etc/passwd")
+        self.assertEqual(403, cm.exception.status_code)
+
+    def test_if_none_match(self):
+        etag = self.test_app.get("/static/js/app.js").headers["ETag"]
+        self.test_app.get("/static/js/app.js", headers={"If-None-Match": etag}, status=304)
+        self.test_app.get("/static/js/app.js", headers={"If-None-Match": '"other", %s' % etag}, status=304)
+        self.test_app.get("/static/js/app.js", headers={"If-None-Match": '"other"'}, status=200)
+        # Прокси (например, gzip nginx) ослабляют ETag
+        self.test_app.get("/static/js/app.js", headers={"If-None-Match": "W/%s" % etag}, status=304)
+        self.test_app.get("/static/js/app.js", headers={"If-None-Match": 'W/"other"'}, status=200)
+
+    def test_if_modified_since(self):
+        last_modified = self.test_app.get("/static/js/app.js").headers["Last-Modified"]
+        self.test_app.get("/static/js/app.js", headers={"If-Modified-Since": last_modified}, status=304)
+        self.test_app.get("/static/js/app.js", headers={"If-Modified-Since": "Thu, 01 Jan 1970 00:00:00 GMT"},
+                          status=200)
+
+    def test_precompressed(self):
+        """ Сжатая копия отдается, только если клиент ее принимает и она не старше оригинала """
+        self.write("js/app.js.gz", gzip.compress(b"console.log(1);" * 10))
+        headers, body = wsgi_request(self.app, "/static/js/app.js", HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual("gzip", headers["Content-Encoding"])
+        self.assertEqual(self.static.content_type("app.js"), headers["Content-Type"])
+        self.assertEqual("Accept-Encoding", headers["Vary"])
+        self.assertEqual(b"console.log(1);" * 10, gzip.decompress(body))
+        plain, body = wsgi_request(self.app, "/static/js/app.js", HTTP_ACCEPT_ENCODING="gzip;q=0, deflate")
+        self.assertNotIn("Content-Encoding", plain)
+        self.assertEqual(b"console.log(1);" * 10, body)
+        self.assertNotEqual(headers["Etag"], plain["Etag"])
+
+        self.write("js/app.js.br", b"stale", mtime=0)
+        headers, body = wsgi_request(self.app, "/static/js/app.js", HTTP_ACCEPT_ENCODING="br, gzip")
+        self.assertEqual("gzip", headers["Content-Encoding"])
+
+    def test_stat_cache(self):
+        """ Изменения файлов замечаются после stat_ttl """
+        self.test_app.get("/static/js/app.js")
+        self.write("js/app.js", b"changed")
+        self.assertEqual(b"console.log(1);" * 10, self.test_app.get("/static/js/app.js").body)
+        self.static.invalidate()
+        self.assertEqual(b"changed", self.test_app.get("/static/js/app.js").body)
+
+    def test_changed_within_stat_ttl(self):
+        """ Content-Length соответствует отправленному содержимому, даже если файл изменился после stat """
+        self.static.stat(os.path.join(self.root, "js", "app.js"))
+        self.write("js/app.js", b"changed")
+        response = self.test_app.get("/static/js/app.js")
+        self.assertEqual((b"changed", "7"), (response.body, response.headers["Content-Length"]))
+
+    def test_memory_cache(self):
+        """ Небольшие файлы кешируются в памяти, большие - читаются с диска """
+        self.test_app.get("/static/js/app.js")
+        self.test_app.get("/static/big.bin")
+        self.assertEqual(1, len(self.static._contents))
+        self.assertEqual(100000, len(self.test_app.get("/static/big.bin").body))
+
+    def test_file_wrapper(self):
+        """ Большие файлы отправляются через wsgi.file_wrapper сервера """
+        wrapped = []
+
+        def file_wrapper(f, block_size=8192):
+            wrapped.append(f)
+            return iter(lambda: f.read(block_size), b"")
+
+        body = wsgi_request(self.app, "/static/big.bin", **{"wsgi.file_wrapper": file_wrapper})[1]
+        self.assertEqual(100000, len(body))
+        self.assertEqual(1, len(wrapped))
+        wrapped[0].close()
+
+    def test_head(self):
+        response = self.test_app.head("/static/js/app.js")
+        self.assertEqual(b"", response.body)
+        self.assertEqual("150", response.headers["Content-Length"])
+
+    def test_range(self):
+        """ Запросы с Range обрабатываются bottle.static_file """
+        response = self.test_app.get("/static/js/app.v1.js", headers={"Range": "bytes=0-6"}, status=206)
+        self.assertEqual(b"console", response.body)
@@ -0,0 +1,145 @@
+import json
+import unittest
+from webtest import TestApp
+from envi import Application, Controller, StreamingResponse, template
+
+
+class ExportController(Controller):
+    """ Действия, возвращающие потоковые ответы """
+
+    @staticmethod
+    def rows(request, **kwargs):
+        return ({"i": i} for i in range(request.get("count", 3, cast_type=int)))
+
+    @staticmethod
+    def ndjson(**kwargs):
+        return StreamingResponse(({"i": i} for i in range(3)), StreamingResponse.NDJSON)
+
+    @staticmethod
+    def raw(**kwargs):
+        return StreamingResponse(iter(["a", b"b", 1]), StreamingResponse.RAW, content_type="text/plain")
+
+    @staticmethod
+    def fails_before_first_item(**kwargs):
+        raise ValueError("before")
+        yield
+
+    @staticmethod
+    def fails_after_first_item(**kwargs):
+        yield {"i": 0}
+        raise ValueError("after")
+
+    @staticmethod
+    @template("row")
+    def template_rows(**kwargs):
+        return iter([1, 2])
+
+
+class WrappingApplication(Application):
+    """ Приложение с конвертером, оборачивающим результат (как SuitApplication) """
+
+    def ajax_output_converter(self, result):
+        if isinstance(result, Exception):
+            return {"error": str(result)}
+        return {"result": result}
+
+    def static_output_converter(self, result):
+        return "<%s>%s</%s>" % (result.template, result.data, result.template)
+
+    @classmethod
+    def log(cls, err):
+        pass
+
+
+class TestStreamingResponse(unittest.TestCase):
+    def test_first_chunk(self):
+        """ Первый элемент отправляется отдельной порцией, остальные накапливаются до buffer_size """
+        self.assertEqual([b"[0", b",1,2]"], list(StreamingResponse(iter(range(3)))))
+        self.assertEqual([b"[]"], list(StreamingResponse(iter([]))))
+
+    def test_buffer_size(self):
+        response = StreamingResponse(iter(["x" * 10] * 3), StreamingResponse.NDJSON)
+        response.buffer_size = 20
+        self.assertEqual([b'"xxxxxxxxxx"\n', b'"xxxxxxxxxx"\n"xxxxxxxxxx"\n'], list(response))
+
+    def test_lazy(self):
+        """ Элементы запрашиваются у итератора по мере отправки """
+        produced = []
+
+        def items():
+            for i in range(3):
+                produced.append(i)
+                yield i
+
+        chunks = iter(StreamingResponse(items()))
+        self.assertEqual(b"[0", next(chunks))
+        self.assertEqual([0], produced)
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, StreamingResponse, [], "xml")
+
+
+class TestStreamingRoute(unittest.TestCase):
+    def setUp(self):
+        self.app = Application()
+        self.app.route("/", ExportController)
+        self.app.route("/<action>/", ExportController)
+        self.test_app = TestApp(self.app)
+
+    def get(self, url, **kwargs):
+        return self.test_app.get(url, headers={"X-Requested-With": "XMLHttpRequest"}, **kwargs)
+
+    def test_generator(self):
+        """ Генератор отправляется как JSON-массив без Content-Length """
+        headers = {}
+        environ = {"REQUEST_METHOD": "GET", "PATH_INFO": "/rows/", "QUERY_STRING": "count=1000",
+                   "HTTP_X_REQUESTED_WITH": "XMLHttpRequest"}
+        start_response = lambda status, response_headers, exc_info=None: headers.update(response_headers)
+        body = b"".join(self.app(environ, start_response))
+        self.assertEqual("application/json", headers["Content-Type"])
+        self.assertNotIn("Content-Length", headers)
+        self.assertEqual([{"i": i} for i in range(1000)], json.loads(body.decode()))
+
+    def test_ndjson(self):
+        response = self.get("/ndjson/")
+        self.assertEqual("application/x-ndjson", response.content_type)
+        self.assertEqual(b'{"i":0}\n{"i":1}\n{"i":2}\n', response.body.replace(b" ", b""))
+
+    def test_raw(self):
+        response = self.get("/raw/")
+        self.assertEqual("text/plain", response.content_type)
+        self.assertEqual(b"ab1", response.body)
+
+    def test_converters(self):
+        """ Каждый элемент проходит через ajax_output_converter приложения """
+        app = WrappingApplication()
+        app.route("/<action>/", ExportController)
+        response = TestApp(app).get("/rows/", headers={"X-Requested-With": "XMLHttpRequest"})
+        self.assertEqual([{"result": {"i": i}} for i in range(3)], json.loads(response.body.decode()))
+
+    def test_template(self):
+        """ При статической загрузке с шаблоном каждый элемент отрисовывается static_output_converter """
+        app = WrappingApplication()
+        app.route("/<action>/", ExportController)
+        response = TestApp(app).get("/template_rows/")
+        self.assertEqual(b"<row>1</row><row>2</row>", response.body)
+
+    def test_error_before_first_item(self):
+        """ Исключение до начала отправки обрабатывается как обычно """
+        self.app.log = lambda err: None
+        response = self.get("/fails_before_first_item/")
+        self.assertEqual({"error": {"code": 0, "type": "<class 'ValueError'>", "message": "before"}},
+                         json.loads(response.body.decode()))
+
+    def test_error_after_first_item(self):
+        """ Исключение после начала отправки становится последним элементом ответа """
+        app = WrappingApplication()
+        app.route("/<action>/", ExportController)
+        response = TestApp(app).get("/fails_after_first_item/", headers={"X-Requested-With": "XMLHttpRequest"})
+        self.assertEqual([{"result": {"i": 0}}, {"error": "after"}], json.loads(response.body.decode()))
+
+    def test_json_rpc(self):
+        """ В ответах JSON-RPC потоковый результат собирается в список """
+        response = self.test_app.get("/", params={"q": json.dumps({"jsonrpc": "2.0", "method": "rows", "id": 1})})
+        self.assertEqual({"jsonrpc": "2.0", "result": [{"i": 0}, {"i": 1}, {"i": 2}], "id": 1},
+                         json.loads(response.body.decode()))
@@ -0,0 +1,403 @@
+import json
+import time
+import queue
+import socket
+import asyncio
+import threading
+import unittest
+from datetime import datetime
+from envi import Application, AsgiApplication, Request, WebSocketController, WebSocketControllerNb, \
+    UwsgiWebSocketTransport, AsgiWebSocketTransport, BinaryCodec, BroadcastHub, json_loads_handler
+
+
+class FakeUwsgi(object):
+    """ Имитация WebSocket-API uwsgi поверх socketpair: сообщения передаются с 4-байтовой длиной """
+
+    def __init__(self):
+        self.server, self.client = socket.socketpair()
+        self.buffer = b""
+        self.sent = queue.Queue()
+        self.recv_nb_calls = 0
+        self.handshake_args = None
+
+    def websocket_handshake(self, *args):
+        self.handshake_args = args
+
+    def connection_fd(self):
+        return self.server.fileno()
+
+    def frame(self):
+        if len(self.buffer) >= 4:
+            size = int.from_bytes(self.buffer[:4], "big")
+            if len(self.buffer) >= 4 + size:
+                frame, self.buffer = self.buffer[4:4 + size], self.buffer[4 + size:]
+                return frame
+
+    def websocket_recv(self):
+        while True:
+            frame = self.frame()
+            if frame is not None:
+                return frame
+            data = self.server.recv(4096)
+            if not data:
+                raise OSError("connection closed")
+            self.buffer += data
+
+    def websocket_recv_nb(self):
+        self.recv_nb_calls += 1
+        frame = self.frame()
+        if frame is not None:
+            return frame
+        try:
+            data = self.server.recv(4096, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return b""
+        if not data:
+            raise OSError("connection closed")
+        self.buffer += data
+        return self.frame() or b""
+
+    def websocket_send(self, data):
+        self.sent.put(("text", data))
+
+    def websocket_send_binary(self, data):
+        self.sent.put(("binary", data))
+
+    def client_send_raw(self, *frames):
+        self.client.sendall(b"".join(len(frame).to_bytes(4, "big") + frame for frame in frames))
+
+    def client_send(self, *messages):
+        self.client_send_raw(*[json.dumps(msg).encode() for msg in messages])
+
+    def received_raw(self, timeout=1.0):
+        return self.sent.get(timeout=timeout)
+
+    def received(self, timeout=1.0):
+        kind, data = self.received_raw(timeout)
+        return json.loads(data.decode() if isinstance(data, bytes) else data)
+
+
+class EchoMixin(object):
+    uwsgi = None
+    connections = None
+    events = None
+
+    def create_transport(self):
+        return UwsgiWebSocketTransport(self.uwsgi)
+
+    def open(self, app, request, user, host):
+        self.events.append("open")
+        self.connections.put(self)
+
+    def close(self, app, request, user, host):
+        self.events.append("close")
+
+    def tick(self, app, request, user, host):
+        self.events.append("tick")
+
+    @staticmethod
+    def echo(request, **kwargs):
+        return {"echo": request.get("text")}
+
+
+class EchoController(EchoMixin, WebSocketController):
+    pass
+
+
+class EchoControllerNb(EchoMixin, WebSocketControllerNb):
+    pass
+
+
+class LegacyControllerNb(EchoControllerNb):
+    """ Контроллер со старым способом отправки сообщений (переопределенное свойство messages) """
+    polls = 0
+
+    @property
+    def messages(self):
+        LegacyControllerNb.polls += 1
+        return [{"poll": LegacyControllerNb.polls}] if LegacyControllerNb.polls == 3 else []
+
+
+class BurstControllerNb(EchoControllerNb):
+    """ Отправляет несколько сообщений до первого пробуждения обработчика """
+
+    def open(self, app, request, user, host):
+        for i in range(3):
+            self.push({"i": i})
+        super().open(app, request, user, host)
+
+
+def start_connection(controller, request) -> tuple:
+    """ Запускает обработчик uwsgi-соединения в потоке. Возвращает (поток, список SystemExit обработчика):
+    connect завершает запрос uwsgi через SystemExit, и он не должен выходить из потока
+    """
+    exits = []
+
+    def connect():
+        try:
+            controller.instance().connect(Application(), request, None, None)
+        except SystemExit as err:
+            exits.append(err)
+
+    thread = threading.Thread(target=connect, daemon=True)
+    thread.start()
+    return thread, exits
+
+
+class UwsgiTransportFixture(unittest.TestCase):
+    controller = None
+    environ = {}
+
+    def setUp(self):
+        self.uwsgi = FakeUwsgi()
+        self.controller.uwsgi = self.uwsgi
+        self.controller.connections = queue.Queue()
+        self.controller.events = []
+        self.thread, self.exits = start_connection(
+            self.controller, Request(environ=dict(self.environ, REMOTE_ADDR="127.0.0.1"))
+        )
+        self.connection = self.controller.connections.get(timeout=1)
+
+    def tearDown(self):
+        self.uwsgi.client.close()
+        self.thread.join(1)
+        self.assertFalse(self.thread.is_alive())
+        self.assertEqual(1, len(self.exits))
+        self.assertEqual("close", self.controller.events[-1])
+        self.uwsgi.server.close()
+
+
+class TestUwsgiTransport(unittest.TestCase):
+    def test_notify_while_closing(self):
+        """ notify из других потоков не пишет в дескрипторы, закрытые (и, возможно, уже переиспользованные) close """
+        transport = UwsgiWebSocketTransport(FakeUwsgi())
+        errors = []
+
+        def notify():
+            try:
+                for _ in range(1000):
+                    transport.notify()
+            except OSError as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=notify) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        transport.close()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertTrue(transport.closed)
+
+
+class TestWebSocketController(UwsgiTransportFixture):
+    controller = EchoController
+
+    def test_request_from_browser(self):
+        """ Блокирующий контроллер обрабатывает сообщения клиента (раньше - TypeError из-за аргумента uwsgi) """
+        self.uwsgi.client_send({"action": "echo", "text": "hi"}, {"action": "echo", "text": "again"})
+        self.assertEqual({"echo": "hi", "ws": {"event": "echo"}}, self.uwsgi.received())
+        self.assertEqual({"echo": "again", "ws": {"event": "echo"}}, self.uwsgi.received())
+        self.uwsgi.client_send_raw(b"not json", b"5")
+        self.uwsgi.client_send({"action": "echo", "text": "third"})
+        self.assertEqual("third", self.uwsgi.received()["echo"])
+        self.assertEqual(["open", "tick", "tick", "tick"], self.controller.events)
+
+
+class TestWebSocketControllerNb(UwsgiTransportFixture):
+    controller = EchoControllerNb
+
+    def test_request_from_browser(self):
+        self.uwsgi.client_send({"action": "echo", "text": "hi"}, {"action": "echo", "text": "again"})
+        self.assertEqual("hi", self.uwsgi.received()["echo"])
+        self.assertEqual("again", self.uwsgi.received()["echo"])
+
+    def test_push(self):
+        """ Сообщения из других потоков отправляются сразу, без ожидания очередного опроса """
+        started = time.perf_counter()
+        self.connection.push({"event": "news"})
+        self.assertEqual({"event": "news"}, self.uwsgi.received())
+        self.assertLess(time.perf_counter() - started, 0.05)
+        for i in range(100):
+            self.connection.push({"i": i})
+        self.assertEqual(list(range(100)), [self.uwsgi.received()["i"] for _ in range(100)])
+
+    def test_idle(self):
+        """ Простаивающее соединение не опрашивает сокет """
+        time.sleep(0.1)
+        calls = self.uwsgi.recv_nb_calls
+        time.sleep(0.3)
+        self.assertEqual(calls, self.uwsgi.recv_nb_calls)
+
+
+class TestLegacyMessages(UwsgiTransportFixture):
+    controller = LegacyControllerNb
+
+    def test_messages_polled(self):
+        """ Переопределенное свойство messages по-прежнему опрашивается """
+        LegacyControllerNb.polls = 0
+        self.assertEqual({"poll": 3}, self.uwsgi.received())
+
+
+class TestJsonBatch(UwsgiTransportFixture):
+    controller = BurstControllerNb
+    environ = {"HTTP_SEC_WEBSOCKET_PROTOCOL": "xml, json.batch", "HTTP_SEC_WEBSOCKET_KEY": "key"}
+
+    def test_batch(self):
+        """ Сообщения, полученные за одно пробуждение, отправляются одним массивом """
+        self.assertEqual(("key", "", "json.batch"), self.uwsgi.handshake_args)
+        self.assertEqual([{"i": 0}, {"i": 1}, {"i": 2}], self.uwsgi.received())
+        self.uwsgi.client_send([{"action": "echo", "text": "a"}, {"action": "echo", "text": "b"}])
+        self.assertEqual(["a", "b"], [result["echo"] for result in self.uwsgi.received()])
+
+
+class TestUnknownProtocol(UwsgiTransportFixture):
+    controller = EchoControllerNb
+    environ = {"HTTP_SEC_WEBSOCKET_PROTOCOL": "xml", "HTTP_SEC_WEBSOCKET_KEY": "key"}
+
+    def test_json(self):
+        """ Без согласованного подпротокола используется JSON по сообщению на результат """
+        self.assertEqual((), self.uwsgi.handshake_args)
+        self.uwsgi.client_send({"action": "echo", "text": "a"})
+        self.assertEqual(("text", '{"echo":"a","ws":{"event":"echo"}}'), self.uwsgi.received_raw())
+
+
+@unittest.skipUnless(BinaryCodec.get("msgpack"), "msgpack is not installed")
+class TestMsgpackBatch(UwsgiTransportFixture):
+    controller = BurstControllerNb
+    environ = {"HTTP_SEC_WEBSOCKET_PROTOCOL": "msgpack.batch, json", "HTTP_SEC_WEBSOCKET_KEY": "key",
+               "HTTP_ORIGIN": "http://example.com"}
+
+    def test_batch(self):
+        codec = BinaryCodec.get("msgpack")
+        self.assertEqual(("key", "http://example.com", "msgpack.batch"), self.uwsgi.handshake_args)
+        kind, data = self.uwsgi.received_raw()
+        self.assertEqual("binary", kind)
+        self.assertEqual([{"i": 0}, {"i": 1}, {"i": 2}], codec.loads(data))
+
+        moment = datetime(2016, 1, 2, 3, 4, 5)
+        self.uwsgi.client_send_raw(codec.dumps([{"action": "echo", "text": "a"}, {"action": "echo", "text": moment}]))
+        kind, data = self.uwsgi.received_raw()
+        self.assertEqual([
+            {"echo": "a", "ws": {"event": "echo"}}, {"echo": moment, "ws": {"event": "echo"}}
+        ], codec.loads(data, object_hook=json_loads_handler))
+
+
+class AsyncEchoController(WebSocketControllerNb):
+    events = []
+    connections = None
+
+    async def open(self, app, request, user, host):
+        self.events.append(("open", user))
+        self.connections.put_nowait(self)
+
+    def close(self, app, request, user, host):
+        self.events.append("close")
+
+    @staticmethod
+    async def echo(request, **kwargs):
+        await asyncio.sleep(0)
+        return {"echo": request.get("text")}
+
+    @staticmethod
+    def blocking(request, **kwargs):
+        return {"thread": threading.current_thread().name}
+
+
+class AsgiUserApplication(AsgiApplication):
+    async def user_initialization_hook(self, request):
+        return {"id": 1}
+
+
+class TestAsgiWebSocket(unittest.TestCase):
+    def setUp(self):
+        self.app = AsgiUserApplication()
+        self.app.route("/ws/", AsyncEchoController)
+        AsyncEchoController.events = []
+
+    @staticmethod
+    def scope(path, headers=()):
+        return {"type": "websocket", "path": path, "query_string": b"", "headers": list(headers),
+                "server": ("testserver", 80), "client": ("127.0.0.1", 5000), "scheme": "ws"}
+
+    def test_connection(self):
+        async def main():
+            incoming, sent = asyncio.Queue(), asyncio.Queue()
+            AsyncEchoController.connections = asyncio.Queue()
+            incoming.put_nowait({"type": "websocket.connect"})
+            task = asyncio.ensure_future(self.app(self.scope("/ws"), incoming.get, sent.put))
+            self.assertEqual({"type": "websocket.accept"}, await sent.get())
+            connection = await AsyncEchoController.connections.get()
+
+            incoming.put_nowait({"type": "websocket.receive", "text": json.dumps({"action": "echo", "text": "hi"})})
+            self.assertEqual({"echo": "hi", "ws": {"event": "echo"}}, json.loads((await sent.get())["text"]))
+
+            incoming.put_nowait({"type": "websocket.receive", "bytes": json.dumps({"action": "blocking"}).encode()})
+            self.assertTrue(json.loads((await sent.get())["text"])["thread"].startswith("envi-sync"))
+
+            # push из другого потока
+            threading.Thread(target=connection.push, args=({"event": "news"},)).start()
+            self.assertEqual({"event": "news"}, json.loads((await asyncio.wait_for(sent.get(), 1))["text"]))
+
+            incoming.put_nowait({"type": "websocket.disconnect", "code": 1000})
+            await asyncio.wait_for(task, 1)
+            self.assertEqual([("open", {"id": 1}), "close"], AsyncEchoController.events)
+
+        asyncio.run(main())
+
+    def test_not_found(self):
+        """ Соединения с адресами без WebSocket-контроллера отклоняются """
+        async def main():
+            incoming, sent = asyncio.Queue(), []
+            incoming.put_nowait({"type": "websocket.connect"})
+
+            async def send(message):
+                sent.append(message)
+
+            await self.app(self.scope("/nowhere"), incoming.get, send)
+            return sent
+
+        self.assertEqual([{"type": "websocket.close", "code": 1008}], asyncio.run(main()))
+
+    def test_transport_wait(self):
+        """ wait возвращает сообщения клиента и очереди, не теряя ожидаемое сообщение клиента при пробуждении """
+        async def main():
+            incoming, sent = asyncio.Queue(), []
+            transport = AsgiWebSocketTransport(incoming.get, sent.append)
+            self.assertEqual(([], []), await transport.wait(0.01))
+            transport.push(1)
+            transport.push(2)
+            self.assertEqual(([], [1, 2]), await transport.wait())
+            incoming.put_nowait({"type": "websocket.receive", "text": "a"})
+            self.assertEqual((["a"], []), await transport.wait())
+
+        asyncio.run(main())
+
+    @unittest.skipUnless(BinaryCodec.get("cbor"), "cbor2 is not installed")
+    def test_cbor(self):
+        """ Двоичный формат в ASGI: запросы, ответы и рассылка кодируются в CBOR (рассылка - один раз) """
+        codec = BinaryCodec.get("cbor")
+        hub = BroadcastHub()
+
+        async def main():
+            incoming, sent = asyncio.Queue(), asyncio.Queue()
+            AsyncEchoController.connections = asyncio.Queue()
+            incoming.put_nowait({"type": "websocket.connect"})
+            task = asyncio.ensure_future(self.app(
+                self.scope("/ws", [(b"sec-websocket-protocol", b"cbor, json")]), incoming.get, sent.put
+            ))
+            self.assertEqual({"type": "websocket.accept", "subprotocol": "cbor"}, await sent.get())
+            connection = await AsyncEchoController.connections.get()
+
+            incoming.put_nowait({"type": "websocket.receive", "bytes": codec.dumps({"action": "echo", "text": "hi"})})
+            self.assertEqual({"echo": "hi", "ws": {"event": "echo"}}, codec.loads((await sent.get())["bytes"]))
+
+            hub.subscribe(connection, "news")
+            hub.publish("news", {"title": "hello"})
+            self.assertEqual({"title": "hello"}, codec.loads((await asyncio.wait_for(sent.get(), 1))["bytes"]))
+
+            incoming.put_nowait({"type": "websocket.disconnect", "code": 1000})
+            await asyncio.wait_for(task, 1)
+
+        asyncio.run(main())
+        self.assertEqual(0, hub.subscribers("news"))
@@ -0,0 +1,12 @@
+def wsgi_request(app, path: str, **environ) -> tuple:
+    """ GET-запрос напрямую к WSGI-приложению - для проверки сжатых ответов, которые webtest распаковывает
+    Возвращает (заголовки ответа и код ответа в ключе status, тело ответа)
+    """
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response.update(headers)
+        response["status"] = int(status.split()[0])
+
+    environ = dict({"REQUEST_METHOD": "GET", "PATH_INFO": path}, **environ)
+    return response, b"".join(app(environ, start_response))